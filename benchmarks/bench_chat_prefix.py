@@ -0,0 +1,81 @@
+"""Prompt formatting time of long chats with and without the chat template prefix cache.
+
+Replays a chat that grows by one exchange per request, with a list of tools,
+through the `Jinja2ChatFormatter` of a model's chat template (ChatML if it has
+none) and reports the time from messages to prompt tokens per request, i.e.
+rendering plus tokenization as in the chat completion handler, with the prefix
+cache disabled and enabled.
+
+Example:
+    python benchmarks/bench_chat_prefix.py --model_path qwen2.5-1.5b-instruct-q4_k_m.gguf --turns 50 --tools 40
+"""
+
+import argparse
+import statistics
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_chat_format import CHATML_CHAT_TEMPLATE, Jinja2ChatFormatter
+
+
+def make_tools(n_tools: int):
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": f"tool_{i}",
+                "description": f"Looks up record type {i} by id and returns its fields.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {f"field_{j}": {"type": "string"} for j in range(6)},
+                    "required": ["field_0"],
+                },
+            },
+        }
+        for i in range(n_tools)
+    ]
+
+
+def make_chats(n_turns: int):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    chats = []
+    for i in range(n_turns):
+        messages = messages + [{"role": "user", "content": f"Question {i}: " + "what about this? " * 20}]
+        chats.append(messages)
+        messages = messages + [{"role": "assistant", "content": f"Answer {i}: " + "it is like that. " * 40}]
+    return chats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50, help="Requests, the chat grows by one exchange per request")
+    parser.add_argument("--tools", type=int, default=20, help="Number of tools sent with every request")
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF model, its tokenizer and chat template are used")
+    args = parser.parse_args()
+
+    llm = Llama(model_path=args.model_path, vocab_only=True, verbose=False)
+    template = llm.metadata.get("tokenizer.chat_template", CHATML_CHAT_TEMPLATE)
+    eos_token = llm._model.token_get_text(llm.token_eos())
+    bos_token = llm._model.token_get_text(llm.token_bos())
+
+    tools = make_tools(args.tools)
+    chats = make_chats(args.turns)
+    print(f"turns={args.turns} tools={args.tools}")
+    print(f"{'formatter':<12} {'mean ms':>9} {'last ms':>9}")
+    for name, size in [("no cache", 0), ("cache", 64)]:
+        formatter = Jinja2ChatFormatter(
+            template=template, eos_token=eos_token, bos_token=bos_token, prefix_cache_size=size
+        )
+        timings = []
+        for messages in chats:
+            t_start = time.perf_counter()
+            result = formatter(messages=messages, tools=tools, tokenizer=llm)
+            if result.prompt_tokens is None:
+                llm.tokenize(result.prompt.encode("utf-8"), add_bos=False, special=True)
+            timings.append(time.perf_counter() - t_start)
+        print(f"{name:<12} {statistics.mean(timings) * 1e3:>9.3f} {timings[-1] * 1e3:>9.3f}")
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
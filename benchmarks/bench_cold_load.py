@@ -0,0 +1,81 @@
+"""Cold vs. warm model load benchmark for the `prefetch` policies of `Llama`.
+
+Cold runs evict the model file from the page cache with
+`posix_fadvise(POSIX_FADV_DONTNEED)` before loading, so they approximate a
+freshly started node. Linux only (other platforms can only run warm).
+
+Example:
+    python benchmarks/bench_cold_load.py path/to/model.gguf --runs 3
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama._utils_prefetch import PREFETCH_POLICIES, evict_page_cache
+
+
+def load_once(model_path: str, policy: str, prompt: str, n_gpu_layers: int) -> dict:
+    t_start = time.perf_counter()
+    llm = Llama(
+        model_path=model_path,
+        prefetch=policy,
+        n_gpu_layers=n_gpu_layers,
+        verbose=False,
+    )
+    llm.eval(llm.tokenize(prompt.encode("utf-8")))
+    timings = dict(llm.load_timings)
+    timings["total"] = time.perf_counter() - t_start
+    llm.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_path", type=str, help="Path to a GGUF model file")
+    parser.add_argument(
+        "--policies",
+        nargs="*",
+        choices=PREFETCH_POLICIES,
+        default=list(PREFETCH_POLICIES),
+        help="Prefetch policies to compare",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Runs per policy and state")
+    parser.add_argument("--prompt", type=str, default="The quick brown fox jumps over")
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    args = parser.parse_args()
+
+    states = ["cold", "warm"]
+    if not evict_page_cache(args.model_path):
+        print("posix_fadvise is not available, only warm loads are measured", file=sys.stderr)
+        states = ["warm"]
+
+    header = f"{'policy':<10} {'state':<5} {'total':>9} {'metadata':>9} {'mapping':>9} {'context':>9} {'first':>9}"
+    print(header)
+    print("-" * len(header))
+    for policy in args.policies:
+        for state in states:
+            if state == "warm":
+                # Make sure the file is resident before the warm runs
+                load_once(args.model_path, "none", args.prompt, args.n_gpu_layers)
+            runs = []
+            for _ in range(args.runs):
+                if state == "cold":
+                    evict_page_cache(args.model_path)
+                runs.append(load_once(args.model_path, policy, args.prompt, args.n_gpu_layers))
+
+            def median_ms(key):
+                values = [r[key] for r in runs if key in r]
+                return f"{statistics.median(values) * 1000:9.1f}" if values else f"{'-':>9}"
+
+            print(
+                f"{policy:<10} {state:<5} {median_ms('total')} {median_ms('metadata')} "
+                f"{median_ms('tensor_mapping')} {median_ms('context')} {median_ms('first_token')}"
+            )
+    print("(median milliseconds)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Throughput of /v1/embeddings under many concurrent clients.
+
+Sends a synthetic corpus of short documents to a running `nexa server` with an
+embedding model, one document per request from `--clients` concurrent
+clients, and reports documents/s and the tokens counted in `usage`. With
+`--model_path` the same corpus is also embedded offline with one
+`Llama.embed_array` call, the upper bound for the server.
+
+Example:
+    nexa server nomic-embed-text-v1.5:fp16 --port 8000
+    python benchmarks/bench_embedding_server.py --clients 64 --docs 20000 --model_path nomic.gguf
+"""
+
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+WORDS = (
+    "the model index query vector search document chunk answer source context "
+    "retrieval embedding token batch server client cache latency memory table "
+    "report summary customer order invoice product price shipping account"
+).split()
+
+
+def make_corpus(n_docs: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))) for _ in range(n_docs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", type=str, default="http://localhost:8000/v1/embeddings")
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent clients")
+    parser.add_argument("--docs", type=int, default=20000, help="Number of documents")
+    parser.add_argument("--model_path", type=str, help="Also embed the corpus offline with this GGUF model")
+    parser.add_argument("--nctx", type=int, default=2048, help="Same as the --nctx of the server")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.docs)
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.clients))
+
+    def embed(doc):
+        response = session.post(args.url, json={"input": doc})
+        response.raise_for_status()
+        return response.json()["usage"]["prompt_tokens"]
+
+    print(f"docs={len(corpus)} clients={args.clients}")
+    print(f"{'path':<16} {'docs/s':>9} {'tok/s':>10}")
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        n_tokens = sum(pool.map(embed, corpus))
+    elapsed = time.perf_counter() - t_start
+    print(f"{'server':<16} {len(corpus) / elapsed:>9.1f} {n_tokens / elapsed:>10.1f}")
+
+    if args.model_path:
+        from nexa.gguf.llama.llama import Llama
+
+        # Same settings as the server
+        llm = Llama(model_path=args.model_path, embedding=True, n_ctx=args.nctx, verbose=False)
+        t_start = time.perf_counter()
+        _, n_tokens = llm.embed_array(corpus, return_count=True)
+        elapsed = time.perf_counter() - t_start
+        print(f"{'offline batch':<16} {len(corpus) / elapsed:>9.1f} {n_tokens / elapsed:>10.1f}")
+        llm.close()
+
+
+if __name__ == "__main__":
+    main()
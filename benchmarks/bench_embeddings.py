@@ -0,0 +1,91 @@
+"""Embedding throughput of the batched engine over many short documents.
+
+Embeds a synthetic corpus of short documents (like the chunks of a RAG index)
+three ways: one `Llama.embed` call per document, as the server used to do for
+a list input, one `Llama.embed` call for the whole corpus (lists of floats)
+and one `Llama.embed_array` call (a float32 matrix). The per-document path is
+timed on a sample and reported per document.
+
+Example:
+    python benchmarks/bench_embeddings.py --model_path nomic-embed-text-v1.5.Q8_0.gguf --docs 100000
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from nexa.gguf.llama.llama import Llama
+
+WORDS = (
+    "the model index query vector search document chunk answer source context "
+    "retrieval embedding token batch server client cache latency memory table "
+    "report summary customer order invoice product price shipping account"
+).split()
+
+
+def make_corpus(n_docs: int, min_words: int, max_words: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+        for _ in range(n_docs)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF embedding model")
+    parser.add_argument("--docs", type=int, default=100000, help="Number of documents")
+    parser.add_argument("--min_words", type=int, default=5)
+    parser.add_argument("--max_words", type=int, default=40)
+    parser.add_argument("--per_doc_sample", type=int, default=2000,
+                        help="Documents embedded one call at a time")
+    parser.add_argument("--n_ctx", type=int, default=2048)
+    parser.add_argument("--n_batch", type=int, default=2048)
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    parser.add_argument("--normalize", action="store_true")
+    args = parser.parse_args()
+
+    llm = Llama(
+        model_path=args.model_path,
+        embedding=True,
+        n_ctx=args.n_ctx,
+        n_batch=args.n_batch,
+        n_ubatch=args.n_batch,
+        n_gpu_layers=args.n_gpu_layers,
+        verbose=False,
+    )
+    corpus = make_corpus(args.docs, args.min_words, args.max_words)
+    sample = corpus[: args.per_doc_sample]
+
+    print(f"docs={len(corpus)} n_batch={args.n_batch}")
+    print(f"{'path':<22} {'docs/s':>9} {'tok/s':>10} {'100k docs s':>12}")
+
+    def report(name, n_docs, n_tokens, elapsed):
+        print(
+            f"{name:<22} {n_docs / elapsed:>9.1f} {n_tokens / elapsed:>10.1f} "
+            f"{100000 * elapsed / n_docs:>12.1f}"
+        )
+
+    t_start = time.perf_counter()
+    n_tokens = 0
+    for doc in sample:
+        _, count = llm.embed(doc, normalize=args.normalize, return_count=True)
+        n_tokens += count
+    report("embed per document", len(sample), n_tokens, time.perf_counter() - t_start)
+
+    t_start = time.perf_counter()
+    _, n_tokens = llm.embed(corpus, normalize=args.normalize, return_count=True)
+    report("embed (lists)", len(corpus), n_tokens, time.perf_counter() - t_start)
+
+    t_start = time.perf_counter()
+    embeddings, n_tokens = llm.embed_array(corpus, normalize=args.normalize, return_count=True)
+    report("embed_array (ndarray)", len(corpus), n_tokens, time.perf_counter() - t_start)
+    assert embeddings.shape == (len(corpus), llm.n_embd()) and embeddings.dtype == np.single
+
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
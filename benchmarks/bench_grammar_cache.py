@@ -0,0 +1,144 @@
+"""Grammar setup time per request with and without the compiled grammar cache.
+
+Replays requests that cycle through a few JSON schemas, like a service sending
+the same tool and response schemas over and over, and times
+`LlamaGrammar.from_json_schema` per request with the process-wide grammar
+cache disabled and enabled. With `--model_path` the native side is timed as
+well: parsing the GBNF into a llama.cpp grammar sampler for every request
+against cloning the parsed sampler kept by the model.
+
+Example:
+    python benchmarks/bench_grammar_cache.py --requests 2000
+    python benchmarks/bench_grammar_cache.py --model_path model.gguf
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from nexa.gguf.llama.llama_grammar import GRAMMAR_CACHE, LlamaGrammar
+
+SCHEMAS = [
+    {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "arguments": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string"},
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                },
+                "required": ["location"],
+            },
+        },
+        "required": ["name", "arguments"],
+    },
+    {
+        "type": "object",
+        "properties": {
+            "invoice_id": {"type": "string", "pattern": "^INV-[0-9]{6}$"},
+            "date": {"type": "string", "format": "date"},
+            "customer": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "email": {"type": "string"},
+                    "vip": {"type": "boolean"},
+                },
+                "required": ["name"],
+            },
+            "items": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": 20,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "sku": {"type": "string"},
+                        "quantity": {"type": "integer", "minimum": 1},
+                        "price": {"type": "number"},
+                    },
+                    "required": ["sku", "quantity", "price"],
+                },
+            },
+            "total": {"type": "number"},
+        },
+        "required": ["invoice_id", "items", "total"],
+    },
+    {
+        "type": "object",
+        "properties": {
+            "sentiment": {"type": "string", "enum": ["positive", "neutral", "negative"]},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+            "keywords": {"type": "array", "items": {"type": "string"}, "maxItems": 5},
+        },
+        "required": ["sentiment", "confidence"],
+    },
+]
+
+
+def time_requests(setup, n_requests: int):
+    timings = []
+    for i in range(n_requests):
+        t_start = time.perf_counter()
+        setup(i)
+        timings.append(time.perf_counter() - t_start)
+    return timings
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    print(
+        f"{name:<22} {statistics.mean(timings) * 1e6:>10.1f} "
+        f"{timings[len(timings) // 2] * 1e6:>10.1f} {timings[int(len(timings) * 0.99)] * 1e6:>10.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--model_path", type=str, help="Also time the llama.cpp grammar sampler setup")
+    args = parser.parse_args()
+
+    # Requests serialize their schema themselves, as the server and chat handlers do
+    schemas = [json.dumps(schema) for schema in SCHEMAS]
+
+    def build(i):
+        return LlamaGrammar.from_json_schema(schemas[i % len(schemas)], verbose=False)
+
+    print(f"requests={args.requests} schemas={len(schemas)}")
+    print(f"{'grammar setup':<22} {'mean us':>10} {'p50 us':>10} {'p99 us':>10}")
+    capacity = GRAMMAR_CACHE.capacity
+    GRAMMAR_CACHE.capacity = 0
+    GRAMMAR_CACHE.clear()
+    report("no cache", time_requests(build, args.requests))
+    GRAMMAR_CACHE.capacity = capacity
+    report("cache", time_requests(build, args.requests))
+    print(f"cache stats: {GRAMMAR_CACHE.stats()}")
+
+    if args.model_path:
+        from nexa.gguf.llama import llama_cpp
+        from nexa.gguf.llama.llama import Llama
+
+        llm = Llama(model_path=args.model_path, vocab_only=True, verbose=False)
+        grammars = [build(i) for i in range(len(schemas))]
+
+        def parse(i):
+            grammar = grammars[i % len(grammars)]
+            sampler = llama_cpp.llama_sampler_init_grammar(
+                llm._model.vocab, grammar._grammar.encode("utf-8"), grammar._root.encode("utf-8")
+            )
+            llama_cpp.llama_sampler_free(sampler)
+
+        def clone(i):
+            llama_cpp.llama_sampler_free(llm._model.grammar_sampler(grammars[i % len(grammars)]))
+
+        report("sampler parse", time_requests(parse, args.requests))
+        report("sampler clone", time_requests(clone, args.requests))
+        llm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Per-token detokenization time of a Hugging Face tokenizer at long prompts.
+
+Replays the `detokenize` calls `Llama.create_completion` makes for every
+generated token when the model uses a `LlamaHFTokenizer`: the completion so far
+after the prompt, and the newly generated token after the prompt and the
+completion streamed so far. The previous implementation decoded the whole
+prompt twice per call, the current one decodes a few tokens of context before
+the new ones. The outputs of both are compared call by call.
+
+Requires `transformers`.
+
+Example:
+    python benchmarks/bench_hf_detokenize.py --hf_tokenizer Qwen/Qwen2.5-0.5B-Instruct
+"""
+
+import argparse
+import time
+
+from nexa.gguf.llama.llama_tokenizer import LlamaHFTokenizer
+
+PARAGRAPH = (
+    "Tokenizers split text into pieces: words, sub-words and bytes. "
+    "Déjà vu, naïve café — 東京の天気は晴れです。 Emojis too 🚀🎉, and code: x = f(y) + 1; "
+)
+
+
+def decode_full(tokenizer: LlamaHFTokenizer, tokens, prev_tokens):
+    text = tokenizer.hf_tokenizer.decode(prev_tokens + tokens, skip_special_tokens=True).encode(
+        "utf-8", errors="ignore"
+    )
+    prev_text = tokenizer.hf_tokenizer.decode(prev_tokens, skip_special_tokens=True).encode(
+        "utf-8", errors="ignore"
+    )
+    return text[len(prev_text) :]
+
+
+def replay(detokenize, prompt_tokens, completion_tokens):
+    outputs = []
+    t_start = time.perf_counter()
+    for i in range(1, len(completion_tokens) + 1):
+        outputs.append(detokenize(completion_tokens[:i], prompt_tokens))
+        outputs.append(detokenize(completion_tokens[i - 1 : i], prompt_tokens + completion_tokens[: i - 1]))
+    return outputs, time.perf_counter() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hf_tokenizer", type=str, required=True, help="Hugging Face tokenizer name or path")
+    parser.add_argument("--prompt_tokens", type=int, nargs="+", default=[512, 2048, 8192])
+    parser.add_argument("--completion_tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    tokenizer = LlamaHFTokenizer.from_pretrained(args.hf_tokenizer)
+    tokens = tokenizer.tokenize(
+        (PARAGRAPH * (max(args.prompt_tokens) + args.completion_tokens)).encode("utf-8"), special=False
+    )
+    completion_tokens = tokens[: args.completion_tokens]
+
+    print(f"completion_tokens={len(completion_tokens)}")
+    print(f"{'prompt':>8} {'full ms/token':>14} {'window ms/token':>16} {'identical':>10}")
+    for n_prompt in args.prompt_tokens:
+        prompt_tokens = tokens[args.completion_tokens : args.completion_tokens + n_prompt]
+        expected, t_full = replay(
+            lambda t, p: decode_full(tokenizer, t, p), prompt_tokens, completion_tokens
+        )
+        outputs, t_window = replay(
+            lambda t, p: tokenizer.detokenize(t, prev_tokens=p), prompt_tokens, completion_tokens
+        )
+        same = outputs == expected
+        print(
+            f"{len(prompt_tokens):>8} {t_full / len(completion_tokens) * 1e3:>14.3f} "
+            f"{t_window / len(completion_tokens) * 1e3:>16.3f} {str(same):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""KV cache memory and tokens/s for each KV cache type.
+
+Loads the model once per configuration (f16 without flash attention, then
+f16, q8_0 and q4_0 K and V with flash attention), fills the context with a
+prefill of `--depth` tokens and decodes single tokens at that depth, where
+attention reads the whole cache. Reports the planned KV cache size of the
+full context (`llama_kv_planner`), the measured size of the filled
+sequence's state and both rates.
+
+Example:
+    python benchmarks/bench_kv_types.py --model_path llama3.2-3b-instruct-q4_k_m.gguf --depth 4096
+"""
+
+import argparse
+import time
+
+import nexa.gguf.llama.llama_cpp as llama_cpp
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_kv_planner import LlamaModelDims, kv_cache_type
+
+PROMPT = (
+    "The committee reviewed the quarterly figures, compared them with last year's "
+    "forecast and agreed to revisit the shipping costs before the next meeting. "
+)
+
+CONFIGURATIONS = [
+    ("f16", "f16", False),
+    ("f16", "f16", True),
+    ("q8_0", "q8_0", True),
+    ("q4_0", "q4_0", True),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF model")
+    parser.add_argument("--depth", type=int, default=4096, help="Tokens in the context when decoding")
+    parser.add_argument("--decode_tokens", type=int, default=64, help="Single-token decodes measured")
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    args = parser.parse_args()
+
+    dims = LlamaModelDims.from_file(args.model_path)
+    n_ctx = args.depth + args.decode_tokens + 256
+    mib = 1 << 20
+    print(f"n_ctx={n_ctx} depth={args.depth} layers={dims.n_layer} kv_heads={max(dims.n_head_kv)}")
+    print(
+        f"{'type_k':<6} {'type_v':<6} {'flash':<5} {'KV MiB':>8} {'state MiB':>10} "
+        f"{'prefill tok/s':>14} {'decode tok/s':>13}"
+    )
+    for type_k, type_v, flash_attn in CONFIGURATIONS:
+        llm = Llama(
+            model_path=args.model_path,
+            n_ctx=n_ctx,
+            n_gpu_layers=args.n_gpu_layers,
+            type_k=kv_cache_type(type_k),
+            type_v=kv_cache_type(type_v),
+            flash_attn=flash_attn,
+            verbose=False,
+        )
+        tokens = llm.tokenize(PROMPT.encode("utf-8"))
+        tokens = (tokens * (args.depth // len(tokens) + 1))[: args.depth]
+        llm.eval(tokens[:8])  # warmup
+        llm.reset()
+
+        t_start = time.perf_counter()
+        llm.eval(tokens)
+        prefill = args.depth / (time.perf_counter() - t_start)
+        state = llama_cpp.llama_state_seq_get_size(llm.ctx, 0)
+        t_start = time.perf_counter()
+        for i in range(args.decode_tokens):
+            llm.eval([tokens[i]])
+        decode = args.decode_tokens / (time.perf_counter() - t_start)
+
+        kv = dims.kv_bytes_per_token(type_k, type_v) * n_ctx
+        print(
+            f"{type_k:<6} {type_v:<6} {str(flash_attn):<5} {kv / mib:>8.1f} {state / mib:>10.1f} "
+            f"{prefill:>14.1f} {decode:>13.2f}"
+        )
+        llm.close()
+
+
+if __name__ == "__main__":
+    main()
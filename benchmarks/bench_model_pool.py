@@ -0,0 +1,57 @@
+"""Latency of requests alternating between models of a running server's model pool.
+
+Sends short `/v1/completions` requests to a running `nexa server`, naming
+each of `--models` in turn in the `model` field, and reports the latency of
+the first request of each model (its load) and of the following switches.
+Run it against a server started with `--load_on_request --max_models 2`,
+where the default model takes one of the two and every switch between two
+other models reloads one, and one keeping all of them resident.
+
+Example:
+    nexa server qwen2.5-0.5b-instruct --load_on_request --max_models 3 --port 8000
+    python benchmarks/bench_model_pool.py --models qwen2.5-0.5b-instruct llama3.2 --rounds 10
+"""
+
+import argparse
+import statistics
+import time
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", type=str, default="http://localhost:8000")
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="Models to alternate between")
+    parser.add_argument("--rounds", type=int, default=10, help="Requests per model after the first")
+    parser.add_argument("--max_new_tokens", type=int, default=1, help="Tokens generated per request")
+    args = parser.parse_args()
+
+    session = requests.Session()
+
+    def complete(model):
+        t_start = time.perf_counter()
+        response = session.post(
+            f"{args.url}/v1/completions",
+            json={"model": model, "prompt": "Hello", "max_new_tokens": args.max_new_tokens},
+        )
+        response.raise_for_status()
+        return time.perf_counter() - t_start
+
+    first = {model: complete(model) for model in args.models}
+    switches = {model: [] for model in args.models}
+    for _ in range(args.rounds):
+        for model in args.models:
+            switches[model].append(complete(model))
+
+    print(f"models={len(args.models)} rounds={args.rounds}")
+    print(f"{'model':<32} {'first s':>8} {'switch p50 s':>13} {'switch max s':>13}")
+    for model in args.models:
+        print(
+            f"{model:<32} {first[model]:>8.2f} {statistics.median(switches[model]):>13.3f} "
+            f"{max(switches[model]):>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Replay a request log with the cross-request n-gram cache as draft model.
+
+Each line of the log is a JSON object with a "prompt" and a "completion".
+Without a model the completions are replayed token by token as the target
+would commit them (words stand in for tokens), which measures the acceptance
+rate and the tokens committed per target forward pass of `LlamaNgramCacheDraft`
+against per-request prompt lookup. With `--model_path` the prompts are run
+through `Llama.create_completion` at temperature 0 and tokens/s is reported.
+Without `--log` a synthetic log of templated requests is generated.
+
+Example:
+    python benchmarks/bench_ngram_cache.py --requests 500
+    python benchmarks/bench_ngram_cache.py --log requests.jsonl --model_path model.gguf
+"""
+
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from nexa.gguf.llama.llama_speculative import (
+    LlamaNgramCache,
+    LlamaNgramCacheDraft,
+    LlamaPromptLookupIndex,
+)
+
+TEMPLATES = [
+    '{{"name": "{name}", "city": "{city}", "status": "{status}", "score": {score}}}',
+    "Dear {name}, your order from {city} is {status}. Your reference number is {score}. "
+    "Please contact support if you have any questions.",
+    "def get_{name}(session):\n    return session.query(User).filter(User.city == "
+    '"{city}").filter(User.status == "{status}").limit({score}).all()',
+]
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+CITIES = ["Paris", "Berlin", "Tokyo", "Lima", "Oslo", "Cairo"]
+STATUSES = ["shipped", "pending", "delivered", "cancelled"]
+
+
+def synthetic_log(n_requests: int, seed: int = 0):
+    rng = random.Random(seed)
+    log = []
+    for _ in range(n_requests):
+        template = rng.randrange(len(TEMPLATES))
+        fields = dict(
+            name=rng.choice(NAMES),
+            city=rng.choice(CITIES),
+            status=rng.choice(STATUSES),
+            score=rng.randrange(1000),
+        )
+        log.append({
+            "prompt": f"Task {template}: produce the record for {fields['name']} in {fields['city']}.",
+            "completion": TEMPLATES[template].format(**fields),
+        })
+    return log
+
+
+def read_log(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class WordTokenizer:
+    """Stand-in tokenizer: one id per whitespace separated word."""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def __call__(self, text: str):
+        return [self.vocab.setdefault(word, len(self.vocab)) for word in text.split()]
+
+
+def replay(make_draft, requests):
+    """Commit each completion as the target would, accepting the matching draft prefix."""
+    n_drafted = n_accepted = n_committed = n_steps = 0
+    for prompt, completion in requests:
+        draft_model = make_draft()
+        sequence = np.array(prompt + completion, dtype=np.intc)
+        pos = len(prompt)
+        draft_model.begin(pos)
+        while pos < len(sequence):
+            draft = draft_model(sequence[:pos])
+            truth = sequence[pos : pos + len(draft)]
+            accepted = 0
+            while accepted < len(truth) and draft[accepted] == truth[accepted]:
+                accepted += 1
+            n_drafted += len(draft)
+            n_accepted += accepted
+            # The target emits the accepted tokens plus one of its own
+            step = min(accepted + 1, len(sequence) - pos)
+            n_committed += step
+            n_steps += 1
+            pos += step
+        # Let the draft record the last committed tokens
+        draft_model(sequence)
+    return n_drafted, n_accepted, n_committed / max(n_steps, 1)
+
+
+def run_model(args, log, cache: LlamaNgramCache):
+    from nexa.gguf.llama.llama import Llama
+
+    configs = [
+        ("baseline", lambda: None),
+        ("prompt lookup", lambda: LlamaPromptLookupIndex(num_pred_tokens=args.num_pred_tokens)),
+        ("ngram cache", lambda: LlamaNgramCacheDraft(cache, num_pred_tokens=args.num_pred_tokens)),
+    ]
+    print(f"{'draft model':<15} {'tokens':>7} {'tok/s':>8}")
+    for name, make_draft in configs:
+        llm = Llama(
+            model_path=args.model_path,
+            n_ctx=args.n_ctx,
+            n_gpu_layers=args.n_gpu_layers,
+            draft_model=make_draft(),
+            verbose=False,
+        )
+        n_generated = 0
+        elapsed = 0.0
+        for entry in log:
+            t_start = time.perf_counter()
+            output = llm.create_completion(
+                entry["prompt"], max_tokens=args.max_tokens, temperature=0.0
+            )
+            elapsed += time.perf_counter() - t_start
+            n_generated += output["usage"]["completion_tokens"]
+        print(f"{name:<15} {n_generated:>7} {n_generated / elapsed:>8.1f}")
+        llm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--log", type=str, help="JSONL request log with prompt/completion")
+    parser.add_argument("--requests", type=int, default=500, help="Size of the synthetic log")
+    parser.add_argument("--warmup", type=float, default=0.2, help="Share of the log used to fill the cache first")
+    parser.add_argument("--num_pred_tokens", type=int, default=10)
+    parser.add_argument("--model_path", type=str, help="Also measure tokens/s with this GGUF model")
+    parser.add_argument("--max_tokens", type=int, default=128)
+    parser.add_argument("--n_ctx", type=int, default=2048)
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    args = parser.parse_args()
+
+    log = read_log(args.log) if args.log else synthetic_log(args.requests)
+    n_warmup = int(len(log) * args.warmup)
+    tokenize = WordTokenizer()
+    requests = [(tokenize(e["prompt"]), tokenize(e["completion"])) for e in log]
+
+    cache = LlamaNgramCache()
+    replay(lambda: LlamaNgramCacheDraft(cache, num_pred_tokens=args.num_pred_tokens), requests[:n_warmup])
+    measured = requests[n_warmup:]
+
+    configs = [
+        ("prompt lookup", lambda: LlamaPromptLookupIndex(num_pred_tokens=args.num_pred_tokens)),
+        ("ngram cache", lambda: LlamaNgramCacheDraft(cache, num_pred_tokens=args.num_pred_tokens)),
+    ]
+    print(f"requests={len(measured)} warmup={n_warmup} (word-level replay)")
+    print(f"{'draft model':<15} {'drafted':>8} {'accept':>7} {'tok/step':>9}")
+    for name, make_draft in configs:
+        n_drafted, n_accepted, per_step = replay(make_draft, measured)
+        print(f"{name:<15} {n_drafted:>8} {n_accepted / max(n_drafted, 1):>7.2f} {per_step:>9.2f}")
+    print(f"cache: {len(cache)} n-grams")
+
+    if args.model_path:
+        run_model(args, log[n_warmup:], LlamaNgramCache())
+
+
+if __name__ == "__main__":
+    main()
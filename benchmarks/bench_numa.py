@@ -0,0 +1,114 @@
+"""Prefill and decode tokens/s with and without NUMA pinning, for one process and one per node.
+
+Each configuration runs in fresh processes, since CPU affinity and the memory
+policy are per process:
+
+- unpinned: threads may run on any CPU and the weights are memory-mapped
+- pinned: `Llama(numa_node=...)` on the physical cores of a node, with the
+  weights copied into its memory (`use_mmap=False`)
+
+With one process, the unpinned run gets as many threads as the pinned one.
+On hosts with several nodes, the same comparison runs with one concurrent
+process per node (the layout of `nexa server --numa_workers`), and the
+aggregate throughput is reported.
+
+Example:
+    python benchmarks/bench_numa.py --model_path llama3.2-3b-instruct-q4_k_m.gguf
+"""
+
+import argparse
+import multiprocessing
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_numa import numa_node_cpus, numa_nodes
+
+PROMPT = (
+    "The committee reviewed the quarterly figures, compared them with last year's "
+    "forecast and agreed to revisit the shipping costs before the next meeting. "
+)
+
+
+def worker(model_path, numa_node, n_threads, args, barrier, results):
+    llm = Llama(
+        model_path=model_path,
+        n_ctx=args.prompt_tokens + args.decode_tokens + 16,
+        n_threads=n_threads,
+        n_threads_batch=n_threads,
+        numa_node=numa_node,
+        use_mmap=numa_node is None,
+        verbose=False,
+    )
+    tokens = llm.tokenize(PROMPT.encode("utf-8"))
+    tokens = (tokens * (args.prompt_tokens // len(tokens) + 1))[: args.prompt_tokens]
+    llm.eval(tokens[:8])  # warmup
+    llm.reset()
+
+    # Start together so concurrent workers compete for the interconnect
+    barrier.wait()
+    t_start = time.perf_counter()
+    llm.eval(tokens)
+    prefill = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    for i in range(args.decode_tokens):
+        llm.eval([tokens[i % len(tokens)]])
+    decode = time.perf_counter() - t_start
+    results.put((len(tokens) / prefill, args.decode_tokens / decode))
+    llm.close()
+
+
+def run(model_path, placements, args):
+    """Run one worker per (numa_node, n_threads) placement and sum their rates."""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(len(placements))
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(model_path, node, n_threads, args, barrier, results))
+        for node, n_threads in placements
+    ]
+    for process in processes:
+        process.start()
+    rates = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return sum(r[0] for r in rates), sum(r[1] for r in rates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF model")
+    parser.add_argument("--prompt_tokens", type=int, default=512, help="Tokens of the prefill")
+    parser.add_argument("--decode_tokens", type=int, default=64, help="Single-token decodes measured")
+    parser.add_argument("--node", type=int, default=0, help="NUMA node of the single-process runs")
+    args = parser.parse_args()
+
+    nodes = numa_nodes()
+    cores = {node: len(numa_node_cpus(node)) for node in nodes}
+    print(f"nodes={len(nodes)} physical cores per node={cores}")
+    configurations = [
+        ("x1", [(None, cores[args.node])], [(args.node, cores[args.node])]),
+    ]
+    if len(nodes) > 1:
+        configurations.append(
+            (
+                f"x{len(nodes)}",
+                [(None, cores[node]) for node in nodes],
+                [(node, cores[node]) for node in nodes],
+            )
+        )
+
+    print(f"{'processes':<10} {'placement':<10} {'prefill tok/s':>14} {'decode tok/s':>13}")
+    for name, unpinned, pinned in configurations:
+        rates = {}
+        for placement, placements in (("unpinned", unpinned), ("pinned", pinned)):
+            rates[placement] = run(args.model_path, placements, args)
+            prefill, decode = rates[placement]
+            print(f"{name:<10} {placement:<10} {prefill:>14.1f} {decode:>13.2f}")
+        print(
+            f"{name:<10} {'gain':<10} {rates['pinned'][0] / rates['unpinned'][0]:>13.2f}x "
+            f"{rates['pinned'][1] / rates['unpinned'][1]:>12.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
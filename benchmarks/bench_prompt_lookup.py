@@ -0,0 +1,88 @@
+"""Per-step cost of prompt lookup drafting at long context.
+
+Replays a synthetic decode over a long, repetitive context (like a RAG prompt
+quoting its sources) and times each draft call of the rescanning
+`LlamaPromptLookupDecoding` against the incremental `LlamaPromptLookupIndex`.
+No model is needed, only the draft side is measured.
+
+Example:
+    python benchmarks/bench_prompt_lookup.py --context 16384 --steps 256
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from nexa.gguf.llama.llama_speculative import (
+    LlamaPromptLookupDecoding,
+    LlamaPromptLookupIndex,
+)
+
+
+def make_sequence(n_tokens: int, n_vocab: int, rng: np.random.Generator) -> np.ndarray:
+    """Random tokens where roughly half of the text re-quotes earlier spans."""
+    tokens = list(rng.integers(0, n_vocab, size=64))
+    while len(tokens) < n_tokens:
+        if rng.random() < 0.5:
+            start = int(rng.integers(0, len(tokens) - 32))
+            tokens.extend(tokens[start : start + int(rng.integers(8, 32))])
+        else:
+            tokens.extend(rng.integers(0, n_vocab, size=int(rng.integers(4, 16))).tolist())
+    return np.array(tokens[:n_tokens], dtype=np.intc)
+
+
+def replay(draft_model, sequence: np.ndarray, n_prompt: int, n_steps: int):
+    """Feed the draft model as Llama.generate would, accepting the matching draft prefix."""
+    timings = []
+    n_drafted = n_accepted = 0
+    pos = n_prompt
+    for _ in range(n_steps):
+        if pos >= len(sequence):
+            break
+        t_start = time.perf_counter()
+        draft = draft_model(sequence[:pos])
+        timings.append(time.perf_counter() - t_start)
+        truth = sequence[pos : pos + len(draft)]
+        accepted = 0
+        while accepted < len(truth) and draft[accepted] == truth[accepted]:
+            accepted += 1
+        n_drafted += len(draft)
+        n_accepted += accepted
+        # The target emits the accepted tokens plus one of its own
+        pos += accepted + 1
+    return timings, n_drafted, n_accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--context", type=int, default=16384, help="Prompt length in tokens")
+    parser.add_argument("--steps", type=int, default=256, help="Decode steps to replay")
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--max_ngram_size", type=int, default=3)
+    parser.add_argument("--num_pred_tokens", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sequence = make_sequence(args.context + args.steps * (args.num_pred_tokens + 1), args.vocab, rng)
+
+    candidates = [
+        ("rescan", LlamaPromptLookupDecoding(args.max_ngram_size, args.num_pred_tokens)),
+        ("index/recent", LlamaPromptLookupIndex(args.max_ngram_size, args.num_pred_tokens, "recent")),
+        ("index/frequent", LlamaPromptLookupIndex(args.max_ngram_size, args.num_pred_tokens, "frequent")),
+    ]
+    print(f"context={args.context} steps={args.steps}")
+    print(f"{'draft model':<15} {'first ms':>9} {'median ms':>10} {'p99 ms':>8} {'accept':>7}")
+    for name, draft_model in candidates:
+        timings, n_drafted, n_accepted = replay(draft_model, sequence, args.context, args.steps)
+        # The first call of the index builds it over the whole prompt
+        steady = sorted(timings[1:])
+        print(
+            f"{name:<15} {timings[0] * 1000:>9.2f} {statistics.median(steady) * 1000:>10.3f} "
+            f"{steady[int(len(steady) * 0.99)] * 1000:>8.3f} {n_accepted / max(n_drafted, 1):>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Restore time of a spilled chat session vs. re-prefilling it, across context lengths.
+
+For every context length the prompt is prefilled once, its sequence state is
+exported and written to a `LlamaSessionStore`, and then the same state is
+loaded back (read + decompress + `llama_state_seq_set_data`).
+
+Example:
+    python benchmarks/bench_session_restore.py path/to/model.gguf --lengths 512 2048 8192
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_session import LlamaSessionStore, WORKING_SEQ_ID
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_path", type=str, help="Path to a GGUF model file")
+    parser.add_argument("--lengths", type=int, nargs="*", default=[256, 1024, 4096])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=LlamaSessionStore.COMPRESSIONS,
+        default=None,
+        help="Defaults to zstd, then lz4, then zlib, whichever is installed",
+    )
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    args = parser.parse_args()
+
+    llm = Llama(
+        model_path=args.model_path,
+        n_ctx=max(args.lengths),
+        n_gpu_layers=args.n_gpu_layers,
+        verbose=False,
+    )
+    text = "The quick brown fox jumps over the lazy dog. " * 4096
+    all_tokens = llm.tokenize(text.encode("utf-8"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = LlamaSessionStore(directory, compression=args.compression)
+        print(f"compression: {store.compression}")
+        header = f"{'tokens':>7} {'prefill ms':>11} {'spill ms':>9} {'restore ms':>11} {'state MB':>9} {'file MB':>8}"
+        print(header)
+        print("-" * len(header))
+        for n_tokens in args.lengths:
+            tokens = all_tokens[:n_tokens]
+            prefill, spill, restore = [], [], []
+            for _ in range(args.runs):
+                llm.reset()
+                llm._ctx.kv_cache_clear()
+                t_start = time.perf_counter()
+                llm.eval(tokens)
+                prefill.append(time.perf_counter() - t_start)
+
+                t_start = time.perf_counter()
+                state = llm._ctx.get_seq_state_data(WORKING_SEQ_ID)
+                store.save("bench", llm.input_ids[: llm.n_tokens], state)
+                spill.append(time.perf_counter() - t_start)
+
+                llm._ctx.kv_cache_clear()
+                t_start = time.perf_counter()
+                _, loaded = store.load("bench")
+                if not llm._ctx.set_seq_state_data(loaded, WORKING_SEQ_ID):
+                    raise RuntimeError("Failed to restore the sequence state")
+                restore.append(time.perf_counter() - t_start)
+
+            file_size = store.cache_size
+            print(
+                f"{n_tokens:>7} {statistics.median(prefill) * 1000:>11.1f} "
+                f"{statistics.median(spill) * 1000:>9.1f} {statistics.median(restore) * 1000:>11.1f} "
+                f"{len(state) / 2**20:>9.1f} {file_size / 2**20:>8.1f}"
+            )
+            store.discard("bench")
+
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
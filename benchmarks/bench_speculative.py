@@ -0,0 +1,81 @@
+"""Speculative decoding with a GGUF draft model: acceptance rate and tokens/s.
+
+Compares plain decoding of the target model with `LlamaGGUFDraftModel` in
+greedy and rejection-sampling acceptance modes on the same prompts.
+
+Example:
+    python benchmarks/bench_speculative.py target.gguf draft.gguf --max_tokens 256
+"""
+
+import argparse
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_speculative import LlamaGGUFDraftModel
+
+DEFAULT_PROMPTS = [
+    "Write a Python function that parses a CSV file and returns a list of dicts.",
+    "Explain the difference between a process and a thread.",
+    "List the planets of the solar system with one fact about each.",
+]
+
+
+def run(llm: Llama, prompts, max_tokens: int, temperature: float):
+    n_generated = 0
+    elapsed = 0.0
+    for prompt in prompts:
+        t_start = time.perf_counter()
+        output = llm.create_completion(
+            prompt, max_tokens=max_tokens, temperature=temperature, seed=0
+        )
+        elapsed += time.perf_counter() - t_start
+        n_generated += output["usage"]["completion_tokens"]
+    return n_generated, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_path", type=str, help="Target GGUF model")
+    parser.add_argument("draft_model_path", type=str, help="Draft GGUF model sharing the vocabulary")
+    parser.add_argument("--prompts", nargs="*", default=DEFAULT_PROMPTS)
+    parser.add_argument("--max_tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--draft_max_tokens", type=int, default=16)
+    parser.add_argument("--n_ctx", type=int, default=2048)
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'tokens':>7} {'tok/s':>8} {'accept':>7} {'drafted':>8}")
+    configs = [("baseline", None), ("greedy", "greedy"), ("rejection", "rejection")]
+    for name, acceptance in configs:
+        draft = None
+        if acceptance is not None:
+            draft = LlamaGGUFDraftModel(
+                args.draft_model_path,
+                max_pred_tokens=args.draft_max_tokens,
+                acceptance=acceptance,
+                temp=max(args.temperature, 0.1),
+                seed=0,
+                n_ctx=args.n_ctx,
+                n_gpu_layers=args.n_gpu_layers,
+            )
+        llm = Llama(
+            model_path=args.model_path,
+            n_ctx=args.n_ctx,
+            n_gpu_layers=args.n_gpu_layers,
+            draft_model=draft,
+            verbose=False,
+        )
+        n_generated, elapsed = run(llm, args.prompts, args.max_tokens, args.temperature)
+        if draft is not None:
+            accept = f"{draft.n_accepted_total / max(draft.n_drafted_total, 1):>7.2f}"
+            drafted = f"{draft.n_drafted_total:>8}"
+            draft.close()
+        else:
+            accept, drafted = f"{'-':>7}", f"{'-':>8}"
+        print(f"{name:<10} {n_generated:>7} {n_generated / elapsed:>8.1f} {accept} {drafted}")
+        llm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Per-phase timings of chat completions and the cost of recording them.
+
+Runs the same greedy chat completions without and with a
+`LlamaTimingCollector`, alternating the two so that thermal and cache effects
+hit both alike, and reports the decode throughput of each and the collected
+phase breakdown. Without a collector no timer runs at all, so the difference
+in throughput is the cost of the instrumentation.
+
+Example:
+    python benchmarks/bench_timings.py --model_path qwen2.5-1.5b-instruct-q4_k_m.gguf
+"""
+
+import argparse
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_timings import LlamaTimingCollector
+
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Write a short story about a lighthouse keeper who finds a message in a bottle."},
+]
+
+
+def run(llm: Llama, max_tokens: int):
+    t_start = time.perf_counter()
+    completion = llm.create_chat_completion(
+        messages=MESSAGES, max_tokens=max_tokens, temperature=0.0, seed=0
+    )
+    return completion["usage"]["completion_tokens"], time.perf_counter() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF model")
+    parser.add_argument("--requests", type=int, default=10, help="Requests per configuration")
+    parser.add_argument("--max_tokens", type=int, default=256, help="Tokens generated per request")
+    parser.add_argument("--n_ctx", type=int, default=2048, help="Context window")
+    args = parser.parse_args()
+
+    llm = Llama(model_path=args.model_path, n_ctx=args.n_ctx, verbose=False)
+    collector = LlamaTimingCollector()
+    run(llm, 8)  # warmup
+
+    totals = {"off": [0, 0.0], "on": [0, 0.0]}
+    for _ in range(args.requests):
+        for name in ("off", "on"):
+            llm.timing_collector = collector if name == "on" else None
+            llm.reset()
+            n_tokens, seconds = run(llm, args.max_tokens)
+            totals[name][0] += n_tokens
+            totals[name][1] += seconds
+    llm.timing_collector = None
+
+    rate = {name: n_tokens / seconds for name, (n_tokens, seconds) in totals.items()}
+    print(f"requests={args.requests} max_tokens={args.max_tokens}")
+    print(f"{'timings':<10} {'tok/s':>8}")
+    for name in ("off", "on"):
+        print(f"{name:<10} {rate[name]:>8.2f}")
+    print(f"overhead: {(rate['off'] / rate['on'] - 1) * 100:.2f}%")
+    print()
+    print(f"{'phase':<12} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for phase, stats in collector.summary().items():
+        print(
+            f"{phase:<12} {stats['mean'] * 1e3:>10.3f} "
+            f"{stats['p50'] * 1e3:>10.3f} {stats['p99'] * 1e3:>10.3f}"
+        )
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
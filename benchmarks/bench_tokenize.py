@@ -0,0 +1,73 @@
+"""Tokenization time across input sizes with text-sized buffers and the token cache.
+
+Times `LlamaModel.tokenize` on texts from a few bytes to a few hundred KB:
+the previous implementation, which allocated a ctypes token buffer of the
+model's training context length on every call and copied it into a list, the
+current list and intc array paths with the token cache disabled, and repeated
+calls served from the token cache.
+
+Example:
+    python benchmarks/bench_tokenize.py --model_path qwen2.5-1.5b-instruct-q4_k_m.gguf
+"""
+
+import argparse
+import statistics
+import time
+
+from nexa.gguf.llama import llama_cpp
+from nexa.gguf.llama.llama import Llama
+
+SIZES = [16, 256, 4096, 65536, 262144]
+SENTENCE = b"The quick brown fox jumps over the lazy dog, then naps in the sun. "
+
+
+def tokenize_ctx_buffer(model, text: bytes, add_bos: bool, special: bool):
+    n_ctx = model.n_ctx_train()
+    tokens = (llama_cpp.llama_token * n_ctx)()
+    n_tokens = llama_cpp.llama_tokenize(model.vocab, text, len(text), tokens, n_ctx, add_bos, special)
+    if n_tokens < 0:
+        n_tokens = abs(n_tokens)
+        tokens = (llama_cpp.llama_token * n_tokens)()
+        n_tokens = llama_cpp.llama_tokenize(model.vocab, text, len(text), tokens, n_tokens, add_bos, special)
+    return list(tokens[:n_tokens])
+
+
+def time_calls(fn, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t_start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True, help="GGUF model, only its vocabulary is loaded")
+    parser.add_argument("--repeat", type=int, default=50, help="Calls per size, the median is reported")
+    args = parser.parse_args()
+
+    llm = Llama(model_path=args.model_path, vocab_only=True, verbose=False)
+    model = llm._model
+    print(f"n_ctx_train={model.n_ctx_train()}")
+    print(f"{'bytes':>8} {'tokens':>8} {'ctx buffer us':>14} {'list us':>10} {'array us':>10} {'cached us':>10}")
+    for size in SIZES:
+        text = (SENTENCE * (size // len(SENTENCE) + 1))[:size]
+        n_tokens = len(tokenize_ctx_buffer(model, text, True, False))
+        model.token_cache_size = 0
+        row = [
+            time_calls(lambda: tokenize_ctx_buffer(model, text, True, False), args.repeat),
+            time_calls(lambda: model.tokenize(text, True, False), args.repeat),
+            time_calls(lambda: model.tokenize_array(text, True, False), args.repeat),
+        ]
+        model.token_cache_size = 256
+        if size <= model.TOKEN_CACHE_MAX_BYTES:
+            row.append(time_calls(lambda: model.tokenize_array(text, True, False), args.repeat))
+        else:
+            row.append(float("nan"))
+        print(f"{size:>8} {n_tokens:>8} " + " ".join(f"{t * 1e6:>{w}.1f}" for t, w in zip(row, (14, 10, 10, 10))))
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
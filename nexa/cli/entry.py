@@ -334,6 +334,8 @@ def run_embedding_generation(args):
     ms = kwargs.pop('modelscope', False)
     normalize = kwargs.pop('normalize', False)
     no_truncate = kwargs.pop('no_truncate', False)
+    encoding_format = kwargs.pop('encoding_format', "float")
+    dimensions = kwargs.pop('dimensions', None)
 
     local_path = None
     if is_local_path or hf or ms:
@@ -353,7 +355,8 @@ def run_embedding_generation(args):
         inference = NexaTextInference(
             model_path=model_path, local_path=local_path, embedding=True)
         embedding = inference.create_embedding(
-            prompt, normalize=normalize, truncate=not no_truncate)
+            prompt, normalize=normalize, truncate=not no_truncate,
+            encoding_format=encoding_format, dimensions=dimensions)
         print({"embedding": embedding})
     except Exception as e:
         print(f"Error generating embedding: {e}")
@@ -541,6 +544,28 @@ def main():
                             help="Path to a LoRA file to apply to the model.")
     text_group.add_argument("--nctx", type=int, default=2048,
                             help="Maximum context length of the model you're using")
+    text_group.add_argument("--prefetch", type=str, choices=["none", "willneed", "readahead", "mlock"],
+                            help="Page-cache warm-up policy for the model weights at load time")
+    text_group.add_argument("--context_shift", action="store_true",
+                            help="Discard the oldest tokens when the context is full instead of dropping the chat history")
+    text_group.add_argument("--autotune", action="store_true",
+                            help="Probe and use the fastest thread counts and batch size at load, cached per host and model")
+    text_group.add_argument("--numa_node", type=int,
+                            help="Pin inference threads to the physical cores of this NUMA node and bind memory to it")
+    text_group.add_argument("--type_k", type=str, choices=["f16", "q8_0", "q4_0"],
+                            help="KV cache type of K")
+    text_group.add_argument("--type_v", type=str, choices=["f16", "q8_0", "q4_0"],
+                            help="KV cache type of V, quantized types require --flash_attn")
+    text_group.add_argument("--flash_attn", action="store_true",
+                            help="Use flash attention")
+    text_group.add_argument("--memory_budget_gb", type=float,
+                            help="Plan nctx and the KV cache types to fit the weights and KV cache in this many GB (0: available memory)")
+    text_group.add_argument("--draft_model_path", type=str,
+                            help="Local path to a smaller GGUF model with the same vocabulary, used for speculative decoding")
+    text_group.add_argument("--draft_max_tokens", type=int,
+                            help="Maximum number of tokens drafted per step, the draft length adapts to the acceptance rate")
+    text_group.add_argument("--draft_acceptance", type=str, choices=["greedy", "rejection"],
+                            help="How drafted tokens are verified by the target model")
 
     # Image generation arguments
     image_group = run_parser.add_argument_group('Image generation options')
@@ -668,6 +693,11 @@ def main():
         "-n", "--normalize", action="store_true", help="Normalize the embeddings")
     embed_parser.add_argument(
         "-nt", "--no_truncate", action="store_true", help="Not truncate the embeddings")
+    embed_parser.add_argument(
+        "-ef", "--encoding_format", type=str, choices=["float", "base64", "float16", "int8", "binary"], default="float",
+        help="Output encoding: floats, base64 of float32 / float16, int8 with a scale, or sign bits")
+    embed_parser.add_argument(
+        "-d", "--dimensions", type=int, help="Keep only the first dimensions of the embedding (Matryoshka models), before normalizing")
 
     # Convert command
     convert_parser = subparsers.add_parser(
@@ -744,6 +774,52 @@ def main():
         "--reload", action="store_true", help="Enable automatic reloading on code changes")
     server_parser.add_argument("--nctx", type=int, default=2048,
                                help="Maximum context length of the model you're using")
+    server_parser.add_argument("--prefetch", type=str, choices=["none", "willneed", "readahead", "mlock"],
+                               help="Page-cache warm-up policy for the model weights at load time")
+    server_parser.add_argument("--context_shift", action="store_true",
+                               help="Discard the oldest tokens after the system prompt when the context is full instead of failing")
+    server_parser.add_argument("--autotune", action="store_true",
+                               help="Probe and use the fastest thread counts and batch size at load, cached per host and model")
+    server_parser.add_argument("--numa_node", type=int,
+                               help="Pin inference threads to the physical cores of this NUMA node and bind memory to it")
+    server_parser.add_argument("--numa_workers", action="store_true",
+                               help="Run one server worker per NUMA node on the same port, each pinned to its node with a local copy of the model")
+    server_parser.add_argument("--type_k", type=str, choices=["f16", "q8_0", "q4_0"],
+                               help="KV cache type of K")
+    server_parser.add_argument("--type_v", type=str, choices=["f16", "q8_0", "q4_0"],
+                               help="KV cache type of V, quantized types require --flash_attn")
+    server_parser.add_argument("--flash_attn", action="store_true",
+                               help="Use flash attention")
+    server_parser.add_argument("--memory_budget_gb", type=float,
+                               help="Plan the context, KV cache types and sessions to fit the weights and KV cache in this many GB (0: available memory)")
+    server_parser.add_argument("--sessions", type=int, default=4,
+                               help="Number of chat sessions (session_id) whose KV state is kept resident, 0 to disable")
+    server_parser.add_argument("--max_samples", type=int, default=4,
+                               help="Maximum n / best_of of a request, the samples share the prompt and are decoded in one batch")
+    server_parser.add_argument("--session_dir", type=str,
+                               help="Directory where evicted chat sessions are spilled and restored from, also across restarts")
+    server_parser.add_argument("--session_dir_gb", type=float, default=2,
+                               help="Maximum size of --session_dir in GB")
+    server_parser.add_argument("--draft_model_path", type=str,
+                               help="Local path to a smaller GGUF model with the same vocabulary, used for speculative decoding")
+    server_parser.add_argument("--draft_max_tokens", type=int, default=16,
+                               help="Maximum number of tokens drafted per step, the draft length adapts to the acceptance rate")
+    server_parser.add_argument("--draft_acceptance", type=str, choices=["greedy", "rejection"], default="greedy",
+                               help="How drafted tokens are verified by the target model")
+    server_parser.add_argument("--ngram_cache", action="store_true",
+                               help="Draft tokens from n-gram statistics of previous requests (ignored with --draft_model_path)")
+    server_parser.add_argument("--ngram_cache_dir", type=str,
+                               help="Directory where the n-gram cache is persisted across restarts, implies --ngram_cache")
+    server_parser.add_argument("--embedding_wait_ms", type=float, default=5,
+                               help="How long an embedding request waits for concurrent ones to share its batch")
+    server_parser.add_argument("--jump_forward", action="store_true",
+                               help="Insert the text forced by the function schema without sampling it token by token, used with --function_calling")
+    server_parser.add_argument("--pool_budget_gb", type=float,
+                               help="Keep several models resident within this many GB, least recently used idle models are unloaded first (0: available memory)")
+    server_parser.add_argument("--max_models", type=int,
+                               help="Maximum number of resident models, 0 for no limit (default 1, no limit with --pool_budget_gb)")
+    server_parser.add_argument("--load_on_request", action="store_true",
+                               help="Load the hub and local models named in the model field of requests, pulling them if needed")
     server_parser.add_argument(
         "-fc",
         "--function_calling",
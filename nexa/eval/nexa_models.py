@@ -1,5 +1,6 @@
 from typing import Optional
 from nexa.eval import utils
+import itertools
 import logging
 import time
 from nexa.gguf.nexa_inference_text import NexaTextInference
@@ -12,22 +13,27 @@ class GGUFLM:
     def __init__(self, model_path=None, local_path=None, **kwargs):
         if model_path is None and local_path is None:
             raise ValueError("model_path or local_path must be provided.")
-        self.model = NexaTextInference(model_path, local_path, logits_all=True)
+        # Largest number of repeats of a request sampled together, sharing the prompt KV cache
+        self.max_samples = kwargs.get("max_samples", 4)
+        self.model = NexaTextInference(model_path, local_path, logits_all=True, max_samples=self.max_samples)
         self.logprobs = 10
         self.temperature = 0
 
     def gguf_completion(
-        self, context, max_tokens = None, continuation = None, stop=None, benchmark_disable_logprobs=False
+        self, context, max_tokens = None, continuation = None, stop=None, benchmark_disable_logprobs=False,
+        temperature=None, n=1
     ):
         try:
             prompt = context
             params = {
                 "prompt": prompt,
                 "logprobs": self.logprobs if not benchmark_disable_logprobs else None,
-                "temperature": self.temperature,
+                "temperature": self.temperature if temperature is None else temperature,
                 "max_tokens": max_tokens,
                 "eval_context_length": len(context)
             }
+            if n > 1:
+                params["n"] = n
             if continuation:
                 prompt += continuation
                 params.update({"prompt": prompt, "max_tokens": 1, "echo": True})
@@ -76,27 +82,50 @@ class GGUFLM:
             return []
 
         res = []
-        for request in tqdm([req.args for req in requests], disable=disable_tqdm):
+        pbar = tqdm(total=len(requests), disable=disable_tqdm)
+        # The repeats of an instance are adjacent, they are generated together
+        for request, group in itertools.groupby(req.args for req in requests):
+            n_repeats = len(list(group))
             inp = request[0]
             request_args = request[1]
             until = request_args.get("until", ["</s>"])
             max_tokens = request_args.get("max_gen_toks", None)
-            response = self.gguf_completion(context=inp, stop=until, max_tokens=max_tokens, benchmark_disable_logprobs=True)
-            if response and "choices" in response and response["choices"]:
-                choice = response["choices"][0]
-                if "text" in choice:
-                    generated_text = choice["text"].strip()
-                    res.append(generated_text)
-                else:
-                    logger.error(
-                        f"Invalid response for greedy_until. Response: {response}"
-                    )
-                    res.append(None)  # Add default value in case of error
+            temperature = self.temperature
+            if request_args.get("do_sample", False):
+                temperature = request_args.get("temperature", 1.0)
+            if temperature == 0:
+                # Greedy decoding gives every repeat the same text
+                response = self.gguf_completion(context=inp, stop=until, max_tokens=max_tokens, benchmark_disable_logprobs=True)
+                res.extend(self._completion_texts(response, 1) * n_repeats)
             else:
-                logger.error(f"Invalid response for greedy_until. Response: {response}")
-                res.append(None)  # Add default value in case of error
+                # One completion of n samples prefills the prompt once for all of them
+                for start in range(0, n_repeats, self.max_samples):
+                    n = min(self.max_samples, n_repeats - start)
+                    response = self.gguf_completion(
+                        context=inp, stop=until, max_tokens=max_tokens, benchmark_disable_logprobs=True,
+                        temperature=temperature, n=n)
+                    res.extend(self._completion_texts(response, n))
+            pbar.update(n_repeats)
+        pbar.close()
         return res
 
+    def _completion_texts(self, response, n):
+        """Stripped text of the `n` choices of a completion, None for each one missing."""
+        choices = response.get("choices") if response else None
+        if not choices:
+            logger.error(f"Invalid response for greedy_until. Response: {response}")
+            return [None] * n  # Add default value in case of error
+        texts = []
+        for choice in choices[:n]:
+            if "text" in choice:
+                texts.append(choice["text"].strip())
+            else:
+                logger.error(
+                    f"Invalid response for greedy_until. Response: {response}"
+                )
+                texts.append(None)  # Add default value in case of error
+        return texts + [None] * (n - len(texts))
+
 
     def get_result(self, logprobs, context_length=None):
         is_greedy = True
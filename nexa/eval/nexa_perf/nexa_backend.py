@@ -10,6 +10,7 @@ from psutil import cpu_count
 from nexa.eval.nexa_perf.utils.import_utils import nexa_sdk_version
 from nexa.eval.nexa_perf.utils.system_utils import get_gpu_device_ids, is_nvidia_system, is_rocm_system
 from nexa.gguf import NexaTextInference
+from nexa.gguf.llama.llama import LogitsProcessorList, MinTokensLogitsProcessor
 
 LOGGER = getLogger("backend")
 
@@ -123,10 +124,12 @@ class NexaBackend:
         Load the model from the given model path (normally GGUF, GGML)
         """
         # TODO: add mps (apple metal) support, currently cant benchmark mps device accurately for energy
+        # Room for num_beams KV sequences, unused sequences cost nothing
+        model_kwargs = {"max_samples": 8, **self.config.model_kwargs}
         if self.config.device == "cuda" or self.config.device == "mps":
-            nexa_model = NexaTextInference(model_path=self.config.model, device="gpu", **self.config.model_kwargs)
+            nexa_model = NexaTextInference(model_path=self.config.model, device="gpu", **model_kwargs)
         elif self.config.device == "cpu":
-            nexa_model = NexaTextInference(model_path=self.config.model, device="cpu", **self.config.model_kwargs)
+            nexa_model = NexaTextInference(model_path=self.config.model, device="cpu", **model_kwargs)
         else:
             raise ValueError(f"Invalid device: {self.config.device}")
         
@@ -136,6 +139,18 @@ class NexaBackend:
         next(self.pretrained_model.generate(**inputs))
 
     def generate(self, inputs: Dict[str, Any], kwargs: Dict[str, Any]) -> list[int]:
+        if kwargs.get("num_beams", 1) > 1:
+            # All beams are decoded in one batch per step
+            min_tokens = MinTokensLogitsProcessor(
+                kwargs.get("min_new_tokens", 0), self.pretrained_model.token_eos()
+            )
+            hypotheses = self.pretrained_model.beam_search(
+                inputs["tokens"],
+                num_beams=kwargs["num_beams"],
+                max_tokens=kwargs["max_new_tokens"],
+                logits_processor=LogitsProcessorList([min_tokens]),
+            )
+            return hypotheses[0][0]
         generator = self.pretrained_model.generate(**inputs)
         for _ in range(kwargs["max_new_tokens"]):
             next(generator)
@@ -1,2 +1,3 @@
 from nexa.gguf.llama.llama_cpp import *
 from nexa.gguf.llama.llama import *
+from nexa.gguf.llama.llama_async import AsyncLlama
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
 import os
+import time
+import base64
 import ctypes
+import threading
+from collections import OrderedDict
 
 from typing import (
+    Any,
     Dict,
     List,
     Tuple,
@@ -36,21 +41,53 @@ class LlamaModel:
         path_model: str,
         params: llama_cpp.llama_model_params,
         verbose: bool = True,
+        token_cache_size: int = 256,
     ):
         self.path_model = path_model
         self.params = params
         self.verbose = verbose
         self._exit_stack = ExitStack()
 
+        # Tokens of recently tokenized short texts (system prompts, stop words,
+        # few-shot headers), see `tokenize_array`
+        self.token_cache_size = token_cache_size
+        self._token_cache: "OrderedDict[Tuple[bytes, bool, bool], npt.NDArray[np.intc]]" = OrderedDict()
+        self._token_cache_lock = threading.Lock()
+
         model = None
 
         if not os.path.exists(path_model):
             raise ValueError(f"Model path does not exist: {path_model}")
 
+        # Load-time breakdown in seconds, see `_install_progress_timer`
+        self.load_timings: Dict[str, float] = {}
+
+        t_start = time.perf_counter()
+        with open(path_model, "rb") as f:
+            f.read(4)  # GGUF magic, faults in the header page
+        self.load_timings["open"] = time.perf_counter() - t_start
+
+        progress_marks = self._install_progress_timer()
+
+        t_load = time.perf_counter()
         with suppress_stdout_stderr(disable=verbose):
             model = llama_cpp.llama_load_model_from_file(
                 self.path_model.encode("utf-8"), self.params
             )
+        t_end = time.perf_counter()
+
+        if progress_marks is not None:
+            # Don't leave a pointer to the Python callback behind in the params
+            self.params.progress_callback = llama_cpp.llama_progress_callback()
+
+        if progress_marks:
+            t_first = progress_marks.get("first", t_end)
+            t_done = progress_marks.get("done", t_end)
+            self.load_timings["metadata"] = t_first - t_load
+            self.load_timings["tensor_mapping"] = t_done - t_first
+            self.load_timings["finalize"] = t_end - t_done
+        else:
+            self.load_timings["model"] = t_end - t_load
 
         if model is None:
             raise ValueError(f"Failed to load model from file: {path_model}")
@@ -71,6 +108,56 @@ class LlamaModel:
 
         self._exit_stack.callback(free_model)
 
+        # Parsed grammar samplers, cloned for every sampler chain that uses the grammar
+        self._grammar_samplers: "OrderedDict[Tuple[str, str], llama_cpp.llama_sampler_p]" = OrderedDict()
+        self._grammar_lock = threading.Lock()
+
+        def free_grammar_samplers():
+            for sampler in self._grammar_samplers.values():
+                llama_cpp.llama_sampler_free(sampler)
+            self._grammar_samplers.clear()
+
+        self._exit_stack.callback(free_grammar_samplers)
+
+    def grammar_sampler(self, grammar: LlamaGrammar, capacity: int = 64) -> llama_cpp.llama_sampler_p:
+        """A new grammar sampler, cloned from a parsed copy kept for the last `capacity` grammars."""
+        key = (grammar._grammar, grammar._root)
+        with self._grammar_lock:
+            parsed = self._grammar_samplers.get(key)
+            if parsed is None:
+                parsed = llama_cpp.llama_sampler_init_grammar(
+                    self.vocab, grammar._grammar.encode("utf-8"), grammar._root.encode("utf-8")
+                )
+                if not parsed:
+                    raise ValueError("Failed to parse grammar")
+                self._grammar_samplers[key] = parsed
+                while len(self._grammar_samplers) > capacity:
+                    _, evicted = self._grammar_samplers.popitem(last=False)
+                    llama_cpp.llama_sampler_free(evicted)
+            else:
+                self._grammar_samplers.move_to_end(key)
+            return llama_cpp.llama_sampler_clone(parsed)
+
+    def _install_progress_timer(self) -> Optional[Dict[str, float]]:
+        # llama.cpp reports progress once the metadata has been parsed and the
+        # tensors are being mapped, and 1.0 when all tensors are in place.
+        # Only hook in if the caller did not provide a callback of their own.
+        if self.params.progress_callback:
+            return None
+
+        marks: Dict[str, float] = {}
+
+        def progress_callback(progress: float, user_data: ctypes.c_void_p) -> bool:
+            now = time.perf_counter()
+            marks.setdefault("first", now)
+            if progress >= 1.0:
+                marks.setdefault("done", now)
+            return True
+
+        self._progress_callback = llama_cpp.llama_progress_callback(progress_callback)
+        self.params.progress_callback = self._progress_callback
+        return marks
+
     def close(self):
         self._exit_stack.close()
 
@@ -154,28 +241,58 @@ class LlamaModel:
 
     # Tokenization
 
-    def tokenize(self, text: bytes, add_bos: bool, special: bool):
-        n_ctx = self.n_ctx_train()
-        tokens = (llama_cpp.llama_token * n_ctx)()
+    # Longest text whose tokens are kept by the token cache
+    TOKEN_CACHE_MAX_BYTES = 16384
+
+    def tokenize(self, text: bytes, add_bos: bool, special: bool) -> List[int]:
+        return self.tokenize_array(text, add_bos, special).tolist()
+
+    def tokenize_array(self, text: bytes, add_bos: bool, special: bool) -> npt.NDArray[np.intc]:
+        """Tokenize `text` into an intc array.
+
+        Arrays of short texts come from a bounded LRU and are read-only, copy
+        them before modifying.
+        """
+        cached = len(text) <= self.TOKEN_CACHE_MAX_BYTES and self.token_cache_size > 0
+        if cached:
+            key = (text, add_bos, special)
+            with self._token_cache_lock:
+                tokens = self._token_cache.get(key)
+                if tokens is not None:
+                    self._token_cache.move_to_end(key)
+                    return tokens
+
+        # A token covers at least one byte, plus BOS/EOS and a space prefix
+        n_max = len(text) + 4
+        tokens = np.empty(n_max, dtype=np.intc)
         n_tokens = llama_cpp.llama_tokenize(
-            self.vocab, text, len(text), tokens, n_ctx, add_bos, special
+            self.vocab, text, len(text), tokens.ctypes.data_as(llama_cpp.llama_token_p), n_max, add_bos, special
         )
         if n_tokens < 0:
-            n_tokens = abs(n_tokens)
-            tokens = (llama_cpp.llama_token * n_tokens)()
+            n_max = -n_tokens
+            tokens = np.empty(n_max, dtype=np.intc)
             n_tokens = llama_cpp.llama_tokenize(
-                self.vocab, text, len(text), tokens, n_tokens, add_bos, special
+                self.vocab, text, len(text), tokens.ctypes.data_as(llama_cpp.llama_token_p), n_max, add_bos, special
             )
             if n_tokens < 0:
                 raise RuntimeError(
                     f'Failed to tokenize: text="{text}" n_tokens={n_tokens}'
                 )
-        return list(tokens[:n_tokens])
+        tokens = tokens[:n_tokens]
+
+        if cached:
+            tokens = tokens.copy()
+            tokens.setflags(write=False)
+            with self._token_cache_lock:
+                self._token_cache[key] = tokens
+                while len(self._token_cache) > self.token_cache_size:
+                    self._token_cache.popitem(last=False)
+        return tokens
 
     def token_to_piece(self, token: int, special: bool = False) -> bytes:
         buf = ctypes.create_string_buffer(32)
-        llama_cpp.llama_token_to_piece(self.vocab, token, buf, 32, 0, special)
-        return bytes(buf)
+        n = llama_cpp.llama_token_to_piece(self.vocab, token, buf, 32, 0, special)
+        return bytes(buf[: max(n, 0)])
 
     def detokenize(self, tokens: List[int], special: bool = False) -> bytes:
         output = b""
@@ -279,6 +396,9 @@ class LlamaContext:
     def kv_cache_clear(self):
         llama_cpp.llama_kv_cache_clear(self.ctx)
 
+    def kv_cache_used_cells(self) -> int:
+        return llama_cpp.llama_get_kv_cache_used_cells(self.ctx)
+
     def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int):
         llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, p0, p1)
 
@@ -298,6 +418,19 @@ class LlamaContext:
 
     # TODO: set_state_data
 
+    def get_seq_state_size(self, seq_id: int) -> int:
+        return llama_cpp.llama_state_seq_get_size(self.ctx, seq_id)
+
+    def get_seq_state_data(self, seq_id: int) -> bytes:
+        size = llama_cpp.llama_state_seq_get_size(self.ctx, seq_id)
+        buffer = (ctypes.c_uint8 * size)()
+        n_bytes = llama_cpp.llama_state_seq_get_data(self.ctx, buffer, size, seq_id)
+        return bytes(memoryview(buffer)[:n_bytes])
+
+    def set_seq_state_data(self, data: bytes, seq_id: int) -> bool:
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        return llama_cpp.llama_state_seq_set_data(self.ctx, buffer, len(data), seq_id) != 0
+
     # TODO: llama_load_session_file
 
     # TODO: llama_save_session_file
@@ -479,6 +612,13 @@ class LlamaBatch:
 
         self.batch = batch
 
+        # NumPy views of the per-token arrays, filled without a Python loop
+        if self.embd == 0:
+            self._token = np.ctypeslib.as_array(batch.token, shape=(self._n_tokens,))
+        self._pos = np.ctypeslib.as_array(batch.pos, shape=(self._n_tokens,))
+        self._n_seq_id = np.ctypeslib.as_array(batch.n_seq_id, shape=(self._n_tokens,))
+        self._logits = np.ctypeslib.as_array(batch.logits, shape=(self._n_tokens,))
+
         def free_batch():
             if self.batch is None:
                 return
@@ -502,26 +642,34 @@ class LlamaBatch:
     def set_batch(self, batch: Sequence[int], n_past: int, logits_all: bool):
         n_tokens = len(batch)
         self.batch.n_tokens = n_tokens
+        self._token[:n_tokens] = batch
+        self._pos[:n_tokens] = np.arange(n_past, n_past + n_tokens)
+        self._n_seq_id[:n_tokens] = 1
+        self._logits[:n_tokens] = logits_all
+        self._logits[n_tokens - 1] = True
         for i in range(n_tokens):
-            self.batch.token[i] = batch[i]
-            self.batch.pos[i] = n_past + i
             self.batch.seq_id[i][0] = 0
-            self.batch.n_seq_id[i] = 1
-            self.batch.logits[i] = logits_all
-        self.batch.logits[n_tokens - 1] = True
 
     def add_sequence(self, batch: Sequence[int], seq_id: int, logits_all: bool):
         n_tokens = len(batch)
         n_tokens0 = self.batch.n_tokens
         self.batch.n_tokens += n_tokens
-        for i in range(n_tokens):
-            j = n_tokens0 + i
-            self.batch.token[j] = batch[i]
-            self.batch.pos[j] = i
+        self._token[n_tokens0 : n_tokens0 + n_tokens] = batch
+        self._pos[n_tokens0 : n_tokens0 + n_tokens] = np.arange(n_tokens)
+        self._n_seq_id[n_tokens0 : n_tokens0 + n_tokens] = 1
+        self._logits[n_tokens0 : n_tokens0 + n_tokens] = logits_all
+        self._logits[n_tokens0 + n_tokens - 1] = True
+        for j in range(n_tokens0, n_tokens0 + n_tokens):
             self.batch.seq_id[j][0] = seq_id
-            self.batch.n_seq_id[j] = 1
-            self.batch.logits[j] = logits_all
-        self.batch.logits[n_tokens - 1] = True
+
+    def add_token(self, token: int, pos: int, seq_id: int, logits: bool):
+        i = self.batch.n_tokens
+        self.batch.token[i] = token
+        self.batch.pos[i] = pos
+        self.batch.seq_id[i][0] = seq_id
+        self.batch.n_seq_id[i] = 1
+        self.batch.logits[i] = logits
+        self.batch.n_tokens += 1
 
 
 class LlamaTokenDataArray:
@@ -559,6 +707,53 @@ def normalize_embedding(embedding):
     return [v / norm for v in embedding]
 
 
+def normalize_embeddings(embeddings: npt.NDArray[np.single]) -> npt.NDArray[np.single]:
+    """Scale the rows of an embedding matrix to unit length in place, zero rows are left as is."""
+    norm = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    np.divide(embeddings, norm, out=embeddings, where=norm > 0)
+    return embeddings
+
+
+EMBEDDING_ENCODING_FORMATS = ("float", "base64", "float16", "int8", "binary")
+
+
+def encode_embeddings(
+    embeddings: npt.NDArray[np.single], encoding_format: str = "float"
+) -> List[Any]:
+    """Encode the rows of an embedding matrix for a JSON response.
+
+    "float" gives lists of floats. "base64" and "float16" give base64 strings of
+    the little-endian float32 / float16 values, "binary" of the sign bits packed
+    8 per byte (most significant bit first). "int8" gives {"data", "scale"}
+    dicts, where data holds the row divided by scale = max(abs(row)) / 127 and
+    rounded.
+    """
+    if encoding_format == "float":
+        return embeddings.tolist()
+    if encoding_format == "base64":
+        data = embeddings.astype("<f4", copy=False)
+    elif encoding_format == "float16":
+        data = embeddings.astype("<f2")
+    elif encoding_format == "int8":
+        scales = np.abs(embeddings).max(axis=-1, initial=0.0) / 127
+        data = np.rint(
+            embeddings / np.where(scales > 0, scales, 1)[:, None]
+        ).astype(np.int8)
+    elif encoding_format == "binary":
+        data = np.packbits(embeddings > 0, axis=-1)
+    else:
+        raise ValueError(
+            f"Unknown encoding_format {encoding_format!r}, expected one of {EMBEDDING_ENCODING_FORMATS}"
+        )
+    encoded = [base64.b64encode(row.tobytes()).decode("ascii") for row in data]
+    if encoding_format == "int8":
+        return [
+            {"data": row, "scale": scale}
+            for row, scale in zip(encoded, scales.tolist())
+        ]
+    return encoded
+
+
 # Python wrappers over common/sampling structs
 
 
@@ -762,14 +957,18 @@ class LlamaSampler:
         self.sampler = llama_cpp.llama_sampler_chain_init(params)
         self.samplers: List[llama_cpp.llama_sampler_p] = []
         self.custom_samplers: List[Tuple[int, CustomSampler]] = []
+        # Grammar member of the chain, probed on its own by jump-forward decoding
+        self.grammar: Optional[llama_cpp.llama_sampler_p] = None
+        # Seed of the last sampler of the chain (dist or mirostat) and how to rebuild it, see reseed
+        self.seed: Optional[int] = None
+        self._seeded: Optional[Callable[[int], llama_cpp.llama_sampler_p]] = None
 
     def add_greedy(self):
         sampler = llama_cpp.llama_sampler_init_greedy()
         self._add_sampler(sampler)
 
     def add_dist(self, seed: int):
-        sampler = llama_cpp.llama_sampler_init_dist(seed)
-        self._add_sampler(sampler)
+        self._add_seeded(llama_cpp.llama_sampler_init_dist, seed)
 
     def add_softmax(self):
         sampler = llama_cpp.llama_sampler_init_softmax()
@@ -800,18 +999,18 @@ class LlamaSampler:
         self._add_sampler(sampler)
 
     def add_mirostat(self, n_vocab: int, seed: int, tau: float, eta: float, m: int):
-        sampler = llama_cpp.llama_sampler_init_mirostat(n_vocab, seed, tau, eta, m)
-        self._add_sampler(sampler)
+        self._add_seeded(
+            lambda seed: llama_cpp.llama_sampler_init_mirostat(n_vocab, seed, tau, eta, m), seed
+        )
 
     def add_mirostat_v2(self, seed: int, tau: float, eta: float):
-        sampler = llama_cpp.llama_sampler_init_mirostat_v2(seed, tau, eta)
-        self._add_sampler(sampler)
+        self._add_seeded(
+            lambda seed: llama_cpp.llama_sampler_init_mirostat_v2(seed, tau, eta), seed
+        )
 
     def add_grammar(self, model: LlamaModel, grammar: LlamaGrammar):
-        sampler = llama_cpp.llama_sampler_init_grammar(
-            model.vocab, grammar._grammar.encode("utf-8"), grammar._root.encode("utf-8")
-        )
-        self._add_sampler(sampler)
+        self.grammar = model.grammar_sampler(grammar)
+        self._add_sampler(self.grammar)
 
     def add_penalties(
         self,
@@ -841,6 +1040,13 @@ class LlamaSampler:
         )
         self._add_sampler(sampler)
 
+    def add_logit_bias(self, n_vocab: int, logit_bias: Dict[int, float]):
+        # llama.cpp copies the biases, the array only has to outlive the call
+        biases = (llama_cpp.llama_logit_bias * len(logit_bias))(
+            *(llama_cpp.llama_logit_bias(token, bias) for token, bias in logit_bias.items())
+        )
+        self.init_logit_bias(n_vocab, len(logit_bias), biases)
+
     def add_custom(
         self, apply_func: Callable[[llama_cpp.llama_token_data_array], None]
     ):
@@ -857,6 +1063,22 @@ class LlamaSampler:
         llama_cpp.llama_sampler_chain_add(self.sampler, sampler)
         self.samplers.append(sampler)
 
+    def _add_seeded(self, init: Callable[[int], llama_cpp.llama_sampler_p], seed: int):
+        self._add_sampler(init(seed))
+        self.seed = seed
+        self._seeded = init
+
+    def reseed(self, seed: int):
+        """Replace the seeded sampler ending the chain with one seeded with `seed`.
+
+        llama.cpp has no setter for the seed, the rest of the chain is kept.
+        """
+        assert self.sampler is not None and self._seeded is not None
+        index = llama_cpp.llama_sampler_chain_n(self.sampler) - 1
+        llama_cpp.llama_sampler_free(llama_cpp.llama_sampler_chain_remove(self.sampler, index))
+        self.samplers.pop()
+        self._add_seeded(self._seeded, seed)
+
     def get_seed(self) -> int:
         assert self.sampler is not None
         return llama_cpp.llama_sampler_get_seed(self.sampler)
@@ -866,6 +1088,20 @@ class LlamaSampler:
         assert ctx.ctx is not None
         return llama_cpp.llama_sampler_sample(self.sampler, ctx.ctx, idx)
 
+    def apply(self, candidates: LlamaTokenDataArray):
+        """Run the chain over `candidates` without accepting a token."""
+        assert self.sampler is not None
+        llama_cpp.llama_sampler_apply(self.sampler, ctypes.byref(candidates.candidates))
+
+    def accept(self, token: int):
+        assert self.sampler is not None
+        llama_cpp.llama_sampler_accept(self.sampler, token)
+
+    def reset(self):
+        """Reset the state of every sampler of the chain (penalty history, RNG, mirostat)."""
+        assert self.sampler is not None
+        llama_cpp.llama_sampler_reset(self.sampler)
+
     def close(self):
         if self.sampler:
             # NOTE: Must remove custom samplers before free or llama.cpp will try to free them
@@ -873,6 +1109,7 @@ class LlamaSampler:
                 llama_cpp.llama_sampler_chain_remove(self.sampler, i)
             llama_cpp.llama_sampler_free(self.sampler)
             self.sampler = None
+        self.grammar = None
         self.samplers.clear()
         self.custom_samplers.clear()
 
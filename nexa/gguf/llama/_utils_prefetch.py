@@ -0,0 +1,103 @@
+"""Page-cache warm-up helpers for GGUF model files.
+
+With `use_mmap=True` llama.cpp maps the weights lazily, so on a cold node the
+first prompt pays for every page fault. These helpers let the caller pull the
+file into the page cache up front (or evict it again, for benchmarking).
+"""
+
+import os
+import mmap
+import threading
+
+from typing import Optional
+
+# "mlock" is implemented by llama.cpp itself (`llama_model_params.use_mlock`)
+PREFETCH_POLICIES = ("none", "willneed", "readahead", "mlock")
+
+_READAHEAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _check_policy(policy: str):
+    if policy not in PREFETCH_POLICIES:
+        raise ValueError(
+            f"Unknown prefetch policy {policy!r}, expected one of {PREFETCH_POLICIES}"
+        )
+
+
+def _advise_willneed(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        elif hasattr(mmap, "MADV_WILLNEED") and os.fstat(fd).st_size > 0:
+            # The advice applies to the file pages, which stay cached after unmap
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _sequential_read(path: str, chunk_size: int = _READAHEAD_CHUNK_SIZE):
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(view):
+            pass
+
+
+def prefetch_model_file(path: str, policy: str = "none") -> Optional[threading.Thread]:
+    """Start warming the page cache for `path` according to `policy`.
+
+    Args:
+        path: Path to the model file.
+        policy: One of `PREFETCH_POLICIES`.
+            - "none": do nothing.
+            - "willneed": ask the kernel to start asynchronous readahead of the whole file.
+            - "readahead": read the file sequentially on a background daemon thread,
+              overlapping with the model load.
+            - "mlock": nothing to do here, the caller should set `use_mlock`.
+
+    Returns:
+        The background thread for "readahead", otherwise None.
+    """
+    _check_policy(policy)
+
+    if policy == "willneed":
+        try:
+            _advise_willneed(path)
+        except OSError:
+            # Advisory only, a failure here must not prevent loading the model
+            pass
+        return None
+
+    if policy == "readahead":
+        thread = threading.Thread(
+            target=_sequential_read,
+            args=(path,),
+            name="nexa-model-readahead",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    return None
+
+
+def evict_page_cache(path: str) -> bool:
+    """Drop the clean, unmapped pages of `path` from the page cache.
+
+    Uses `posix_fadvise(POSIX_FADV_DONTNEED)`. Pages still mapped or locked by a
+    live process are not evicted.
+
+    Returns:
+        True if the advice was issued, False if the platform does not support it.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
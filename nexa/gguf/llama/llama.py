@@ -9,6 +9,7 @@ import ctypes
 import typing
 import random
 import fnmatch
+import inspect
 import warnings
 import contextlib
 import multiprocessing
@@ -24,9 +25,11 @@ from typing import (
     Iterator,
     Deque,
     Callable,
+    ContextManager,
     Dict,
+    Tuple,
 )
-from collections import deque
+from collections import OrderedDict, deque
 from pathlib import Path
 
 
@@ -43,6 +46,12 @@ import nexa.gguf.llama.llama_cpp as llama_cpp
 import nexa.gguf.llama.llama_chat_format as llama_chat_format
 
 from nexa.gguf.llama.llama_speculative import LlamaDraftModel
+from nexa.gguf.llama.llama_timings import LlamaTimingCollector, LlamaTimings
+from nexa.gguf.llama.llama_autotune import (
+    DEFAULT_AUTOTUNE_CACHE_PATH,
+    LlamaAutotuneResult,
+    autotune as autotune_llama,
+)
 
 import numpy as np
 import numpy.typing as npt
@@ -50,6 +59,13 @@ import numpy.typing as npt
 import nexa.gguf.llama._internals_transformers as internals
 from nexa.gguf.llama._logger_transformers import set_verbose
 from nexa.gguf.llama._utils_transformers import suppress_stdout_stderr
+from nexa.gguf.llama._utils_prefetch import prefetch_model_file
+from nexa.gguf.llama.llama_numa import pin_numa_node
+
+# Layout of llama_token_data, for NumPy views of candidate arrays
+_TOKEN_DATA_DTYPE = np.dtype(
+    [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
+)
 
 
 class Llama:
@@ -70,12 +86,14 @@ class Llama:
         vocab_only: bool = False,
         use_mmap: bool = True,
         use_mlock: bool = False,
+        prefetch: str = "none",
         kv_overrides: Optional[Dict[str, Union[bool, int, float, str]]] = None,
         # Context Params
         seed: int = llama_cpp.LLAMA_DEFAULT_SEED,
         n_ctx: int = 512,
         n_batch: int = 512,
         n_ubatch: int = 512,
+        n_seq_max: int = 1,
         n_threads: Optional[int] = None,
         n_threads_batch: Optional[int] = None,
         rope_scaling_type: Optional[
@@ -93,6 +111,8 @@ class Llama:
         embedding: bool = False,
         offload_kqv: bool = True,
         flash_attn: bool = False,
+        context_shift: bool = False,
+        n_keep: int = 0,
         # Sampling Params
         no_perf: bool = False,
         last_n_tokens_size: int = 64,
@@ -102,13 +122,20 @@ class Llama:
         lora_path: Optional[str] = None,
         # Backend Params
         numa: Union[bool, int] = False,
+        numa_node: Optional[int] = None,
         # Chat Format Params
         chat_format: Optional[str] = None,
         chat_handler: Optional[llama_chat_format.LlamaChatCompletionHandler] = None,
         # Speculative Decoding
         draft_model: Optional[LlamaDraftModel] = None,
+        # Timings
+        timing_collector: Optional[LlamaTimingCollector] = None,
+        # Autotune
+        autotune: bool = False,
+        autotune_cache_path: Optional[str] = None,
         # Tokenizer Override
         tokenizer: Optional[BaseLlamaTokenizer] = None,
+        token_cache_size: int = 256,
         # KV cache quantization
         type_k: Optional[int] = None,
         type_v: Optional[int] = None,
@@ -154,11 +181,13 @@ class Llama:
             vocab_only: Only load the vocabulary no weights.
             use_mmap: Use mmap if possible.
             use_mlock: Force the system to keep the model in RAM.
+            prefetch: Page-cache warm-up policy for the model file, one of "none", "willneed" (kernel readahead hint), "readahead" (sequential read on a background thread) or "mlock" (same as use_mlock=True).
             kv_overrides: Key-value overrides for the model.
             seed: RNG seed, -1 for random
             n_ctx: Text context, 0 = from model
             n_batch: Prompt processing maximum batch size
             n_ubatch: Physical batch size
+            n_seq_max: Maximum number of sequences that can hold state in the KV cache (see LlamaSessionSlots)
             n_threads: Number of threads to use for generation
             n_threads_batch: Number of threads to use for batch processing
             rope_scaling_type: RoPE scaling type, from `enum llama_rope_scaling_type`. ref: https://github.com/ggerganov/llama.cpp/pull/2054
@@ -174,15 +203,22 @@ class Llama:
             embedding: Embedding mode only.
             offload_kqv: Offload K, Q, V to GPU.
             flash_attn: Use flash attention.
+            context_shift: When the context is full, discard the oldest tokens after the first n_keep and shift the rest instead of failing or truncating the output.
+            n_keep: Number of leading tokens never discarded by the context shift (the BOS token is always kept). Chat completions also keep the system prompt.
             no_perf: Measure performance timings.
             last_n_tokens_size: Maximum number of tokens to keep in the last_n_tokens deque.
             lora_base: Optional path to base model, useful if using a quantized base model and you want to apply LoRA to an f16 model.
             lora_path: Path to a LoRA file to apply to the model.
             numa: numa policy
+            numa_node: Pin the process to the physical cores of this NUMA node and allocate its memory there (`llama_numa.pin_numa_node`). n_threads and n_threads_batch default to the number of those cores. Use with use_mmap=False when other processes load the same model on other nodes, so that each gets a local copy.
             chat_format: String specifying the chat format to use when calling create_chat_completion.
             chat_handler: Optional chat handler to use when calling create_chat_completion.
             draft_model: Optional draft model to use for speculative decoding.
+            timing_collector: Record the time of each phase of every completion (`LlamaTimings`, also returned as the "timings" of responses) into this collector. No timings are taken without it.
+            autotune: Measure a short synthetic prefill and decode at load and use the fastest n_threads, n_threads_batch and n_batch (overriding the given ones). The choice is cached per host and model, see `llama_autotune.autotune`. Ignored for vocab_only and embedding models.
+            autotune_cache_path: Cache file of the autotune choices (default: ~/.cache/nexa/autotune.json).
             tokenizer: Optional tokenizer to override the default tokenizer from llama.cpp.
+            token_cache_size: Number of short texts (system prompts, stop words, chat template pieces) whose tokens are kept by the llama.cpp tokenizer, see `tokenize_array`. 0 disables the cache.
             verbose: Print verbose output to stderr.
             type_k: KV cache data type for K (default: f16)
             type_v: KV cache data type for V (default: f16)
@@ -204,6 +240,15 @@ class Llama:
                 llama_cpp.llama_backend_init()
             Llama.__backend_initialized = True
 
+        self.numa_node = numa_node
+        if numa_node is not None:
+            numa_cpus = pin_numa_node(numa_node)
+            n_threads = n_threads or len(numa_cpus)
+            n_threads_batch = n_threads_batch or len(numa_cpus)
+            if numa is False:
+                # ggml keeps its threads within the CPUs of the process
+                numa = llama_cpp.GGML_NUMA_STRATEGY_NUMACTL
+
         if isinstance(numa, bool):
             self.numa = (
                 llama_cpp.GGML_NUMA_STRATEGY_DISTRIBUTE
@@ -246,7 +291,8 @@ class Llama:
             self.model_params.tensor_split = self._c_tensor_split
         self.model_params.vocab_only = vocab_only
         self.model_params.use_mmap = use_mmap if lora_path is None else False
-        self.model_params.use_mlock = use_mlock
+        self.model_params.use_mlock = use_mlock or prefetch == "mlock"
+        self.prefetch = prefetch
 
         # kv_overrides is the original python dict
         self.kv_overrides = kv_overrides
@@ -314,6 +360,7 @@ class Llama:
         self.context_params.n_ctx = n_ctx
         self.context_params.n_batch = self.n_batch
         self.context_params.n_ubatch = min(self.n_batch, n_ubatch)
+        self.context_params.n_seq_max = max(n_seq_max, 1)
         self.context_params.n_threads = self.n_threads
         self.context_params.n_threads_batch = self.n_threads_batch
         self.context_params.rope_scaling_type = (
@@ -367,12 +414,17 @@ class Llama:
         if not os.path.exists(model_path):
             raise ValueError(f"Model path does not exist: {model_path}")
 
+        self._prefetch_thread = (
+            prefetch_model_file(model_path, prefetch) if not vocab_only else None
+        )
+
         self._model = self._stack.enter_context(
             contextlib.closing(
                 internals.LlamaModel(
                     path_model=self.model_path,
                     params=self.model_params,
                     verbose=self.verbose,
+                    token_cache_size=token_cache_size,
                 )
             )
         )
@@ -388,6 +440,7 @@ class Llama:
             self.context_params.n_batch = self.n_batch
             self.context_params.n_ubatch = min(self.n_batch, n_ubatch)
 
+        t_context = time.perf_counter()
         self._ctx = self._stack.enter_context(
             contextlib.closing(
                 internals.LlamaContext(
@@ -397,6 +450,10 @@ class Llama:
                 )
             )
         )
+        # Load-time breakdown in seconds, "first_token" is filled in by the first decode
+        self.load_timings: Dict[str, float] = dict(self._model.load_timings)
+        self.load_timings["context"] = time.perf_counter() - t_context
+        self._first_decode_pending = True
 
         self._batch = self._stack.enter_context(
             contextlib.closing(
@@ -438,6 +495,11 @@ class Llama:
 
         if self.verbose:
             print(llama_cpp.llama_print_system_info().decode("utf-8"), file=sys.stderr)
+            print(
+                f"Llama.__init__: load timings ({self.prefetch}): "
+                + ", ".join(f"{k}={v * 1000:.2f} ms" for k, v in self.load_timings.items()),
+                file=sys.stderr,
+            )
 
         self.chat_format = chat_format
         self.chat_handler = chat_handler
@@ -446,6 +508,15 @@ class Llama:
         ] = {}
 
         self.draft_model = draft_model
+        self.timing_collector = timing_collector
+        # Timings of the request being prepared or generated
+        self._timings: Optional[LlamaTimings] = None
+        self.context_shift = context_shift
+        self.n_keep = n_keep
+        # Called with the first position a context shift moves, before its KV cells are moved
+        self.on_context_shift: Optional[Callable[[int], None]] = None
+        # Called with the number of KV cells a completion may fill, before its prompt is evaluated
+        self.on_kv_request: Optional[Callable[[int], None]] = None
 
         self._n_vocab = self.n_vocab()
         self._n_ctx = self.n_ctx()
@@ -454,8 +525,13 @@ class Llama:
         self._token_eos = self.token_eos()
 
         self._candidates = internals.LlamaTokenDataArray(n_vocab=self._n_vocab)
+        self._draft_rng: Optional[np.random.Generator] = None
+        # Candidates of the single byte tokens plus EOS, built on the first jump-forward
+        self._byte_candidates: Optional[internals.LlamaTokenDataArray] = None
 
         self.n_tokens = 0
+        # (prompt tokens, tokens reused from the KV cache) of the last prompt passed to generate
+        self.last_prefix_match: Optional[Tuple[int, int]] = None
         self.input_ids: npt.NDArray[np.intc] = np.ndarray((n_ctx,), dtype=np.intc)
         self.scores: npt.NDArray[np.single] = np.ndarray(
             (n_ctx if logits_all == True else n_batch, self._n_vocab), dtype=np.single
@@ -543,6 +619,15 @@ class Llama:
                 )
 
         self._sampler = None
+        self._sampler_cache: "OrderedDict[Tuple[Any, ...], internals.LlamaSampler]" = OrderedDict()
+
+        self.autotune_result: Optional[LlamaAutotuneResult] = None
+        if autotune and not vocab_only and not embedding:
+            self.autotune_result = autotune_llama(
+                self, cache_path=autotune_cache_path or DEFAULT_AUTOTUNE_CACHE_PATH
+            )
+            if self.verbose:
+                print(self.autotune_result.report(), file=sys.stderr)
 
     @property
     def ctx(self) -> llama_cpp.llama_context_p:
@@ -589,6 +674,29 @@ class Llama:
         """
         return self.tokenizer_.tokenize(text, add_bos, special)
 
+    def tokenize_array(
+        self, text: bytes, add_bos: bool = True, special: bool = False
+    ) -> npt.NDArray[np.intc]:
+        """Tokenize a string into an intc array.
+
+        Same as `tokenize` without building a list, the array can be passed to
+        `eval` as is. It may be shared with other callers, copy it before
+        modifying.
+        """
+        if isinstance(self.tokenizer_, LlamaTokenizer):
+            return self._model.tokenize_array(text, add_bos, special)
+        return np.array(self.tokenizer_.tokenize(text, add_bos, special), dtype=np.intc)
+
+    def timed(self, phase: str) -> ContextManager[Any]:
+        """Context manager adding the time of its block to `phase` of the current request's timings.
+
+        Does nothing without a `timing_collector`. Chat handlers use it for
+        the template and tokenize phases.
+        """
+        if self._timings is None:
+            return contextlib.nullcontext()
+        return self._timings.timed(phase)
+
     def detokenize(
         self,
         tokens: List[int],
@@ -635,7 +743,7 @@ class Llama:
         Args:
             tokens: The list of tokens to evaluate.
         """
-        self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+        self._ctx.kv_cache_seq_rm(0, self.n_tokens, -1)
         for i in range(0, len(tokens), self.n_batch):
             batch = tokens[i : min(len(tokens), i + self.n_batch)]
             n_past = self.n_tokens
@@ -643,7 +751,10 @@ class Llama:
             self._batch.set_batch(
                 batch=batch, n_past=n_past, logits_all=self.context_params.logits_all
             )
-            self._ctx.decode(self._batch)
+            if self._first_decode_pending:
+                self._timed_first_decode()
+            else:
+                self._ctx.decode(self._batch)
             # Save tokens
             self.input_ids[n_past : n_past + n_tokens] = batch
             # Save logits
@@ -666,6 +777,81 @@ class Llama:
             # Update n_tokens
             self.n_tokens += n_tokens
 
+    def _timed_first_decode(self):
+        # With mmap the first decode is where the weights actually get paged in
+        t_start = time.perf_counter()
+        self._ctx.decode(self._batch)
+        self.load_timings["first_token"] = time.perf_counter() - t_start
+        self._first_decode_pending = False
+        if self.verbose:
+            print(
+                f"Llama.eval: first decode took {self.load_timings['first_token'] * 1000:.2f} ms",
+                file=sys.stderr,
+            )
+
+    def shift_context(self, n_keep: int, n_discard: Optional[int] = None) -> int:
+        """Discard tokens of the working sequence right after the first `n_keep`.
+
+        The KV cells of the discarded tokens are removed and the positions of
+        the following tokens are shifted down, so evaluation continues without
+        re-processing them. `input_ids` and `scores` are moved along with the
+        cache.
+
+        Args:
+            n_keep: Number of leading tokens to keep.
+            n_discard: Number of tokens to discard, half of the tokens after n_keep if None.
+
+        Returns:
+            The number of discarded tokens.
+        """
+        n_keep = min(n_keep, self.n_tokens)
+        if n_discard is None:
+            n_discard = (self.n_tokens - n_keep) // 2
+        n_discard = min(n_discard, self.n_tokens - n_keep)
+        if n_discard <= 0:
+            return 0
+        if self.on_context_shift is not None:
+            self.on_context_shift(n_keep + n_discard)
+        self._ctx.kv_cache_seq_rm(0, n_keep, n_keep + n_discard)
+        self._ctx.kv_cache_seq_shift(0, n_keep + n_discard, self.n_tokens, -n_discard)
+        n_moved = self.n_tokens - n_keep - n_discard
+        self.input_ids[n_keep : n_keep + n_moved] = self.input_ids[n_keep + n_discard : self.n_tokens]
+        if self.context_params.logits_all:
+            self.scores[n_keep : n_keep + n_moved, :] = self.scores[n_keep + n_discard : self.n_tokens, :]
+        self.n_tokens -= n_discard
+        if self.verbose:
+            print(
+                f"Llama.shift_context: discarded {n_discard} tokens after the first {n_keep}",
+                file=sys.stderr,
+            )
+        return n_discard
+
+    def _fit_prompt(self, prompt_tokens: List[int], n_keep: int) -> List[int]:
+        """Cut the oldest tokens after `n_keep` from a prompt that does not fit the context.
+
+        After a context shift the cache holds the kept tokens followed by the
+        most recent ones. If the prompt continues that shifted view (like the
+        next turn of a chat), the cut is made where it lines up with the cache
+        so the cached tokens are reused. Otherwise half of the window after
+        n_keep is left for the most recent prompt tokens.
+        """
+        n_keep = min(n_keep, len(prompt_tokens))
+        cached = self._input_ids[n_keep:]
+        if (
+            self.n_tokens > n_keep
+            and self._input_ids[:n_keep].tolist() == prompt_tokens[:n_keep]
+        ):
+            rest = np.array(prompt_tokens[n_keep:], dtype=np.intc)
+            n_cached = len(cached)
+            for offset in np.flatnonzero(rest[: max(len(rest) - n_cached + 1, 0)] == cached[0]):
+                if np.array_equal(rest[offset : offset + n_cached], cached):
+                    candidate = prompt_tokens[:n_keep] + prompt_tokens[n_keep + int(offset) :]
+                    if len(candidate) < self._n_ctx:
+                        return candidate
+                    break
+        n_tail = (self._n_ctx - n_keep) // 2
+        return prompt_tokens[:n_keep] + prompt_tokens[len(prompt_tokens) - n_tail :]
+
     def _init_sampler(
         self,
         top_k: int = 40,
@@ -683,30 +869,23 @@ class Llama:
         penalize_nl: bool = True,
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
+        seed: Optional[int] = None,
+        history: Optional[Callable[[], npt.NDArray[np.intc]]] = None,
+        logit_bias: Optional[Dict[int, float]] = None,
     ):
         sampler = internals.LlamaSampler()
+        if seed is None:
+            seed = self._seed
+        if history is None:
+            history = lambda: self._input_ids
+
+        if logits_processor:
+            sampler.add_custom(
+                self._logits_processor_apply(logits_processor, history)
+            )
 
-        if logits_processor is not None:
-            # Create and add a custom sampler
-            def apply_func(token_data_array: llama_cpp.llama_token_data_array_p):
-                size = token_data_array.contents.size
-                data_soa = token_data_array.contents.data
-                data_soa_address = ctypes.addressof(data_soa.contents)
-                # NOTE: This is probably broken
-                recarray = np.recarray(
-                    shape=(size,),
-                    dtype=np.dtype(
-                        [("id", np.intc), ("logit", np.single), ("p", np.single)],
-                        align=True,
-                    ),
-                    buf=(llama_cpp.llama_token_data * size).from_address(
-                        data_soa_address
-                    ),
-                )
-                for logit_processor in logits_processor:
-                    recarray.logit[:] = logit_processor(self._input_ids, recarray.logit)
-
-            sampler.add_custom(apply_func)
+        if logit_bias:
+            sampler.add_logit_bias(self._n_vocab, logit_bias)
 
         sampler.add_penalties(
             n_vocab=self._n_vocab,
@@ -725,7 +904,7 @@ class Llama:
 
         if temp < 0.0:
             sampler.add_softmax()
-            sampler.add_dist(self._seed)
+            sampler.add_dist(seed)
         elif temp == 0.0:
             sampler.add_greedy()
         else:
@@ -733,14 +912,14 @@ class Llama:
                 mirostat_m = 100
                 sampler.add_mirostat(
                     self._n_vocab,
-                    self._seed,
+                    seed,
                     mirostat_tau,
                     mirostat_eta,
                     mirostat_m,
                 )
             elif mirostat_mode == 2:
                 sampler.add_mirostat_v2(
-                    self._seed,
+                    seed,
                     mirostat_tau,
                     mirostat_eta,
                 )
@@ -752,9 +931,89 @@ class Llama:
                 sampler.add_top_p(top_p, min_keep)
                 sampler.add_min_p(min_p, min_keep)
                 sampler.add_temp(temp)
-                sampler.add_dist(self._seed)
+                sampler.add_dist(seed)
         return sampler
 
+    # Sampler chains kept by `_cached_sampler`
+    SAMPLER_CACHE_SIZE = 8
+
+    def _cached_sampler(self, **kwargs: Any) -> internals.LlamaSampler:
+        """`_init_sampler` for the chain of `generate` and `sample`.
+
+        Chains without a grammar or logits processors only depend on the
+        sampling parameters, they are kept per parameter tuple and reset
+        instead of rebuilt. The seed is not part of the key, as unseeded
+        completions get a new one every time: only the seeded sampler ending
+        a reused chain is replaced. Chains with a grammar or processors hold
+        per request state and are built for every generation.
+        """
+        if kwargs.get("grammar") is not None or kwargs.get("logits_processor"):
+            return self._init_sampler(**kwargs)
+        seed = kwargs.pop("seed", None)
+        if seed is None:
+            seed = self._seed
+        kwargs.pop("logits_processor", None)
+        kwargs.pop("grammar", None)
+        key = tuple(
+            (name, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+            for name, value in sorted(kwargs.items())
+        )
+        sampler = self._sampler_cache.get(key)
+        if sampler is not None:
+            self._sampler_cache.move_to_end(key)
+            sampler.reset()
+            if sampler.seed is not None and sampler.seed != seed:
+                sampler.reseed(seed)
+            return sampler
+        sampler = self._init_sampler(seed=seed, **kwargs)
+        self._sampler_cache[key] = sampler
+        while len(self._sampler_cache) > self.SAMPLER_CACHE_SIZE:
+            self._sampler_cache.popitem(last=False)
+        return sampler
+
+    def _logits_processor_apply(
+        self,
+        logits_processor: LogitsProcessorList,
+        history: Callable[[], npt.NDArray[np.intc]],
+    ) -> Callable[[llama_cpp.llama_token_data_array_p], None]:
+        """Custom sampler function running `logits_processor` on the candidates.
+
+        The processors see the logits of the candidate array in place, through
+        a view that is rebuilt only when llama.cpp hands over a different
+        buffer. The custom sampler heads the chain, where the candidates are
+        the whole vocabulary in token id order; other arrays are scattered into
+        a dense score vector and gathered back.
+        """
+        n_vocab = self._n_vocab
+        view_key: Tuple[int, int] = (0, 0)
+        view: Optional[npt.NDArray[Any]] = None
+        dense_scores = np.empty(n_vocab, dtype=np.single)
+
+        def apply_func(token_data_array: llama_cpp.llama_token_data_array_p):
+            nonlocal view_key, view
+            size = token_data_array.contents.size
+            key = (ctypes.addressof(token_data_array.contents.data.contents), size)
+            if key != view_key or view is None:
+                view = np.frombuffer(
+                    (llama_cpp.llama_token_data * size).from_address(key[0]),
+                    dtype=_TOKEN_DATA_DTYPE,
+                )
+                view_key = key
+            if size == n_vocab:
+                scores = view["logit"]
+                for processor in logits_processor:
+                    scores[:] = processor(history(), scores)
+            else:
+                ids = view["id"]
+                dense_scores.fill(-np.inf)
+                dense_scores[ids] = view["logit"]
+                scores = dense_scores
+                for processor in logits_processor:
+                    scores = processor(history(), scores)
+                view["logit"] = scores[ids]
+
+        return apply_func
+
     def sample(
         self,
         top_k: int = 40,
@@ -773,6 +1032,7 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         idx: Optional[int] = None,
+        logit_bias: Optional[Dict[int, float]] = None,
     ):
         """Sample a token from the model.
 
@@ -781,6 +1041,7 @@ class Llama:
             top_p: The top-p sampling parameter.
             temp: The temperature parameter.
             repeat_penalty: The repeat penalty parameter.
+            logit_bias: Added to the logits of the given tokens.
 
         Returns:
             The sampled token.
@@ -791,7 +1052,7 @@ class Llama:
 
         if self._sampler is None:
             tmp_sampler = True
-            self._sampler = self._init_sampler(
+            self._sampler = self._cached_sampler(
                 top_k=top_k,
                 top_p=top_p,
                 min_p=min_p,
@@ -807,6 +1068,7 @@ class Llama:
                 penalize_nl=penalize_nl,
                 logits_processor=logits_processor,
                 grammar=grammar,
+                logit_bias=logit_bias,
             )
 
         ridx = idx - self.n_tokens if idx is not None else -1
@@ -837,6 +1099,9 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         grammar: Optional[LlamaGrammar] = None,
+        n_keep: Optional[int] = None,
+        jump_forward: bool = False,
+        logit_bias: Optional[Dict[int, float]] = None,
     ) -> Generator[int, Optional[Sequence[int]], None]:
         """Create a generator of tokens from a prompt.
 
@@ -853,13 +1118,16 @@ class Llama:
             temp: The temperature parameter.
             repeat_penalty: The repeat penalty parameter.
             reset: Whether to reset the model state.
+            n_keep: Tokens kept by the context shift, defaults to the n_keep of the model.
+            jump_forward: With a grammar, append the text the grammar forces after each sampled token (keys, punctuation of a JSON schema) without sampling it token by token.
+            logit_bias: Added to the logits of the given tokens by the sampler chain.
 
         Yields:
             The generated tokens.
         """
         # Reset mirostat sampling
         self._mirostat_mu = ctypes.c_float(2.0 * mirostat_tau)
-        self._sampler = self._init_sampler(
+        self._sampler = self._cached_sampler(
             top_k=top_k,
             top_p=top_p,
             min_p=min_p,
@@ -875,11 +1143,13 @@ class Llama:
             penalize_nl=penalize_nl,
             logits_processor=logits_processor,
             grammar=grammar,
+            logit_bias=logit_bias,
         )
 
         # Check for kv cache prefix match
+        longest_prefix = 0
+        n_prompt_tokens = len(tokens)
         if reset and self.n_tokens > 0:
-            longest_prefix = 0
             for a, b in zip(self._input_ids, tokens[:-1]):
                 if a == b:
                     longest_prefix += 1
@@ -896,6 +1166,9 @@ class Llama:
                         file=sys.stderr,
                     )
 
+        if reset or longest_prefix > 0:
+            self.last_prefix_match = (n_prompt_tokens, longest_prefix)
+
         # Reset the model state
         if reset:
             self.reset()
@@ -906,36 +1179,81 @@ class Llama:
 
         sample_idx = self.n_tokens + len(tokens) - 1
         tokens = list(tokens)
+        if self.draft_model is not None:
+            self.draft_model.begin(sample_idx + 1)
+
+        # Speculative decoding state of the current round
+        n_drafted = 0
+        draft_distributions = None
+
+        if n_keep is None:
+            n_keep = self.n_keep
+
+        # Set by create_completion when timing_collector is set
+        timings = self._timings
+        prefill = True
 
         # Eval and sample
         while True:
+            while self.context_shift and self.n_tokens + len(tokens) > self._n_ctx:
+                n_discard = self.shift_context(n_keep)
+                if n_discard == 0:
+                    break
+                sample_idx -= n_discard
+            if timings is not None:
+                timings.mark()
             self.eval(tokens)
+            if timings is not None:
+                if prefill:
+                    timings.lap("prefill")
+                    timings.prefill_tokens += len(tokens)
+                else:
+                    timings.lap("decode")
+                    timings.decode_steps += 1
+            prefill = False
+            n_accepted = 0
             while sample_idx < self.n_tokens:
-                token = self.sample(
-                    top_k=top_k,
-                    top_p=top_p,
-                    min_p=min_p,
-                    typical_p=typical_p,
-                    temp=temp,
-                    repeat_penalty=repeat_penalty,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    tfs_z=tfs_z,
-                    mirostat_mode=mirostat_mode,
-                    mirostat_tau=mirostat_tau,
-                    mirostat_eta=mirostat_eta,
-                    logits_processor=logits_processor,
-                    grammar=grammar,
-                    penalize_nl=penalize_nl,
-                    idx=sample_idx,
-                )
+                # The drafted tokens are the last n_drafted evaluated tokens
+                draft_index = sample_idx + 1 - (self.n_tokens - n_drafted)
+                if draft_distributions is not None and 0 <= draft_index < n_drafted:
+                    token = self._sample_draft_token(
+                        idx=sample_idx,
+                        draft_token=int(self.input_ids[sample_idx + 1]),
+                        draft_distribution=draft_distributions[draft_index],
+                    )
+                else:
+                    token = self.sample(
+                        top_k=top_k,
+                        top_p=top_p,
+                        min_p=min_p,
+                        typical_p=typical_p,
+                        temp=temp,
+                        repeat_penalty=repeat_penalty,
+                        frequency_penalty=frequency_penalty,
+                        presence_penalty=presence_penalty,
+                        tfs_z=tfs_z,
+                        mirostat_mode=mirostat_mode,
+                        mirostat_tau=mirostat_tau,
+                        mirostat_eta=mirostat_eta,
+                        logits_processor=logits_processor,
+                        grammar=grammar,
+                        penalize_nl=penalize_nl,
+                        idx=sample_idx,
+                        logit_bias=logit_bias,
+                    )
+                if timings is not None:
+                    timings.lap("sample")
 
                 sample_idx += 1
                 if stopping_criteria is not None and stopping_criteria(
                     self._input_ids[: sample_idx], self._scores[sample_idx - self.n_tokens, :]
                 ):
                     return
+                if timings is not None:
+                    timings.lap("stop_check")
                 tokens_or_none = yield token
+                if timings is not None:
+                    timings.mark()
                 tokens.clear()
                 tokens.append(token)
                 if tokens_or_none is not None:
@@ -943,19 +1261,486 @@ class Llama:
 
                 if sample_idx < self.n_tokens and token != self._input_ids[sample_idx]:
                     self.n_tokens = sample_idx
-                    self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+                    self._ctx.kv_cache_seq_rm(0, self.n_tokens, -1)
                     break
+                if sample_idx < self.n_tokens:
+                    n_accepted += 1
+
+            if jump_forward and grammar is not None and len(tokens) == 1:
+                # Forced tokens are evaluated with the sampled one in the next batch
+                forced_tokens = self._forced_tokens(self._n_ctx - self.n_tokens - 1)
+                if timings is not None:
+                    timings.lap("sample")
+                for token in forced_tokens:
+                    self._sampler.accept(token)
+                    sample_idx += 1
+                    # Checked like a sampled token, with the scores of the last evaluated one
+                    if stopping_criteria is not None and stopping_criteria(
+                        np.concatenate([self._input_ids, np.array(tokens, dtype=np.intc)]),
+                        self._scores[-1, :],
+                    ):
+                        return
+                    tokens_or_none = yield token
+                    tokens.append(token)
+                    if tokens_or_none is not None:
+                        # The grammar did not see the sent tokens, stop forcing
+                        tokens.extend(tokens_or_none)
+                        break
+                if timings is not None:
+                    timings.mark()
 
             if self.draft_model is not None:
+                if n_drafted > 0:
+                    self.draft_model.update(n_drafted, n_accepted)
                 self.input_ids[self.n_tokens : self.n_tokens + len(tokens)] = tokens
                 draft_tokens = self.draft_model(
                     self.input_ids[: self.n_tokens + len(tokens)]
                 )
-                tokens.extend(
-                    draft_tokens.astype(int)[
-                        : self._n_ctx - self.n_tokens - len(tokens)
-                    ]
+                draft_tokens = draft_tokens.astype(int)[
+                    : self._n_ctx - self.n_tokens - len(tokens)
+                ]
+                n_drafted = len(draft_tokens)
+                draft_distributions = self.draft_model.draft_distributions()
+                tokens.extend(draft_tokens)
+                if timings is not None:
+                    timings.lap("draft")
+
+    def _sample_draft_token(
+        self,
+        idx: int,
+        draft_token: int,
+        draft_distribution: Tuple[npt.NDArray[np.intc], npt.NDArray[np.single]],
+    ) -> int:
+        """Verify a sampled draft token by rejection sampling.
+
+        The drafted token is accepted with probability min(1, p / q), where p
+        comes from this model's sampler chain and q from the draft. On rejection
+        the token is resampled from the normalized residual max(0, p - q), so
+        the output follows this model's distribution exactly.
+        """
+        assert self._sampler is not None
+        logits = np.ctypeslib.as_array(
+            self._ctx.get_logits_ith(idx - self.n_tokens), shape=(self._n_vocab,)
+        )
+        self._candidates.copy_logits(logits)
+        self._candidates.candidates.selected = -1
+        self._sampler.apply(self._candidates)
+
+        size = self._candidates.candidates.size
+        selected = self._candidates.candidates.selected
+        p_ids = self._candidates.candidates_data.id[:size]
+        p = self._candidates.candidates_data.p[:size]
+        if self._draft_rng is None:
+            self._draft_rng = np.random.default_rng(self._seed)
+
+        q_ids, q = draft_distribution
+        q_dense = np.zeros(self._n_vocab, dtype=np.single)
+        q_dense[q_ids] = q
+        p_x = float(p[p_ids == draft_token].sum())
+        q_x = float(q_dense[draft_token])
+
+        if q_x > 0.0 and self._draft_rng.random() * q_x < p_x:
+            token = draft_token
+        else:
+            residual = np.maximum(p - q_dense[p_ids], 0.0)
+            total = float(residual.sum())
+            if total > 0.0:
+                token = int(self._draft_rng.choice(p_ids, p=residual / total))
+            else:
+                # Greedy chains leave p untouched, take the chain's own choice
+                token = int(p_ids[selected]) if selected >= 0 else int(p_ids[0])
+        self._sampler.accept(token)
+        return token
+
+    def _forced_tokens(self, limit: int, max_bytes: int = 256) -> List[int]:
+        """Tokens of the text the grammar allows as the only continuation.
+
+        The grammar sampler of the current chain is applied to the single byte
+        tokens of ASCII and to tokens starting with every other byte (the
+        single byte token where the vocabulary has one): while exactly one
+        ASCII byte passes, the byte is forced and accepted on a clone of the
+        grammar. The forced text is
+        tokenized as a whole and its last token is left to sampling, so the
+        model can still merge it with the text that follows. Returns at most
+        `limit` tokens, none if the tokenization does not spell the forced
+        bytes exactly (e.g. a tokenizer that adds a space prefix).
+        """
+        assert self._sampler is not None
+        grammar = self._sampler.grammar
+        if grammar is None or limit <= 0:
+            return []
+
+        if self._byte_candidates is None:
+            byte_tokens = [-1] * 256
+            # Tokens starting with a byte that has no single byte token, any of
+            # them passing means the byte is allowed
+            lead_tokens: Dict[int, List[int]] = {}
+            for token in range(self._n_vocab):
+                piece = self._model.token_to_piece(token, special=False)
+                if len(piece) == 1 and byte_tokens[piece[0]] < 0:
+                    byte_tokens[piece[0]] = token
+                elif len(piece) > 1 and piece[0] >= 128:
+                    lead_tokens.setdefault(piece[0], []).append(token)
+            if min(byte_tokens[:128]) < 0:
+                # Vocabulary without ASCII byte tokens, jump-forward is disabled
+                self._byte_candidates = internals.LlamaTokenDataArray(n_vocab=0)
+            else:
+                candidate_ids = byte_tokens[:128] + [self._token_eos]
+                for byte in range(128, 256):
+                    if byte_tokens[byte] >= 0:
+                        candidate_ids.append(byte_tokens[byte])
+                    else:
+                        candidate_ids.extend(lead_tokens.get(byte, []))
+                self._byte_candidates = internals.LlamaTokenDataArray(n_vocab=len(candidate_ids))
+                self._byte_candidates.default_candidates_data_id[:] = candidate_ids
+        candidates = self._byte_candidates
+        if candidates.n_vocab == 0:
+            return []
+
+        logits = np.zeros(candidates.n_vocab, dtype=np.single)
+        forced = bytearray()
+        sampler = grammar
+        try:
+            while len(forced) < max_bytes:
+                candidates.copy_logits(logits)
+                llama_cpp.llama_sampler_apply(sampler, ctypes.byref(candidates.candidates))
+                allowed = np.flatnonzero(np.isfinite(candidates.candidates_data.logit))
+                # Below 128 the index is the byte value, 128 is EOS
+                if len(allowed) != 1 or allowed[0] >= 128:
+                    break
+                if sampler is grammar:
+                    sampler = llama_cpp.llama_sampler_clone(grammar)
+                llama_cpp.llama_sampler_accept(
+                    sampler, int(candidates.default_candidates_data_id[allowed[0]])
                 )
+                forced.append(int(allowed[0]))
+        finally:
+            if sampler is not grammar:
+                llama_cpp.llama_sampler_free(sampler)
+
+        if len(forced) < 2:
+            return []
+        tokens = self.tokenize(bytes(forced), add_bos=False, special=False)
+        if b"".join(self._model.token_to_piece(token) for token in tokens) != forced:
+            return []
+        return tokens[:-1][:limit]
+
+    def _request_kv(self, n_cells: int):
+        """Let `on_kv_request` make room for `n_cells` cells of the next completion."""
+        if self.on_kv_request is not None:
+            self.on_kv_request(min(n_cells, self._n_ctx))
+
+    def _parallel_seq_ids(self, n: int) -> List[int]:
+        """KV sequences of `n` parallel samples: the working sequence plus the highest ids.
+
+        Parked chat sessions (LlamaSessionSlots) use the lowest ids, so both fit
+        as long as n_seq_max >= n_slots + n.
+        """
+        n_seq_max = self.context_params.n_seq_max
+        if n > n_seq_max or n > self.n_batch:
+            raise ValueError(
+                f"{n} parallel samples require Llama(n_seq_max>={n}, n_batch>={n}), "
+                f"got n_seq_max={n_seq_max}, n_batch={self.n_batch}"
+            )
+        return [0] + list(range(n_seq_max - n + 1, n_seq_max))
+
+    def generate_parallel(
+        self,
+        tokens: Sequence[int],
+        n: int,
+        seeds: Optional[Sequence[int]] = None,
+        top_k: int = 40,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        temp: float = 0.80,
+        repeat_penalty: float = 1.0,
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        penalize_nl: bool = True,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        grammar: Optional[LlamaGrammar] = None,
+        logprobs: bool = False,
+        logit_bias: Optional[Dict[int, float]] = None,
+    ) -> Generator[
+        List[Tuple[int, int, Optional[float]]], Optional[Sequence[int]], None
+    ]:
+        """Sample `n` continuations of one prompt, decoded together in one batch per step.
+
+        The prompt is evaluated once on the working sequence and copied to the
+        other sequences with `kv_cache_seq_cp`, which only shares the cells.
+        Each continuation has its own sampler chain seeded with `seeds[i]`.
+
+        Examples:
+            >>> gen = llama.generate_parallel(tokens, n=4, temp=0.8)
+            >>> step = next(gen)  # [(0, token, None), (1, token, None), ...]
+            >>> step = gen.send([2])  # finish sample 2, keep decoding the others
+
+        Args:
+            tokens: The prompt tokens.
+            n: The number of samples.
+            seeds: One sampler seed per sample, derived from the model seed if None.
+            logprobs: Whether to report the log-probability of every sampled token.
+            logit_bias: Added to the logits of the given tokens by every sampler chain.
+
+        Yields:
+            Per step, `(sample index, token, logprob or None)` for every running
+            sample. Samples missing from a step were stopped by `stopping_criteria`.
+            Send the indices of samples to finish. The generator returns when all
+            samples are finished or the context is full.
+        """
+        seq_ids = self._parallel_seq_ids(n)
+        if seeds is None:
+            seeds = [(self._seed + i) & 0xFFFFFFFF for i in range(n)]
+        tokens = list(tokens)
+        histories = [list(tokens) for _ in range(n)]
+        samplers = [
+            self._init_sampler(
+                top_k=top_k,
+                top_p=top_p,
+                min_p=min_p,
+                typical_p=typical_p,
+                temp=temp,
+                repeat_penalty=repeat_penalty,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                tfs_z=tfs_z,
+                mirostat_mode=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+                penalize_nl=penalize_nl,
+                logits_processor=logits_processor,
+                grammar=grammar,
+                seed=seeds[i],
+                history=lambda i=i: np.array(histories[i], dtype=np.intc),
+                logit_bias=logit_bias,
+            )
+            for i in range(n)
+        ]
+
+        # Prefill once, reusing the cached prefix like generate does
+        longest_prefix = 0
+        if self.n_tokens > 0:
+            longest_prefix = Llama.longest_token_prefix(
+                self._input_ids.tolist(), tokens[:-1]
+            )
+        self.last_prefix_match = (len(tokens), longest_prefix)
+        self.n_tokens = longest_prefix
+        self.eval(tokens[longest_prefix:])
+        n_prompt = self.n_tokens
+        for seq_id in seq_ids[1:]:
+            self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            self._ctx.kv_cache_seq_cp(seq_ids[0], seq_id, -1, -1)
+
+        running = list(range(n))
+        # Row of each sample's logits in the last decoded batch
+        logits_idx = [-1] * n
+        pos = n_prompt
+        try:
+            while running:
+                step: List[Tuple[int, int, Optional[float]]] = []
+                stopped = []
+                for i in running:
+                    token = samplers[i].sample(self._ctx, logits_idx[i])
+                    histories[i].append(token)
+                    logits = None
+                    if logprobs or stopping_criteria is not None:
+                        logits = np.ctypeslib.as_array(
+                            self._ctx.get_logits_ith(logits_idx[i]),
+                            shape=(self._n_vocab,),
+                        )
+                    if stopping_criteria is not None and stopping_criteria(
+                        np.array(histories[i], dtype=np.intc), logits
+                    ):
+                        stopped.append(i)
+                        continue
+                    logprob = (
+                        float(Llama.logits_to_logprobs(logits)[token])
+                        if logprobs
+                        else None
+                    )
+                    step.append((i, token, logprob))
+
+                finished = set(stopped)
+                if step:
+                    finished.update((yield step) or ())
+                running = [i for i in running if i not in finished]
+                for i in finished:
+                    if seq_ids[i] != seq_ids[0]:
+                        self._ctx.kv_cache_seq_rm(seq_ids[i], -1, -1)
+                if not running or pos >= self._n_ctx:
+                    return
+
+                self._batch.reset()
+                for row, i in enumerate(running):
+                    self._batch.add_token(histories[i][-1], pos, seq_ids[i], True)
+                    logits_idx[i] = row
+                self._ctx.decode(self._batch)
+                pos += 1
+        finally:
+            for seq_id in seq_ids[1:]:
+                self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            # Only the prompt stays cached for the next request
+            self._ctx.kv_cache_seq_rm(seq_ids[0], n_prompt, -1)
+            self.n_tokens = n_prompt
+            for sampler in samplers:
+                sampler.close()
+
+    def beam_search(
+        self,
+        tokens: Sequence[int],
+        num_beams: int = 4,
+        max_tokens: int = 16,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+    ) -> List[Tuple[List[int], float, str]]:
+        """Beam search over the model's log-probabilities, all beams decoded in one batch per step.
+
+        Every beam lives in its own KV sequence. A beam that is extended in
+        several ways is copied with `kv_cache_seq_cp`, which shares the cells of
+        the common prefix, and beams that are dropped are pruned with
+        `kv_cache_seq_rm`. Hypotheses are ranked by the sum of their token
+        log-probabilities divided by `length ** length_penalty`.
+
+        Args:
+            tokens: The prompt tokens.
+            num_beams: The number of beams.
+            max_tokens: The maximum number of tokens to generate.
+            length_penalty: Exponent of the length normalization, > 0 favours longer outputs.
+            early_stopping: Stop as soon as num_beams hypotheses are finished, instead of
+                when no running beam can beat the finished ones anymore.
+            logits_processor: Applied to the logits of every beam before ranking.
+            stopping_criteria: Finishes a beam like an end-of-generation token.
+
+        Returns:
+            Up to num_beams `(tokens, score, finish_reason)` hypotheses, best first.
+            The tokens exclude the prompt and the end-of-generation token.
+        """
+        seq_ids = self._parallel_seq_ids(num_beams)
+        tokens = list(tokens)
+        # Worst case every beam owns all of its cells
+        max_tokens = min(max_tokens, (self._n_ctx - len(tokens)) // num_beams)
+        n_candidates = min(2 * num_beams, self._n_vocab)
+
+        longest_prefix = 0
+        if self.n_tokens > 0:
+            longest_prefix = Llama.longest_token_prefix(
+                self._input_ids.tolist(), tokens[:-1]
+            )
+        self.last_prefix_match = (len(tokens), longest_prefix)
+        self.n_tokens = longest_prefix
+        self.eval(tokens[longest_prefix:])
+        n_prompt = self.n_tokens
+
+        # (sequence id, generated tokens, sum of log-probabilities)
+        beams: List[Tuple[int, List[int], float]] = [(seq_ids[0], [], 0.0)]
+        logits_rows = [-1]
+        finished: List[Tuple[float, List[int], str]] = []
+        done = False
+
+        def add_hypothesis(generated: List[int], sum_logprob: float, finish_reason: str):
+            score = sum_logprob / (max(len(generated), 1) ** length_penalty)
+            finished.append((score, generated, finish_reason))
+            finished.sort(key=lambda hypothesis: hypothesis[0], reverse=True)
+            del finished[num_beams:]
+
+        def is_done(best_sum_logprob: float, length: int) -> bool:
+            if len(finished) < num_beams:
+                return False
+            if early_stopping:
+                return True
+            return best_sum_logprob / (length ** length_penalty) <= finished[-1][0]
+
+        try:
+            for step in range(max_tokens):
+                candidates: List[Tuple[float, int, int]] = []
+                beam_logits = []
+                for b, (_, generated, sum_logprob) in enumerate(beams):
+                    logits = np.ctypeslib.as_array(
+                        self._ctx.get_logits_ith(logits_rows[b]), shape=(self._n_vocab,)
+                    )
+                    if logits_processor is not None:
+                        logits = logits_processor(
+                            np.array(tokens + generated, dtype=np.intc), logits.copy()
+                        )
+                    beam_logits.append(logits)
+                    logprobs = Llama.logits_to_logprobs(logits)
+                    top = np.argpartition(logprobs, -n_candidates)[-n_candidates:]
+                    candidates.extend(
+                        (sum_logprob + float(logprobs[token]), b, int(token))
+                        for token in top
+                    )
+                candidates.sort(reverse=True)
+
+                next_beams: List[Tuple[int, List[int], float]] = []
+                for rank, (sum_logprob, b, token) in enumerate(candidates):
+                    generated = beams[b][1] + [token]
+                    if llama_cpp.llama_token_is_eog(self._model.vocab, token) or (
+                        stopping_criteria is not None
+                        and stopping_criteria(
+                            np.array(tokens + generated, dtype=np.intc), beam_logits[b]
+                        )
+                    ):
+                        # Only hypotheses that would have been a top beam count
+                        if rank < num_beams:
+                            add_hypothesis(beams[b][1], sum_logprob, "stop")
+                        continue
+                    next_beams.append((b, generated, sum_logprob))
+                    if len(next_beams) == num_beams:
+                        break
+
+                if not next_beams or is_done(next_beams[0][2], step + 1):
+                    done = True
+                    break
+
+                # The first child of a beam keeps its sequence, the others get a copy
+                assigned: List[Optional[int]] = [None] * len(next_beams)
+                parents = set()
+                for j, (b, _, _) in enumerate(next_beams):
+                    if b not in parents:
+                        parents.add(b)
+                        assigned[j] = beams[b][0]
+                free = [seq_id for seq_id in seq_ids if seq_id not in assigned]
+                for seq_id in free:
+                    self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+                for j, (b, _, _) in enumerate(next_beams):
+                    if assigned[j] is None:
+                        assigned[j] = free.pop()
+                        self._ctx.kv_cache_seq_cp(beams[b][0], assigned[j], -1, -1)
+                beams = [
+                    (seq_id, generated, sum_logprob)
+                    for seq_id, (_, generated, sum_logprob) in zip(assigned, next_beams)
+                ]
+
+                if step + 1 == max_tokens:
+                    break
+                self._batch.reset()
+                for seq_id, generated, _ in beams:
+                    self._batch.add_token(generated[-1], n_prompt + step, seq_id, True)
+                logits_rows = list(range(len(beams)))
+                self._ctx.decode(self._batch)
+
+            if not done:
+                for _, generated, sum_logprob in beams:
+                    add_hypothesis(generated, sum_logprob, "length")
+        finally:
+            # Keep the prompt cached on the working sequence for the next request
+            if beams[0][0] != seq_ids[0]:
+                self._ctx.kv_cache_seq_rm(seq_ids[0], -1, -1)
+                self._ctx.kv_cache_seq_cp(beams[0][0], seq_ids[0], 0, n_prompt)
+            for seq_id in seq_ids[1:]:
+                self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            self._ctx.kv_cache_seq_rm(seq_ids[0], n_prompt, -1)
+            self.n_tokens = n_prompt
+
+        return [(generated, score, reason) for score, generated, reason in finished]
 
     def create_embedding(
         self, input: Union[str, List[str]], model: Optional[str] = None
@@ -1003,15 +1788,61 @@ class Llama:
         normalize: bool = False,
         truncate: bool = True,
         return_count: bool = False,
+        dimensions: Optional[int] = None,
     ):
         """Embed a string.
 
         Args:
             input: The utf-8 encoded string to embed.
+            dimensions: Keep only the first dimensions of each embedding (for Matryoshka models), before normalizing.
 
         Returns:
             A list of embeddings
         """
+        embeddings, total_tokens = self.embed_array(
+            input,
+            normalize=normalize,
+            truncate=truncate,
+            return_count=True,
+            dimensions=dimensions,
+        )
+        if isinstance(embeddings, np.ndarray):
+            output = embeddings.tolist()
+        else:
+            output = [embedding.tolist() for embedding in embeddings]
+
+        if return_count:
+            return output, total_tokens
+        else:
+            return output
+
+    def embed_array(
+        self,
+        input: Union[str, List[str], List[List[int]]],
+        normalize: bool = False,
+        truncate: bool = True,
+        return_count: bool = False,
+        dimensions: Optional[int] = None,
+    ):
+        """Embed a string or a list of strings into a float32 array.
+
+        All inputs are tokenized first and bucketed by length. Each batch is
+        filled with the longest inputs that still fit, so the short inputs fill
+        the gaps left by the long ones instead of following the order of the
+        list. The embeddings are copied from the context straight into a
+        preallocated matrix, empty inputs get zero vectors.
+
+        Args:
+            input: The utf-8 encoded string or list of strings to embed, lists of tokens are embedded as is.
+            normalize: Scale the embeddings to unit length.
+            truncate: Truncate inputs longer than the batch size instead of raising.
+            return_count: Also return the number of embedded tokens.
+            dimensions: Keep only the first dimensions of each embedding (for Matryoshka models), before normalizing.
+
+        Returns:
+            An array of shape (len(input), n_embd), or (n_embd,) for a string.
+            Models without pooling return one (n_tokens, n_embd) array per input.
+        """
         n_embd = self.n_embd()
         n_batch = self.n_batch
 
@@ -1024,86 +1855,91 @@ class Llama:
                 "Llama model must be created with embedding=True to call this method"
             )
 
+        if dimensions is not None and not 0 < dimensions <= n_embd:
+            raise ValueError(f"Expected 0 < dimensions <= {n_embd}, got {dimensions}")
+
+        inputs = [input] if isinstance(input, str) else input
+        inputs_tokens = [
+            self.tokenize_array(text.encode("utf-8")) if isinstance(text, str) else text
+            for text in inputs
+        ]
+        if truncate:
+            inputs_tokens = [tokens[:n_batch] for tokens in inputs_tokens]
+        lengths = np.array([len(tokens) for tokens in inputs_tokens], dtype=np.intp)
+        if len(lengths) > 0 and lengths.max() > n_batch:
+            raise ValueError(
+                f"Requested tokens ({lengths.max()}) exceed batch size of {n_batch}"
+            )
+
         if self.verbose:
             llama_cpp.llama_perf_context_reset(self._ctx.ctx)
 
-        if isinstance(input, str):
-            inputs = [input]
+        data: Union[npt.NDArray[np.single], List[npt.NDArray[np.single]]]
+        if logits_all:
+            data = [np.zeros((0, n_embd), dtype=np.single)] * len(inputs_tokens)
         else:
-            inputs = input
-
-        # reset batch
-        self._batch.reset()
-
-        # decode and fetch embeddings
-        data: Union[List[List[float]], List[List[List[float]]]] = []
+            data = np.zeros((len(inputs_tokens), n_embd), dtype=np.single)
 
-        def decode_batch(seq_sizes: List[int]):
+        def decode_batch(indices: List[int]):
             llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
             self._ctx.decode(self._batch)
             self._batch.reset()
 
             # store embeddings
-            if pooling_type == llama_cpp.LLAMA_POOLING_TYPE_NONE:
-                pos: int = 0
-                for i, size in enumerate(seq_sizes):
-                    ptr = llama_cpp.llama_get_embeddings(self._ctx.ctx)
-                    embedding: List[List[float]] = [
-                        ptr[pos + j * n_embd : pos + (j + 1) * n_embd]
-                        for j in range(size)
-                    ]
-                    if normalize:
-                        embedding = [
-                            internals.normalize_embedding(e) for e in embedding
-                        ]
-                    data.append(embedding)
-                    pos += size
-            else:
-                for i in range(len(seq_sizes)):
-                    ptr = llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, i)
-                    embedding: List[float] = ptr[:n_embd]
-                    if normalize:
-                        embedding = internals.normalize_embedding(embedding)
-                    data.append(embedding)
-
-        # init state
-        total_tokens = 0
-        s_batch = []
-        t_batch = 0
-        p_batch = 0
-
-        # accumulate batches and encode
-        for text in inputs:
-            tokens = self.tokenize(text.encode("utf-8"))
-            if truncate:
-                tokens = tokens[:n_batch]
-
-            n_tokens = len(tokens)
-            total_tokens += n_tokens
-
-            # check for overrun
-            if n_tokens > n_batch:
-                raise ValueError(
-                    f"Requested tokens ({n_tokens}) exceed batch size of {n_batch}"
+            if logits_all:
+                embeddings = np.ctypeslib.as_array(
+                    llama_cpp.llama_get_embeddings(self._ctx.ctx),
+                    shape=(int(lengths[indices].sum()), n_embd),
                 )
+                pos = 0
+                for i in indices:
+                    data[i] = embeddings[pos : pos + lengths[i]].copy()
+                    pos += lengths[i]
+            else:
+                for seq_id, i in enumerate(indices):
+                    data[i] = np.ctypeslib.as_array(
+                        llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, seq_id),
+                        shape=(n_embd,),
+                    )
 
-            # time to eval batch
-            if t_batch + n_tokens > n_batch:
-                decode_batch(s_batch)
-                s_batch = []
-                t_batch = 0
-                p_batch = 0
+        # reset batch
+        self._batch.reset()
 
-            # add to batch
-            self._batch.add_sequence(tokens, p_batch, logits_all)
+        # bucket the inputs by length, in reverse so that pop() keeps the input order
+        buckets: List[List[int]] = [[] for _ in range(n_batch + 1)]
+        for i in range(len(inputs_tokens) - 1, -1, -1):
+            buckets[lengths[i]].append(i)
+        n_remaining = len(inputs_tokens) - len(buckets[0])
+        max_length = int(lengths.max()) if len(lengths) > 0 else 0
+
+        # fill each batch with the longest inputs that fit and encode
+        while n_remaining > 0:
+            while not buckets[max_length]:
+                max_length -= 1
+            indices: List[int] = []
+            n_free = n_batch
+            length = max_length
+            while length > 0:
+                if buckets[length]:
+                    i = buckets[length].pop()
+                    self._batch.add_sequence(inputs_tokens[i], len(indices), logits_all)
+                    indices.append(i)
+                    n_free -= length
+                    length = min(length, n_free)
+                else:
+                    length -= 1
+            n_remaining -= len(indices)
+            decode_batch(indices)
 
-            # update batch stats
-            s_batch.append(n_tokens)
-            t_batch += n_tokens
-            p_batch += 1
+        if dimensions is not None and dimensions < n_embd:
+            if logits_all:
+                data = [embeddings[:, :dimensions].copy() for embeddings in data]
+            else:
+                data = data[:, :dimensions].copy()
 
-        # hanlde last batch
-        decode_batch(s_batch)
+        if normalize:
+            for embeddings in data if logits_all else [data]:
+                internals.normalize_embeddings(embeddings)
 
         if self.verbose:
             llama_cpp.llama_perf_context_print(self._ctx.ctx)
@@ -1114,7 +1950,7 @@ class Llama:
         self.reset()
 
         if return_count:
-            return output, total_tokens
+            return output, int(lengths.sum())
         else:
             return output
 
@@ -1145,11 +1981,22 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         logit_bias: Optional[Dict[int, float]] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        n_keep: Optional[int] = None,
+        jump_forward: bool = False,
+        timings: Optional[LlamaTimings] = None,
     ) -> Union[
         Iterator[CreateCompletionResponse], Iterator[CreateCompletionStreamResponse]
     ]:
         assert suffix is None or suffix.__class__ is str
 
+        # Read by generate, cleared by create_completion when the request ends
+        self._timings = timings
+
         completion_id: str = f"cmpl-{str(uuid.uuid4())}"
         created: int = int(time.time())
         bos_token_id: int = self.token_bos()
@@ -1184,6 +2031,8 @@ class Llama:
             suffix = "☺" + suffix
             suffix_space_prefix = 2
 
+        if timings is not None:
+            timings.mark()
         # If prompt is empty, initialize completion with BOS token to avoid
         # detokenization including a space at the beginning of the completion
         completion_tokens: List[int] = [] if len(prompt) > 0 else [bos_token_id]
@@ -1192,11 +2041,11 @@ class Llama:
             [prefix_token_id] if prefix_token_id >= 0 and suffix is not None else []
         ) + (
             (
-                self.tokenize(
+                self.tokenize_array(
                     prompt.encode("utf-8"),
                     add_bos=False,
                     special=(prefix_token_id < 0 or suffix is None),
-                )
+                ).tolist()
                 if prompt != ""
                 else []
             )
@@ -1207,9 +2056,9 @@ class Llama:
             (
                 [suffix_token_id]
                 + (
-                    self.tokenize(suffix.encode("utf-8"), add_bos=False, special=False)[
+                    self.tokenize_array(suffix.encode("utf-8"), add_bos=False, special=False)[
                         suffix_space_prefix:
-                    ]
+                    ].tolist()
                     if suffix
                     else []
                 )
@@ -1229,6 +2078,9 @@ class Llama:
             )
             + eos_tokens
         )
+        if timings is not None:
+            timings.lap("tokenize")
+            timings.prompt_tokens = len(prompt_tokens)
         text: bytes = b""
         returned_tokens: int = 0
         stop = (
@@ -1242,46 +2094,56 @@ class Llama:
                 RuntimeWarning,
             )
 
-        # NOTE: This likely doesn't work correctly for the first token in the prompt
-        # because of the extra space added to the start of the prompt_tokens
+        # Applied by llama.cpp's logit bias sampler in the sampler chain
+        logit_bias_map: Optional[Dict[int, float]] = None
         if logit_bias is not None:
             logit_bias_map = {int(k): float(v) for k, v in logit_bias.items()}
 
-            def logit_bias_processor(
-                input_ids: npt.NDArray[np.intc],
-                scores: npt.NDArray[np.single],
-            ) -> npt.NDArray[np.single]:
-                new_scores = np.copy(
-                    scores
-                )  # Does it make sense to copy the whole array or can we just overwrite the original one?
-                for input_id, score in logit_bias_map.items():
-                    new_scores[input_id] = score + scores[input_id]
-                return new_scores
-
-            _logit_bias_processor = LogitsProcessorList([logit_bias_processor])
-            if logits_processor is None:
-                logits_processor = _logit_bias_processor
-            else:
-                logits_processor = logits_processor.extend(_logit_bias_processor)
-
         if self.verbose:
             self._ctx.reset_timings()
 
+        if self.context_shift:
+            n_keep = self.n_keep if n_keep is None else n_keep
+            if prompt_tokens[:1] == [bos_token_id]:
+                n_keep = max(n_keep, 1)
+            n_keep = min(n_keep, self._n_ctx // 2)
+            if len(prompt_tokens) >= self._n_ctx:
+                n_prompt_tokens = len(prompt_tokens)
+                prompt_tokens = self._fit_prompt(prompt_tokens, n_keep)
+                if self.verbose:
+                    print(
+                        f"Llama._create_completion: prompt of {n_prompt_tokens} tokens "
+                        f"cut to {len(prompt_tokens)} tokens",
+                        file=sys.stderr,
+                    )
+
         if len(prompt_tokens) >= self._n_ctx:
             raise ValueError(
                 f"Requested tokens ({len(prompt_tokens)}) exceed context window of {llama_cpp.llama_n_ctx(self.ctx)}"
             )
 
+        # Only a single completion without logprobs can outgrow the context
+        # window, the other modes index their tokens by position
+        shift_context = (
+            self.context_shift
+            and logprobs is None
+            and num_beams == 1
+            and (best_of or n) == 1
+        )
+
         if max_tokens is None or max_tokens <= 0:
-            # Unlimited, depending on n_ctx.
-            max_tokens = self._n_ctx - len(prompt_tokens)
+            # Unlimited, depending on n_ctx unless the context is shifted.
+            max_tokens = (
+                sys.maxsize if shift_context else self._n_ctx - len(prompt_tokens)
+            )
 
         # Truncate max_tokens if requested tokens would exceed the context window
-        max_tokens = (
-            max_tokens
-            if max_tokens + len(prompt_tokens) < self._n_ctx
-            else (self._n_ctx - len(prompt_tokens))
-        )
+        if not shift_context:
+            max_tokens = (
+                max_tokens
+                if max_tokens + len(prompt_tokens) < self._n_ctx
+                else (self._n_ctx - len(prompt_tokens))
+            )
 
         if stop != []:
             stop_sequences = [s.encode("utf-8") for s in stop]
@@ -1315,6 +2177,73 @@ class Llama:
         else:
             self.set_seed(random.Random(self._seed).randint(0, 2 ** 32))
 
+        if num_beams > 1:
+            if n > num_beams:
+                raise ValueError(f"Expected n <= num_beams, got n={n}, num_beams={num_beams}")
+            if logprobs is not None or stream or grammar is not None:
+                raise ValueError("Beam search does not support logprobs, stream or grammar")
+            yield self._create_completion_beam(
+                prompt_tokens,
+                n=n,
+                num_beams=num_beams,
+                completion_id=completion_id,
+                created=created,
+                model_name=model_name,
+                max_tokens=max_tokens,
+                stop_sequences=stop_sequences,
+                text_prefix=prompt if echo and isinstance(prompt, str) else "",
+                text_suffix=suffix if suffix_token_id < 0 and suffix is not None else "",
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                logit_bias=logit_bias_map,
+            )
+            return
+
+        if best_of is None:
+            best_of = n
+        if n < 1 or best_of < n:
+            raise ValueError(f"Expected 1 <= n <= best_of, got n={n}, best_of={best_of}")
+        if best_of > 1:
+            if logprobs is not None:
+                raise ValueError("logprobs is not supported with n > 1 or best_of > 1")
+            if stream and best_of > n:
+                raise ValueError("best_of > n cannot be streamed")
+            yield from self._create_completion_parallel(
+                prompt_tokens,
+                n=n,
+                best_of=best_of,
+                completion_id=completion_id,
+                created=created,
+                model_name=model_name,
+                max_tokens=max_tokens,
+                stop_sequences=stop_sequences,
+                stream=stream,
+                text_prefix=prompt if echo and isinstance(prompt, str) else "",
+                text_suffix=suffix if suffix_token_id < 0 and suffix is not None else "",
+                sampling=dict(
+                    top_k=top_k,
+                    top_p=top_p,
+                    min_p=min_p,
+                    typical_p=typical_p,
+                    temp=temperature,
+                    tfs_z=tfs_z,
+                    mirostat_mode=mirostat_mode,
+                    mirostat_tau=mirostat_tau,
+                    mirostat_eta=mirostat_eta,
+                    frequency_penalty=frequency_penalty,
+                    presence_penalty=presence_penalty,
+                    repeat_penalty=repeat_penalty,
+                    stopping_criteria=stopping_criteria,
+                    logits_processor=logits_processor,
+                    grammar=grammar,
+                    logit_bias=logit_bias_map,
+                ),
+            )
+            return
+
+        self._request_kv(len(prompt_tokens) + max_tokens)
         finish_reason = "length"
         multibyte_fix = 0
         for token in self.generate(
@@ -1334,7 +2263,13 @@ class Llama:
             stopping_criteria=stopping_criteria,
             logits_processor=logits_processor,
             grammar=grammar,
+            n_keep=n_keep,
+            # Forced tokens have no scores until the next eval
+            jump_forward=jump_forward and logprobs is None,
+            logit_bias=logit_bias_map,
         ):
+            if timings is not None:
+                timings.mark()
             if llama_cpp.llama_token_is_eog(self._model.vocab, token):
                 text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
                 finish_reason = "stop"
@@ -1343,6 +2278,8 @@ class Llama:
             completion_tokens.append(token)
 
             all_text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            if timings is not None:
+                timings.lap("detokenize")
 
             # Contains multi-byte UTF8
             for k, char in enumerate(all_text[-3:]):
@@ -1363,6 +2300,8 @@ class Llama:
                 text = all_text[: all_text.index(first_stop)]
                 finish_reason = "stop"
                 break
+            if timings is not None:
+                timings.lap("stop_check")
 
             if stream:
                 remaining_tokens = completion_tokens[returned_tokens:]
@@ -1444,6 +2383,13 @@ class Llama:
                             "top_logprobs": [top_logprob],
                         }
                         returned_tokens += 1
+                        chunk_text = self.detokenize(
+                            [token],
+                            prev_tokens=prompt_tokens
+                            + completion_tokens[:returned_tokens],
+                        ).decode("utf-8", errors="ignore")
+                        if timings is not None:
+                            timings.lap("detokenize")
                         yield {
                             "id": completion_id,
                             "object": "text_completion",
@@ -1451,17 +2397,15 @@ class Llama:
                             "model": model_name,
                             "choices": [
                                 {
-                                    "text": self.detokenize(
-                                        [token],
-                                        prev_tokens=prompt_tokens
-                                        + completion_tokens[:returned_tokens],
-                                    ).decode("utf-8", errors="ignore"),
+                                    "text": chunk_text,
                                     "index": 0,
                                     "logprobs": logprobs_or_none,
                                     "finish_reason": None,
                                 }
                             ],
                         }
+                        if timings is not None:
+                            timings.mark()
                 else:
                     while len(remaining_tokens) > 0:
                         decode_success = False
@@ -1490,6 +2434,8 @@ class Llama:
                         remaining_tokens = remaining_tokens[i:]
                         returned_tokens += i
 
+                        if timings is not None:
+                            timings.lap("detokenize")
                         yield {
                             "id": completion_id,
                             "object": "text_completion",
@@ -1504,6 +2450,10 @@ class Llama:
                                 }
                             ],
                         }
+                        if timings is not None:
+                            timings.mark()
+                if timings is not None:
+                    timings.lap("detokenize")
 
             if len(completion_tokens) >= max_tokens:
                 text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
@@ -1516,6 +2466,9 @@ class Llama:
             text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
             finish_reason = "stop"
 
+        if timings is not None:
+            timings.completion_tokens = len(completion_tokens)
+
         if self.verbose:
             self._ctx.print_timings()
 
@@ -1738,6 +2691,222 @@ class Llama:
             },
         }
 
+    def _create_completion_parallel(
+        self,
+        prompt_tokens: List[int],
+        n: int,
+        best_of: int,
+        completion_id: str,
+        created: int,
+        model_name: str,
+        max_tokens: int,
+        stop_sequences: List[bytes],
+        stream: bool,
+        text_prefix: str,
+        text_suffix: str,
+        sampling: Dict[str, Any],
+    ) -> Union[
+        Iterator[CreateCompletionResponse], Iterator[CreateCompletionStreamResponse]
+    ]:
+        # All samples share the remaining cells of the (unified) KV cache
+        max_tokens = min(max_tokens, (self._n_ctx - len(prompt_tokens)) // best_of)
+        self._request_kv(len(prompt_tokens) + best_of * max_tokens)
+        completion_tokens: List[List[int]] = [[] for _ in range(best_of)]
+        texts: List[bytes] = [b""] * best_of
+        finish_reasons: List[Optional[str]] = [None] * best_of
+        sum_logprobs = [0.0] * best_of
+        returned = [0] * best_of
+
+        def stream_chunk(i: int, text: str, finish_reason: Optional[str]):
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model_name,
+                "choices": [
+                    {
+                        "text": text,
+                        "index": i,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+
+        generator = self.generate_parallel(
+            prompt_tokens, best_of, logprobs=best_of > n, **sampling
+        )
+        finished: Optional[List[int]] = None
+        while True:
+            try:
+                step = generator.send(finished)
+            except StopIteration:
+                break
+            finished = []
+            stepped = set()
+            for i, token, logprob in step:
+                stepped.add(i)
+                if llama_cpp.llama_token_is_eog(self._model.vocab, token):
+                    finish_reasons[i] = "stop"
+                    finished.append(i)
+                    continue
+                completion_tokens[i].append(token)
+                if logprob is not None:
+                    sum_logprobs[i] += logprob
+                texts[i] = self.detokenize(completion_tokens[i], prev_tokens=prompt_tokens)
+                stop_positions = [texts[i].index(s) for s in stop_sequences if s in texts[i]]
+                if stop_positions:
+                    texts[i] = texts[i][: min(stop_positions)]
+                    finish_reasons[i] = "stop"
+                    finished.append(i)
+                elif len(completion_tokens[i]) >= max_tokens:
+                    finish_reasons[i] = "length"
+                    finished.append(i)
+            for i in range(best_of):
+                if finish_reasons[i] is None and i not in stepped:
+                    # Stopped by stopping_criteria
+                    finish_reasons[i] = "stop"
+            if stream:
+                for i in stepped:
+                    end = len(texts[i])
+                    if finish_reasons[i] is None:
+                        # Hold back text that could be the start of a stop sequence
+                        for s in stop_sequences:
+                            for k in range(min(len(s), end), 0, -1):
+                                if texts[i].endswith(s[:k]):
+                                    end = min(end, len(texts[i]) - k)
+                                    break
+                    delta = texts[i][returned[i] : end]
+                    try:
+                        text = delta.decode("utf-8")
+                    except UnicodeDecodeError as e:
+                        # Wait for the rest of a multi-byte character
+                        delta = delta[: e.start]
+                        text = delta.decode("utf-8", errors="ignore")
+                    if text:
+                        returned[i] += len(delta)
+                        yield stream_chunk(i, text, None)
+        for i in range(best_of):
+            if finish_reasons[i] is None:
+                finish_reasons[i] = "length"
+
+        if self.verbose:
+            self._ctx.print_timings()
+
+        if stream:
+            for i in range(n):
+                rest = texts[i][returned[i] :].decode("utf-8", errors="ignore")
+                if rest or text_suffix:
+                    yield stream_chunk(i, rest + text_suffix, None)
+                yield stream_chunk(i, "", finish_reasons[i])
+            return
+
+        ranked = list(range(best_of))
+        if best_of > n:
+            ranked.sort(
+                key=lambda i: sum_logprobs[i] / max(len(completion_tokens[i]), 1),
+                reverse=True,
+            )
+        n_completion_tokens = sum(len(tokens) for tokens in completion_tokens)
+        yield {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": [
+                {
+                    "text": text_prefix
+                    + texts[i].decode("utf-8", errors="ignore")
+                    + text_suffix,
+                    "index": index,
+                    "logprobs": None,
+                    "finish_reason": finish_reasons[i],
+                }
+                for index, i in enumerate(ranked[:n])
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt_tokens),
+                "completion_tokens": n_completion_tokens,
+                "total_tokens": len(prompt_tokens) + n_completion_tokens,
+            },
+        }
+
+    def _create_completion_beam(
+        self,
+        prompt_tokens: List[int],
+        n: int,
+        num_beams: int,
+        completion_id: str,
+        created: int,
+        model_name: str,
+        max_tokens: int,
+        stop_sequences: List[bytes],
+        text_prefix: str,
+        text_suffix: str,
+        length_penalty: float,
+        early_stopping: bool,
+        logits_processor: Optional[LogitsProcessorList],
+        stopping_criteria: Optional[StoppingCriteriaList],
+        logit_bias: Optional[Dict[int, float]] = None,
+    ) -> CreateCompletionResponse:
+        if logit_bias:
+            # Beam search ranks the logits itself, without a sampler chain
+            bias_ids = np.array(list(logit_bias.keys()), dtype=np.intc)
+            bias_values = np.array(list(logit_bias.values()), dtype=np.single)
+
+            def logit_bias_processor(
+                input_ids: npt.NDArray[np.intc], scores: npt.NDArray[np.single]
+            ) -> npt.NDArray[np.single]:
+                scores[bias_ids] += bias_values
+                return scores
+
+            logits_processor = LogitsProcessorList(
+                [*(logits_processor or []), logit_bias_processor]
+            )
+        self._request_kv(len(prompt_tokens) + num_beams * max_tokens)
+        hypotheses = self.beam_search(
+            prompt_tokens,
+            num_beams=num_beams,
+            max_tokens=max_tokens,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+            logits_processor=logits_processor,
+            stopping_criteria=stopping_criteria,
+        )
+        if self.verbose:
+            self._ctx.print_timings()
+
+        choices = []
+        n_completion_tokens = 0
+        for index, (completion_tokens, _, finish_reason) in enumerate(hypotheses[:n]):
+            n_completion_tokens += len(completion_tokens)
+            text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            # Stop sequences do not steer the search, they only cut the result
+            stop_positions = [text.index(s) for s in stop_sequences if s in text]
+            if stop_positions:
+                text = text[: min(stop_positions)]
+                finish_reason = "stop"
+            choices.append(
+                {
+                    "text": text_prefix + text.decode("utf-8", errors="ignore") + text_suffix,
+                    "index": index,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            )
+        return {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": len(prompt_tokens),
+                "completion_tokens": n_completion_tokens,
+                "total_tokens": len(prompt_tokens) + n_completion_tokens,
+            },
+        }
+
     def create_completion(
         self,
         prompt: Union[str, List[int]],
@@ -1765,6 +2934,13 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         logit_bias: Optional[Dict[int, float]] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        n_keep: Optional[int] = None,
+        jump_forward: bool = False,
     ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
         """Generate text from a prompt.
 
@@ -1794,6 +2970,13 @@ class Llama:
             logits_processor: A list of logits processors to use.
             grammar: A grammar to use for constrained sampling.
             logit_bias: A logit bias to use.
+            n: The number of completions to return. They share the evaluated prompt and are decoded in one batch.
+            best_of: Generate this many completions and return the n with the highest log probability per token.
+            num_beams: Beam search with this many beams instead of sampling, the n best beams are returned.
+            length_penalty: Beam scores are divided by length ** length_penalty.
+            early_stopping: Stop the beam search as soon as num_beams hypotheses are finished.
+            n_keep: Prompt tokens kept when the context is shifted, defaults to the n_keep of the model.
+            jump_forward: With a grammar, insert the text it forces (keys, punctuation) without sampling it, ignored with logprobs.
 
         Raises:
             ValueError: If the requested tokens exceed the context window.
@@ -1802,6 +2985,10 @@ class Llama:
         Returns:
             Response object containing the generated text.
         """
+        # Started by create_chat_completion for the template and tokenize phases
+        timings = self._timings
+        if timings is None and self.timing_collector is not None:
+            timings = LlamaTimings()
         completion_or_chunks = self._create_completion(
             prompt=prompt,
             suffix=suffix,
@@ -1828,13 +3015,46 @@ class Llama:
             logits_processor=logits_processor,
             grammar=grammar,
             logit_bias=logit_bias,
+            n=n,
+            best_of=best_of,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+            n_keep=n_keep,
+            jump_forward=jump_forward,
+            timings=timings,
         )
+        if timings is not None:
+            completion_or_chunks = self._with_timings(completion_or_chunks, timings)
         if stream:
             chunks: Iterator[CreateCompletionStreamResponse] = completion_or_chunks
             return chunks
         completion: Completion = next(completion_or_chunks)  # type: ignore
+        if timings is not None:
+            completion_or_chunks.close()
         return completion
 
+    def _with_timings(
+        self,
+        completion_or_chunks: Iterator[Any],
+        timings: LlamaTimings,
+    ) -> Iterator[Any]:
+        """Add `timings` to the final response or chunks and report them when done."""
+        try:
+            for chunk in completion_or_chunks:
+                if chunk["choices"][0]["finish_reason"] is not None:
+                    timings.total = time.perf_counter() - timings.start_time
+                    if "usage" in chunk:
+                        # Parallel samples and beams count their tokens in the usage only
+                        timings.completion_tokens = chunk["usage"]["completion_tokens"]
+                    chunk["timings"] = timings
+                yield chunk
+        finally:
+            if self._timings is timings:
+                self._timings = None
+            assert self.timing_collector is not None
+            self.timing_collector.observe(timings)
+
     def __call__(
         self,
         prompt: str,
@@ -1862,6 +3082,13 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         logit_bias: Optional[Dict[int, float]] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        n_keep: Optional[int] = None,
+        jump_forward: bool = False,
     ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
         """Generate text from a prompt.
 
@@ -1891,6 +3118,13 @@ class Llama:
             logits_processor: A list of logits processors to use.
             grammar: A grammar to use for constrained sampling.
             logit_bias: A logit bias to use.
+            n: The number of completions to return. They share the evaluated prompt and are decoded in one batch.
+            best_of: Generate this many completions and return the n with the highest log probability per token.
+            num_beams: Beam search with this many beams instead of sampling, the n best beams are returned.
+            length_penalty: Beam scores are divided by length ** length_penalty.
+            early_stopping: Stop the beam search as soon as num_beams hypotheses are finished.
+            n_keep: Prompt tokens kept when the context is shifted, defaults to the n_keep of the model.
+            jump_forward: With a grammar, insert the text it forces (keys, punctuation) without sampling it, ignored with logprobs.
 
         Raises:
             ValueError: If the requested tokens exceed the context window.
@@ -1925,6 +3159,13 @@ class Llama:
             logits_processor=logits_processor,
             grammar=grammar,
             logit_bias=logit_bias,
+            n=n,
+            best_of=best_of,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+            n_keep=n_keep,
+            jump_forward=jump_forward,
         )
 
     def create_chat_completion(
@@ -1957,6 +3198,13 @@ class Llama:
         logit_bias: Optional[Dict[int, float]] = None,
         logprobs: Optional[bool] = None,
         top_logprobs: Optional[int] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        jump_forward: bool = False,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
     ) -> Union[
         CreateChatCompletionResponse, Iterator[CreateChatCompletionStreamResponse]
     ]:
@@ -1989,6 +3237,16 @@ class Llama:
             logits_processor: A list of logits processors to use.
             grammar: A grammar to use.
             logit_bias: A logit bias to use.
+            n: The number of chat completion choices to generate, decoded in one batch.
+            best_of: Generate this many choices and return the n with the highest log probability per token.
+            num_beams: Beam search with this many beams instead of sampling, the n best beams are returned.
+            length_penalty: Beam scores are divided by length ** length_penalty.
+            early_stopping: Stop the beam search as soon as num_beams hypotheses are finished.
+            jump_forward: Insert the text forced by the grammar (or the JSON schema of response_format and tools) without sampling it.
+            stopping_criteria: Checked before each token along with those of the chat format, e.g. to cancel the generation.
+
+        Raises:
+            ValueError: If n, best_of or num_beams are used with a chat handler that does not take them.
 
         Returns:
             Generated chat completion or a stream of chat completion chunks.
@@ -1998,37 +3256,63 @@ class Llama:
             or self._chat_handlers.get(self.chat_format)
             or llama_chat_format.get_chat_completion_handler(self.chat_format)
         )
-        return handler(
-            llama=self,
-            messages=messages,
-            functions=functions,
-            function_call=function_call,
-            tools=tools,
-            tool_choice=tool_choice,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            min_p=min_p,
-            typical_p=typical_p,
-            logprobs=logprobs,
-            top_logprobs=top_logprobs,
-            stream=stream,
-            stop=stop,
-            seed=seed,
-            response_format=response_format,
-            max_tokens=max_tokens,
-            presence_penalty=presence_penalty,
-            frequency_penalty=frequency_penalty,
-            repeat_penalty=repeat_penalty,
-            tfs_z=tfs_z,
-            mirostat_mode=mirostat_mode,
-            mirostat_tau=mirostat_tau,
-            mirostat_eta=mirostat_eta,
-            model=model,
-            logits_processor=logits_processor,
-            grammar=grammar,
-            logit_bias=logit_bias,
-        )
+        samples = n != 1 or best_of not in (None, 1) or num_beams != 1
+        # Only handlers built on the generic chat formatter know about parallel
+        # samples and beams, the others would swallow them in **kwargs
+        if samples and "n" not in inspect.signature(handler).parameters:
+            raise ValueError(
+                f"n, best_of and num_beams are not supported by the chat handler of chat format {self.chat_format!r}"
+            )
+        if self.timing_collector is not None:
+            # Taken over by the create_completion call of the handler
+            self._timings = LlamaTimings()
+        try:
+            return handler(
+                llama=self,
+                messages=messages,
+                functions=functions,
+                function_call=function_call,
+                tools=tools,
+                tool_choice=tool_choice,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                min_p=min_p,
+                typical_p=typical_p,
+                logprobs=logprobs,
+                top_logprobs=top_logprobs,
+                stream=stream,
+                stop=stop,
+                seed=seed,
+                response_format=response_format,
+                max_tokens=max_tokens,
+                presence_penalty=presence_penalty,
+                frequency_penalty=frequency_penalty,
+                repeat_penalty=repeat_penalty,
+                tfs_z=tfs_z,
+                mirostat_mode=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+                model=model,
+                logits_processor=logits_processor,
+                grammar=grammar,
+                logit_bias=logit_bias,
+                **(
+                    dict(
+                        n=n,
+                        best_of=best_of,
+                        num_beams=num_beams,
+                        length_penalty=length_penalty,
+                        early_stopping=early_stopping,
+                    )
+                    if samples
+                    else {}
+                ),
+                **({"jump_forward": True} if jump_forward else {}),
+                **({"stopping_criteria": stopping_criteria} if stopping_criteria is not None else {}),
+            )
+        finally:
+            self._timings = None
 
     def create_chat_completion_openai_v1(
         self,
@@ -2074,12 +3358,14 @@ class Llama:
             vocab_only=self.model_params.vocab_only,
             use_mmap=self.model_params.use_mmap,
             use_mlock=self.model_params.use_mlock,
+            prefetch=self.prefetch,
             kv_overrides=self.kv_overrides,
             # Context Params
             seed=self._seed,
             n_ctx=self.context_params.n_ctx,
             n_batch=self.n_batch,
             n_ubatch=self.context_params.n_ubatch,
+            n_seq_max=self.context_params.n_seq_max,
             n_threads=self.context_params.n_threads,
             n_threads_batch=self.context_params.n_threads_batch,
             rope_scaling_type=self.context_params.rope_scaling_type,
@@ -2095,6 +3381,8 @@ class Llama:
             embedding=self.context_params.embeddings,
             offload_kqv=self.context_params.offload_kqv,
             flash_attn=self.context_params.flash_attn,
+            context_shift=self.context_shift,
+            n_keep=self.n_keep,
             # Sampling Params
             no_perf=self.context_params.no_perf,
             last_n_tokens_size=self.last_n_tokens_size,
@@ -2104,11 +3392,14 @@ class Llama:
             lora_path=self.lora_path,
             # Backend Params
             numa=self.numa,
+            numa_node=self.numa_node,
             # Chat Format Params
             chat_format=self.chat_format,
             chat_handler=self.chat_handler,
             # Speculative Decidng
             draft_model=self.draft_model,
+            # Tokenizer Override
+            token_cache_size=self._model.token_cache_size,
             # KV cache quantization
             type_k=self.context_params.type_k,
             type_v=self.context_params.type_v,
@@ -2169,6 +3460,10 @@ class Llama:
         """Return the context window size."""
         return self._ctx.n_ctx()
 
+    def kv_cache_used_cells(self) -> int:
+        """Return the number of KV cache cells holding tokens of any sequence."""
+        return self._ctx.kv_cache_used_cells()
+
     def n_embd(self) -> int:
         """Return the embedding size."""
         return self._model.n_embd()
@@ -0,0 +1,155 @@
+import asyncio
+import functools
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from nexa.gguf.llama.llama_types import *
+
+import nexa.gguf.llama.llama
+
+T = TypeVar("T")
+
+# Marks the end of a stream in the queue of an async iterator
+_END = object()
+
+
+async def _finished(future: "Future[Any]"):
+    """Wait for `future` to finish, whatever its outcome."""
+    await asyncio.wait([asyncio.wrap_future(future)])
+
+
+class AsyncLlama:
+    """asyncio front end of a `Llama`, decoding on one dedicated thread.
+
+    Every call runs on a single executor thread owned by this object, in the
+    order the calls were made, so any number of waiting clients costs no
+    threads and never touches the model concurrently. Streaming calls return
+    async iterators that buffer at most `max_buffered` chunks: a slow reader
+    pauses decoding rather than piling up chunks. Cancelling the awaiting
+    task, or leaving an `async for` early, aborts the generation before its
+    next token.
+
+    Examples:
+        >>> llm = AsyncLlama(Llama(model_path="model.gguf"))
+        >>> completion = await llm.create_completion("Q: Name the planets. A:", max_tokens=64)
+        >>> async for chunk in await llm.create_chat_completion(messages=messages, stream=True):
+        ...     print(chunk["choices"][0]["delta"].get("content", ""), end="")
+    """
+
+    def __init__(self, llama: "nexa.gguf.llama.llama.Llama", max_buffered: int = 16):
+        self.llama = llama
+        self.max_buffered = max_buffered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama-decode")
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run `func(*args, **kwargs)` on the decode thread and return its result.
+
+        A call cancelled before the thread picks it up never runs, one already
+        running is waited for: the model is in use until it returns.
+        """
+        return await self._run(functools.partial(func, *args, **kwargs))
+
+    async def _run(self, call: Callable[[], T], on_cancel: Optional[Callable[[], None]] = None) -> T:
+        future = self._executor.submit(call)
+        try:
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if not future.cancel():
+                if on_cancel is not None:
+                    on_cancel()
+                await _finished(future)
+            raise
+
+    async def iterate(self, factory: Callable[[], Iterator[T]]) -> AsyncIterator[T]:
+        """Iterate `factory()` on the decode thread.
+
+        The iterator is created and advanced on the decode thread, which holds
+        it until it is exhausted or the async iteration ends.
+        """
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        slots = threading.Semaphore(self.max_buffered)
+        cancelled = threading.Event()
+
+        def produce():
+            iterator = factory()
+            try:
+                for item in iterator:
+                    slots.acquire()
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+
+        future = self._executor.submit(produce)
+        # Scheduled after the items put by the producer
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, _END))
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                slots.release()
+                yield item
+            await asyncio.wrap_future(future)
+        finally:
+            cancelled.set()
+            # Wake the producer if it waits for room in the buffer
+            slots.release()
+            if not future.cancel():
+                # The producer stops before its next item, the model is in use until then
+                await _finished(future)
+
+    async def _generate(self, method: Callable[..., Any], kwargs: Dict[str, Any]):
+        if kwargs.get("stream", False):
+            return self.iterate(functools.partial(method, **kwargs))
+
+        cancelled = threading.Event()
+        stopping_criteria = nexa.gguf.llama.llama.StoppingCriteriaList(
+            [lambda input_ids, logits: cancelled.is_set()]
+        )
+        stopping_criteria.extend(kwargs.get("stopping_criteria") or [])
+        kwargs["stopping_criteria"] = stopping_criteria
+        # Cancelling stops a running generation at its next token
+        return await self._run(functools.partial(method, **kwargs), on_cancel=cancelled.set)
+
+    async def create_completion(
+        self, prompt: Union[str, List[int]], **kwargs: Any
+    ) -> Union[CreateCompletionResponse, AsyncIterator[CreateCompletionStreamResponse]]:
+        """`Llama.create_completion` on the decode thread.
+
+        With `stream=True`, returns an async iterator of the chunks.
+        """
+        return await self._generate(self.llama.create_completion, dict(kwargs, prompt=prompt))
+
+    async def create_chat_completion(
+        self, messages: List[ChatCompletionRequestMessage], **kwargs: Any
+    ) -> Union[
+        CreateChatCompletionResponse, AsyncIterator[CreateChatCompletionStreamResponse]
+    ]:
+        """`Llama.create_chat_completion` on the decode thread.
+
+        With `stream=True`, returns an async iterator of the chunks.
+        """
+        return await self._generate(
+            self.llama.create_chat_completion, dict(kwargs, messages=messages)
+        )
+
+    def close(self):
+        """Let the decode thread exit once the submitted calls are done."""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import tempfile
+
+from dataclasses import asdict, dataclass, field
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+import nexa.gguf.llama.llama
+import nexa.gguf.llama.llama_cpp as llama_cpp
+
+DEFAULT_AUTOTUNE_CACHE_PATH = os.path.join(
+    os.path.expanduser(os.getenv("NEXA_CACHE_ROOT") or "~/.cache/nexa"), "autotune.json"
+)
+
+# Logical batch sizes probed, capped by the n_batch of the context
+BATCH_CANDIDATES = (64, 128, 256, 512, 1024, 2048)
+
+_PROBE_TEXT = (
+    "The committee reviewed the quarterly figures, compared them with last year's "
+    "forecast and agreed to revisit the shipping costs before the next meeting. "
+)
+
+# Bytes hashed at each end of the model file
+_MODEL_HASH_BYTES = 1 << 20
+
+
+@dataclass
+class LlamaAutotuneResult:
+    """Thread counts and batch size picked by `autotune`, with the measurements behind them.
+
+    Each measurement is a dict with the probed `phase` ("prefill" or
+    "decode"), `n_threads`, `n_threads_batch`, `n_batch` and the measured
+    `tokens_per_second`. `cached` is True when the values were read from the
+    cache instead of being measured.
+    """
+
+    n_threads: int
+    n_threads_batch: int
+    n_batch: int
+    measurements: List[Dict[str, Any]] = field(default_factory=list)
+    cached: bool = False
+
+    def report(self) -> str:
+        lines = [
+            f"autotune: n_threads={self.n_threads} n_threads_batch={self.n_threads_batch} "
+            f"n_batch={self.n_batch}" + (" (cached)" if self.cached else "")
+        ]
+        for m in self.measurements:
+            lines.append(
+                f"  {m['phase']:<8} n_threads={m['n_threads']:<4} n_threads_batch={m['n_threads_batch']:<4} "
+                f"n_batch={m['n_batch']:<5} {m['tokens_per_second']:>10.1f} tok/s"
+            )
+        return "\n".join(lines)
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _usable_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def physical_cores() -> int:
+    """Number of physical cores among the usable CPUs, the logical count when unknown."""
+    cpuinfo = _read_text("/proc/cpuinfo")
+    usable = set(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    if cpuinfo is None:
+        return _usable_cpus()
+    cores = set()
+    processor = physical_id = None
+    for line in cpuinfo.splitlines() + [""]:
+        key, _, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if key == "processor":
+            processor = int(value)
+        elif key == "physical id":
+            physical_id = value
+        elif key == "core id" and (usable is None or processor in usable):
+            cores.add((physical_id, value))
+        elif not line:
+            processor = physical_id = None
+    # ARM kernels list no core ids, every CPU is a core
+    return len(cores) or _usable_cpus()
+
+
+def host_fingerprint() -> str:
+    """Hash of what decides the best thread counts: CPU model, core counts, SMT, affinity and backend."""
+    cpu_model = None
+    for line in (_read_text("/proc/cpuinfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() in ("model name", "Model", "CPU part"):
+            cpu_model = value.strip()
+            break
+    info = {
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu": cpu_model or platform.processor(),
+        "logical_cpus": os.cpu_count(),
+        "usable_cpus": _usable_cpus(),
+        "physical_cores": physical_cores(),
+        "smt": _read_text("/sys/devices/system/cpu/smt/active"),
+        "numa_nodes": len(
+            [d for d in os.listdir("/sys/devices/system/node") if d.startswith("node")]
+        )
+        if os.path.isdir("/sys/devices/system/node")
+        else None,
+        "backend": llama_cpp.llama_print_system_info().decode("utf-8", errors="ignore"),
+    }
+    return hashlib.sha256(json.dumps(info, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def model_hash(path: str) -> str:
+    """Hash of the size, the header (metadata) and the tail of a model file."""
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(_MODEL_HASH_BYTES))
+        if size > 2 * _MODEL_HASH_BYTES:
+            f.seek(-_MODEL_HASH_BYTES, os.SEEK_END)
+            digest.update(f.read(_MODEL_HASH_BYTES))
+    return digest.hexdigest()[:16]
+
+
+def thread_candidates(n_cpus: Optional[int] = None, n_cores: Optional[int] = None) -> List[int]:
+    """Thread counts worth probing: powers of two, the physical cores (minus one) and all CPUs."""
+    n_cpus = n_cpus or _usable_cpus()
+    n_cores = min(n_cores or physical_cores(), n_cpus)
+    candidates = {n_cpus, n_cores, max(n_cores - 1, 1)}
+    power = 1
+    while power < n_cpus:
+        candidates.add(power)
+        power *= 2
+    return sorted(candidates)
+
+
+def _load_cache(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(path: str, key: str, result: LlamaAutotuneResult):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    entries = _load_cache(path)
+    entry = asdict(result)
+    entry.pop("cached")
+    entries[key] = entry
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def apply_autotune(llama: "nexa.gguf.llama.llama.Llama", result: LlamaAutotuneResult):
+    """Set the thread counts of the context and the logical batch size of `llama.eval`."""
+    llama.n_threads = llama.context_params.n_threads = result.n_threads
+    llama.n_threads_batch = llama.context_params.n_threads_batch = result.n_threads_batch
+    llama_cpp.llama_set_n_threads(llama.ctx, result.n_threads, result.n_threads_batch)
+    # The context and its batch were allocated for the original n_batch
+    llama.n_batch = min(result.n_batch, llama.context_params.n_batch)
+
+
+def _prefill_rate(llama, tokens: Sequence[int], n_batch: int, repeats: int) -> float:
+    best = 0.0
+    n_batch_saved = llama.n_batch
+    llama.n_batch = n_batch
+    try:
+        for _ in range(repeats):
+            llama.reset()
+            t_start = time.perf_counter()
+            llama.eval(tokens)
+            best = max(best, len(tokens) / (time.perf_counter() - t_start))
+    finally:
+        llama.n_batch = n_batch_saved
+    return best
+
+
+def _decode_rate(llama, tokens: Sequence[int], n_decode: int, repeats: int) -> float:
+    best = 0.0
+    for _ in range(repeats):
+        llama.reset()
+        llama.eval(tokens)
+        t_start = time.perf_counter()
+        for i in range(n_decode):
+            llama.eval(tokens[i % len(tokens) : i % len(tokens) + 1])
+        best = max(best, n_decode / (time.perf_counter() - t_start))
+    return best
+
+
+def autotune(
+    llama: "nexa.gguf.llama.llama.Llama",
+    cache_path: Optional[str] = DEFAULT_AUTOTUNE_CACHE_PATH,
+    prefill_tokens: int = 512,
+    decode_tokens: int = 16,
+    repeats: int = 2,
+    n_threads_candidates: Optional[Sequence[int]] = None,
+    n_batch_candidates: Sequence[int] = BATCH_CANDIDATES,
+    force: bool = False,
+) -> LlamaAutotuneResult:
+    """Pick the fastest `n_threads`, `n_threads_batch` and `n_batch` for `llama` on this host and apply them.
+
+    Probes a synthetic prompt, one parameter at a time: `n_threads_batch` on
+    the prefill of `prefill_tokens` tokens, then the logical batch size
+    `n_batch` (at most the context's) with that thread count, then
+    `n_threads` on `decode_tokens` single-token decodes. Each configuration
+    runs `repeats` times and keeps its best rate. The choice is cached in
+    `cache_path` (None disables the cache) per host fingerprint, model hash
+    and GPU offload, so later loads apply it without probing unless `force`.
+
+    The probes use the working sequence of the KV cache, which is left empty.
+
+    Returns:
+        The applied values and the measurements.
+    """
+    key = f"{host_fingerprint()}-{model_hash(llama.model_path)}-ngl{llama.model_params.n_gpu_layers}"
+    if cache_path is not None and not force:
+        entry = _load_cache(cache_path).get(key)
+        if entry is not None:
+            result = LlamaAutotuneResult(**entry, cached=True)
+            apply_autotune(llama, result)
+            return result
+
+    # Probe with the weights in memory rather than the page faults of the first decode
+    if llama._prefetch_thread is not None:
+        llama._prefetch_thread.join()
+    tokens = llama.tokenize(_PROBE_TEXT.encode("utf-8"), add_bos=True)
+    n_tokens = min(prefill_tokens, llama.n_ctx() - decode_tokens - 1)
+    tokens = (tokens * (n_tokens // len(tokens) + 1))[:n_tokens]
+    llama.reset()
+    llama.eval(tokens[:8])
+
+    threads = sorted(set(n_threads_candidates or thread_candidates()))
+    n_batch_max = llama.context_params.n_batch
+    batches = sorted({b for b in n_batch_candidates if b <= n_batch_max} | {min(llama.n_batch, n_batch_max)})
+    measurements: List[Dict[str, Any]] = []
+
+    def measure(phase, n_threads, n_threads_batch, n_batch):
+        llama_cpp.llama_set_n_threads(llama.ctx, n_threads, n_threads_batch)
+        if phase == "prefill":
+            rate = _prefill_rate(llama, tokens, n_batch, repeats)
+        else:
+            rate = _decode_rate(llama, tokens[:8], decode_tokens, repeats)
+        measurements.append(
+            {
+                "phase": phase,
+                "n_threads": n_threads,
+                "n_threads_batch": n_threads_batch,
+                "n_batch": n_batch,
+                "tokens_per_second": rate,
+            }
+        )
+        return rate
+
+    n_threads, n_batch = llama.n_threads, batches[-1]
+    n_threads_batch = max(threads, key=lambda t: measure("prefill", n_threads, t, n_batch))
+    n_batch = max(batches, key=lambda b: measure("prefill", n_threads, n_threads_batch, b))
+    n_threads = max(threads, key=lambda t: measure("decode", t, n_threads_batch, n_batch))
+    llama.reset()
+
+    result = LlamaAutotuneResult(
+        n_threads=n_threads,
+        n_threads_batch=n_threads_batch,
+        n_batch=n_batch,
+        measurements=measurements,
+    )
+    apply_autotune(llama, result)
+    if cache_path is not None:
+        try:
+            _save_cache(cache_path, key, result)
+        except OSError as e:
+            if llama.verbose:
+                print(f"Failed to save the autotune cache {cache_path}: {e}", file=sys.stderr)
+    return result
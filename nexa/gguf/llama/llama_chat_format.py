@@ -7,7 +7,10 @@ import ctypes
 import dataclasses
 import random
 import string
+import threading
+import weakref
 
+from collections import OrderedDict
 from contextlib import ExitStack
 from typing import (
     Any,
@@ -100,6 +103,7 @@ class LlamaChatCompletionHandler(Protocol):
         grammar: Optional[llama.LlamaGrammar] = None,
         logprobs: Optional[bool] = None,
         top_logprobs: Optional[int] = None,
+        stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
         **kwargs,  # type: ignore
     ) -> Union[
         llama_types.CreateChatCompletionResponse,
@@ -173,6 +177,8 @@ class ChatFormatterResponse:
     stop: Optional[Union[str, List[str]]] = None
     stopping_criteria: Optional[llama.StoppingCriteriaList] = None
     added_special: bool = False
+    # Token ids of the prompt, set by formatters that tokenize it themselves
+    prompt_tokens: Optional[List[int]] = None
 
 
 class ChatFormatter(Protocol):
@@ -189,7 +195,19 @@ class ChatFormatter(Protocol):
     ) -> ChatFormatterResponse: ...
 
 
+@dataclasses.dataclass
+class _RenderedPrefix:
+    messages: Tuple[Any, ...]
+    text: str
+    tokens: Optional[List[int]] = None
+
+
 class Jinja2ChatFormatter(ChatFormatter):
+    # Incremental renders checked against a full render before the template is trusted
+    N_VERIFY = 4
+    # Then one incremental render in VERIFY_EVERY is still checked
+    VERIFY_EVERY = 64
+
     def __init__(
         self,
         template: str,
@@ -197,8 +215,19 @@ class Jinja2ChatFormatter(ChatFormatter):
         bos_token: str,
         add_generation_prompt: bool = True,
         stop_token_ids: Optional[List[int]] = None,
+        prefix_cache_size: int = 64,
     ):
-        """A chat formatter that uses jinja2 templates to format the prompt."""
+        """A chat formatter that uses jinja2 templates to format the prompt.
+
+        The rendered text (and token ids) of the conversations it formats are
+        kept by message prefix, so a request that extends a cached conversation
+        only renders and tokenizes the new messages. This requires an
+        append-stable template, i.e. one that renders a conversation as the
+        rendering of its first messages followed by the rest. The first requests
+        served from the cache, and then one in `VERIFY_EVERY`, are checked
+        against a full render (text and tokens), and the cache is turned off for
+        templates that fail the check.
+        """
         self.template = template
         self.eos_token = eos_token
         self.bos_token = bos_token
@@ -206,6 +235,7 @@ class Jinja2ChatFormatter(ChatFormatter):
         self.stop_token_ids = (
             set(stop_token_ids) if stop_token_ids is not None else None
         )
+        self.prefix_cache_size = prefix_cache_size
 
         self._environment = ImmutableSandboxedEnvironment(
             loader=jinja2.BaseLoader(),
@@ -213,6 +243,15 @@ class Jinja2ChatFormatter(ChatFormatter):
             lstrip_blocks=True,
         ).from_string(self.template)
 
+        self._prefixes: "OrderedDict[int, _RenderedPrefix]" = OrderedDict()
+        self._prefix_lock = threading.Lock()
+        self._tokenizer: Optional[weakref.ReferenceType] = None
+        # Token ids of the generation prompts, which templates may render from the context or the last message
+        self._generation_prompts: "OrderedDict[str, List[int]]" = OrderedDict()
+        # None until enough incremental renders matched a full render
+        self._append_stable: Optional[bool] = None
+        self._n_cached_renders = 0
+
     def __call__(
         self,
         *,
@@ -221,22 +260,16 @@ class Jinja2ChatFormatter(ChatFormatter):
         function_call: Optional[llama_types.ChatCompletionRequestFunctionCall] = None,
         tools: Optional[List[llama_types.ChatCompletionTool]] = None,
         tool_choice: Optional[llama_types.ChatCompletionToolChoiceOption] = None,
+        tokenizer: Optional[llama.Llama] = None,
         **kwargs: Any,
     ) -> ChatFormatterResponse:
-        def raise_exception(message: str):
-            raise ValueError(message)
-
-        prompt = self._environment.render(
-            messages=messages,
-            eos_token=self.eos_token,
-            bos_token=self.bos_token,
-            raise_exception=raise_exception,
-            add_generation_prompt=self.add_generation_prompt,
+        context = dict(
             functions=functions,
             function_call=function_call,
             tools=tools,
             tool_choice=tool_choice,
         )
+        prompt, prompt_tokens = self._render_cached(list(messages), context, tokenizer)
 
         stopping_criteria = None
         if self.stop_token_ids is not None:
@@ -253,8 +286,204 @@ class Jinja2ChatFormatter(ChatFormatter):
             stop=[self.eos_token],
             stopping_criteria=stopping_criteria,
             added_special=True,
+            prompt_tokens=prompt_tokens,
         )
 
+    def _render(
+        self,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        add_generation_prompt: bool,
+        context: Dict[str, Any],
+    ) -> str:
+        def raise_exception(message: str):
+            raise ValueError(message)
+
+        return self._environment.render(
+            messages=messages,
+            eos_token=self.eos_token,
+            bos_token=self.bos_token,
+            raise_exception=raise_exception,
+            add_generation_prompt=add_generation_prompt,
+            **context,
+        )
+
+    @staticmethod
+    def _freeze(message: llama_types.ChatCompletionRequestMessage) -> Any:
+        """Hashable copy of a message, its JSON for nested contents (parts, tool calls)."""
+        items = tuple(message.items())
+        try:
+            hash(items)
+            return items
+        except TypeError:
+            return json.dumps(message)
+
+    def _prefix_keys(
+        self, messages: List[llama_types.ChatCompletionRequestMessage], context: Dict[str, Any]
+    ) -> Tuple[List[int], Tuple[Any, ...]]:
+        """Hash of every message prefix, keys[k - 1] is the key of messages[:k].
+
+        Also returns the frozen messages, prefixed by the context, that a cached
+        prefix is compared against since the keys may collide.
+        """
+        frozen = (json.dumps(context),) + tuple(self._freeze(m) for m in messages)
+        key = hash(frozen[0])
+        keys = []
+        for message in frozen[1:]:
+            key = hash((key, message))
+            keys.append(key)
+        return keys, frozen
+
+    def _render_cached(
+        self,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        context: Dict[str, Any],
+        tokenizer: Optional[llama.Llama],
+    ) -> Tuple[str, Optional[List[int]]]:
+        # Rendering alone is about as fast as looking a conversation up, the
+        # cache pays off with the tokenization of the prompt
+        if (
+            tokenizer is None
+            or self.prefix_cache_size <= 0
+            or self._append_stable is False
+            or not messages
+        ):
+            return self._render(messages, self.add_generation_prompt, context), None
+        try:
+            keys, frozen = self._prefix_keys(messages, context)
+        except (AttributeError, TypeError, ValueError):
+            # Messages that are not dicts of JSON serializable values
+            return self._render(messages, self.add_generation_prompt, context), None
+
+        def tokenize(text: str) -> List[int]:
+            # The tokens of short pieces (generation prompts, first turns) come from the token cache of the model
+            if hasattr(tokenizer, "tokenize_array"):
+                return tokenizer.tokenize_array(text.encode("utf-8"), add_bos=False, special=True).tolist()
+            return tokenizer.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+        with self._prefix_lock:
+            if self._tokenizer is None or self._tokenizer() is not tokenizer:
+                # Token ids are only valid for the vocabulary they came from
+                for prefix in self._prefixes.values():
+                    prefix.tokens = None
+                self._generation_prompts.clear()
+                self._tokenizer = weakref.ref(tokenizer)
+            k, cached = 0, None
+            for i in range(len(messages), 0, -1):
+                cached = self._lookup(keys[i - 1], frozen[: i + 1])
+                if cached is not None:
+                    k = i
+                    break
+
+        # The generation prompt is rendered with the messages of every request,
+        # only its tokens are cached
+        generation_prompt = ""
+        if cached is None:
+            try:
+                history = self._render(messages, False, context)
+                if self.add_generation_prompt:
+                    prompt = self._render(messages, True, context)
+                    if not prompt.startswith(history):
+                        return self._not_append_stable(messages, context)
+                    generation_prompt = prompt[len(history) :]
+            except (jinja2.TemplateError, ValueError):
+                return self._not_append_stable(messages, context)
+        else:
+            # Render the new messages behind the first one or two, so that they
+            # keep the parity of their index and the special case of a leading
+            # system message, then drop the rendering of the anchor
+            n_anchor = 2 - k % 2
+            with self._prefix_lock:
+                anchor = self._lookup(keys[n_anchor - 1], frozen[: n_anchor + 1])
+            try:
+                if anchor is None:
+                    anchor = self._store(
+                        keys[n_anchor - 1],
+                        frozen[: n_anchor + 1],
+                        self._render(messages[:n_anchor], False, context),
+                    )
+                text = self._render(messages[:n_anchor] + messages[k:], False, context)
+                if self.add_generation_prompt:
+                    prompt = self._render(messages[:n_anchor] + messages[k:], True, context)
+                    if not prompt.startswith(text):
+                        return self._not_append_stable(messages, context)
+                    generation_prompt = prompt[len(text) :]
+            except (jinja2.TemplateError, ValueError):
+                # e.g. a template that rejects a conversation ending with its anchor
+                return self._not_append_stable(messages, context)
+            if not text.startswith(anchor.text):
+                return self._not_append_stable(messages, context)
+            history = cached.text + text[len(anchor.text) :]
+        prompt = history + generation_prompt
+
+        history_tokens = None
+        if cached is None:
+            # The history is tokenized when a later request extends it
+            prompt_tokens = tokenize(prompt)
+        else:
+            if cached.tokens is None:
+                cached.tokens = tokenize(cached.text)
+            history_tokens = cached.tokens + tokenize(history[len(cached.text) :])
+            prompt_tokens = history_tokens
+            if generation_prompt:
+                with self._prefix_lock:
+                    generation_tokens = self._generation_prompts.get(generation_prompt)
+                    if generation_tokens is not None:
+                        self._generation_prompts.move_to_end(generation_prompt)
+                if generation_tokens is None:
+                    generation_tokens = tokenize(generation_prompt)
+                    with self._prefix_lock:
+                        self._generation_prompts[generation_prompt] = generation_tokens
+                        while len(self._generation_prompts) > self.prefix_cache_size:
+                            self._generation_prompts.popitem(last=False)
+                prompt_tokens = history_tokens + generation_tokens
+
+            # Tokens may merge across the boundaries of the pieces, which a
+            # message or tool seen for the first time can reveal at any time
+            self._n_cached_renders += 1
+            if self._append_stable is None or self._n_cached_renders % self.VERIFY_EVERY == 0:
+                full = self._render(messages, self.add_generation_prompt, context)
+                if full != prompt or tokenize(full) != prompt_tokens:
+                    return self._not_append_stable(messages, context)
+                if self._n_cached_renders >= self.N_VERIFY:
+                    self._append_stable = True
+
+        self._store(keys[-1], frozen, history, history_tokens)
+        return prompt, prompt_tokens
+
+    def _lookup(self, key: int, messages: Tuple[Any, ...]) -> Optional[_RenderedPrefix]:
+        prefix = self._prefixes.get(key)
+        if prefix is None or prefix.messages != messages:
+            return None
+        self._prefixes.move_to_end(key)
+        return prefix
+
+    def _store(
+        self,
+        key: int,
+        messages: Tuple[Any, ...],
+        text: str,
+        tokens: Optional[List[int]] = None,
+    ) -> _RenderedPrefix:
+        prefix = _RenderedPrefix(messages, text, tokens)
+        with self._prefix_lock:
+            self._prefixes[key] = prefix
+            self._prefixes.move_to_end(key)
+            while len(self._prefixes) > self.prefix_cache_size:
+                self._prefixes.popitem(last=False)
+        return prefix
+
+    def _not_append_stable(
+        self,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        context: Dict[str, Any],
+    ) -> Tuple[str, None]:
+        logger.debug("Chat template is not append-stable, prefix cache disabled")
+        self._append_stable = False
+        with self._prefix_lock:
+            self._prefixes.clear()
+            self._generation_prompts.clear()
+        return self._render(messages, self.add_generation_prompt, context), None
+
     def to_chat_handler(self) -> LlamaChatCompletionHandler:
         return chat_formatter_to_chat_completion_handler(self)
 
@@ -295,24 +524,29 @@ def _convert_text_completion_to_chat(
         "model": completion["model"],
         "choices": [
             {
-                "index": 0,
+                "index": choice["index"],
                 "message": {
                     "role": "assistant",
-                    "content": completion["choices"][0]["text"],
+                    "content": choice["text"],
                 },
-                "logprobs": _convert_text_completion_logprobs_to_chat(completion["choices"][0]["logprobs"]),
-                "finish_reason": completion["choices"][0]["finish_reason"],
+                "logprobs": _convert_text_completion_logprobs_to_chat(choice["logprobs"]),
+                "finish_reason": choice["finish_reason"],
             }
+            for choice in completion["choices"]
         ],
         "usage": completion["usage"],
+        **({"timings": completion["timings"]} if "timings" in completion else {}),
     }
 
 
 def _convert_text_completion_chunks_to_chat(
     chunks: Iterator[llama_types.CreateCompletionStreamResponse],
 ) -> Iterator[llama_types.ChatCompletionChunk]:
-    for i, chunk in enumerate(chunks):
-        if i == 0:
+    started = set()
+    for chunk in chunks:
+        index = chunk["choices"][0]["index"]
+        if index not in started:
+            started.add(index)
             yield {
                 "id": "chat" + chunk["id"],
                 "model": chunk["model"],
@@ -320,7 +554,7 @@ def _convert_text_completion_chunks_to_chat(
                 "object": "chat.completion.chunk",
                 "choices": [
                     {
-                        "index": 0,
+                        "index": index,
                         "delta": {
                             "role": "assistant",
                         },
@@ -336,7 +570,7 @@ def _convert_text_completion_chunks_to_chat(
             "object": "chat.completion.chunk",
             "choices": [
                 {
-                    "index": 0,
+                    "index": index,
                     "delta": (
                         {
                             "content": chunk["choices"][0]["text"],
@@ -348,6 +582,7 @@ def _convert_text_completion_chunks_to_chat(
                     "finish_reason": chunk["choices"][0]["finish_reason"],
                 }
             ],
+            **({"timings": chunk["timings"]} if "timings" in chunk else {}),
         }
 
 
@@ -581,31 +816,58 @@ def chat_formatter_to_chat_completion_handler(
         logit_bias: Optional[Dict[str, float]] = None,
         logprobs: Optional[bool] = None,
         top_logprobs: Optional[int] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        early_stopping: bool = False,
+        jump_forward: bool = False,
+        stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
         **kwargs,  # type: ignore
     ) -> Union[
         llama_types.CreateChatCompletionResponse,
         Iterator[llama_types.CreateChatCompletionStreamResponse],
     ]:
-        result = chat_formatter(
-            messages=messages,
-            functions=functions,
-            function_call=function_call,
-            tools=tools,
-            tool_choice=tool_choice,
-        )
-        prompt = llama.tokenize(
-            result.prompt.encode("utf-8"),
-            add_bos=not result.added_special,
-            special=True,
-        )
+        with llama.timed("template"):
+            result = chat_formatter(
+                messages=messages,
+                functions=functions,
+                function_call=function_call,
+                tools=tools,
+                tool_choice=tool_choice,
+                tokenizer=llama,
+            )
+        prompt = result.prompt_tokens
+        if prompt is None:
+            with llama.timed("tokenize"):
+                prompt = llama.tokenize(
+                    result.prompt.encode("utf-8"),
+                    add_bos=not result.added_special,
+                    special=True,
+                )
         if result.stop is not None:
             stop = [] if stop is None else [stop] if isinstance(stop, str) else stop
             rstop = result.stop if isinstance(result.stop, list) else [result.stop]
             stop = stop + rstop
 
-        stopping_criteria = None
         if result.stopping_criteria is not None:
-            stopping_criteria = result.stopping_criteria
+            stopping_criteria = llama.StoppingCriteriaList(
+                [*result.stopping_criteria, *(stopping_criteria or [])]
+            )
+
+        # Keep the system prompt when the context is shifted
+        n_keep = None
+        if llama.context_shift and messages and messages[0]["role"] == "system":
+            try:
+                system_prompt = llama.tokenize(
+                    chat_formatter(messages=messages[:1]).prompt.encode("utf-8"),
+                    add_bos=not result.added_special,
+                    special=True,
+                )
+                n_keep = max(llama.longest_token_prefix(system_prompt, prompt), llama.n_keep)
+            except Exception as e:
+                if llama.verbose:
+                    print(f"Failed to measure the system prompt: {e}", file=sys.stderr)
 
         if response_format is not None and response_format["type"] == "json_object":
             grammar = _grammar_for_response_format(
@@ -683,6 +945,13 @@ def chat_formatter_to_chat_completion_handler(
             stopping_criteria=stopping_criteria,
             grammar=grammar,
             logit_bias=logit_bias,
+            n=n,
+            best_of=best_of,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+            n_keep=n_keep,
+            jump_forward=jump_forward,
         )
         if tool is not None:
             tool_name = tool["function"]["name"]
@@ -1418,6 +1687,8 @@ def functionary_chat_handler(
     model: Optional[str] = None,
     logits_processor: Optional[llama.LogitsProcessorList] = None,
     grammar: Optional[llama.LlamaGrammar] = None,
+    jump_forward: bool = False,
+    stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
     **kwargs,  # type: ignore
 ) -> Union[llama_types.ChatCompletion, Iterator[llama_types.ChatCompletionChunk]]:
     SYSTEM_MESSAGE = """A chat between a curious user and an artificial intelligence assistant. The assistant gives helpful, detailed, and polite answers to the user's questions. The assistant calls functions with appropriate input when necessary"""
@@ -1605,6 +1876,7 @@ def functionary_chat_handler(
 
     if function_call is None and (functions is None or len(functions) == 0):
         completion_or_completion_chunks = llama.create_completion(
+            stopping_criteria=stopping_criteria,
             prompt=prompt + ":\n",
             temperature=temperature,
             top_p=top_p,
@@ -1632,6 +1904,7 @@ def functionary_chat_handler(
     ):
         stop = "\n"
         completion: llama_types.Completion = llama.create_completion(
+            stopping_criteria=stopping_criteria,
             prompt=prompt, stop=stop, stream=False
         )  # type: ignore
         completion_text = completion["choices"][0]["text"]
@@ -1685,6 +1958,7 @@ def functionary_chat_handler(
             )
 
     completion: llama_types.Completion = llama.create_completion(
+        stopping_criteria=stopping_criteria,
         prompt=new_prompt,
         stop=["user:", "</s>"],
         stream=False,
@@ -1704,6 +1978,7 @@ def functionary_chat_handler(
         mirostat_eta=mirostat_eta,
         model=model,
         logits_processor=logits_processor,
+        jump_forward=jump_forward,
     )  # type: ignore
 
     assert "usage" in completion
@@ -1777,6 +2052,7 @@ def functionary_v1_v2_chat_handler(
     model: Optional[str] = None,
     logits_processor: Optional[llama.LogitsProcessorList] = None,
     grammar: Optional[llama.LlamaGrammar] = None,
+    stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
     **kwargs,  # type: ignore
 ) -> Union[llama_types.ChatCompletion, Iterator[llama_types.ChatCompletionChunk]]:
     SYSTEM_MESSAGE = """A chat between a curious user and an artificial intelligence assistant. The assistant gives helpful, detailed, and polite answers to the user's questions. The assistant calls functions with appropriate input when necessary"""
@@ -1974,6 +2250,7 @@ def functionary_v1_v2_chat_handler(
             prompt += "all\n<|content|>"
 
         completion_or_completion_chunks = llama.create_completion(
+            stopping_criteria=stopping_criteria,
             prompt=prompt,
             temperature=temperature,
             top_p=top_p,
@@ -2037,6 +2314,7 @@ def functionary_v1_v2_chat_handler(
         completion = cast(
             llama_types.Completion,
             llama.create_completion(
+                stopping_criteria=stopping_criteria,
                 prompt=prompt,
                 temperature=temperature,
                 top_p=top_p,
@@ -2789,6 +3067,7 @@ class Llava15ChatHandler:
         logit_bias: Optional[Dict[str, float]] = None,
         logprobs: Optional[bool] = None,
         top_logprobs: Optional[int] = None,
+        stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
         **kwargs,  # type: ignore
     ) -> Union[
         llama_types.CreateChatCompletionResponse,
@@ -2908,6 +3187,7 @@ class Llava15ChatHandler:
                 )
 
         completion_or_chunks = llama.create_completion(
+            stopping_criteria=stopping_criteria,
             prompt=prompt,
             temperature=temperature,
             top_p=top_p,
@@ -3402,6 +3682,7 @@ def chatml_function_calling(
     grammar: Optional[llama.LlamaGrammar] = None,
     logprobs: Optional[bool] = None,
     top_logprobs: Optional[int] = None,
+    stopping_criteria: Optional[llama.StoppingCriteriaList] = None,
     **kwargs,  # type: ignore
 ) -> Union[
     llama_types.CreateChatCompletionResponse,
@@ -3512,6 +3793,7 @@ def chatml_function_calling(
 
         return _convert_completion_to_chat(
             llama.create_completion(
+                stopping_criteria=stopping_criteria,
                 prompt=prompt,
                 temperature=temperature,
                 top_p=top_p,
@@ -3565,6 +3847,7 @@ def chatml_function_calling(
                 )
                 print(e)
         completion_or_chunks = llama.create_completion(
+            stopping_criteria=stopping_criteria,
             prompt=prompt,
             temperature=temperature,
             top_p=top_p,
@@ -3609,6 +3892,7 @@ def chatml_function_calling(
         add_generation_prompt=True,
     )
     completion_or_chunks = llama.create_completion(
+        stopping_criteria=stopping_criteria,
         prompt=prompt,
         temperature=0,
         top_p=top_p,
@@ -3636,6 +3920,7 @@ def chatml_function_calling(
     if "message" in text:
         return _convert_completion_to_chat(
             llama.create_completion(
+                stopping_criteria=stopping_criteria,
                 prompt=prompt + "message:\n",
                 temperature=temperature,
                 top_p=top_p,
@@ -3684,6 +3969,7 @@ def chatml_function_calling(
                     )
                     print(e)
             completion_or_chunks = llama.create_completion(
+                stopping_criteria=stopping_criteria,
                 prompt=prompt,
                 temperature=temperature,
                 top_p=top_p,
@@ -3713,6 +3999,7 @@ def chatml_function_calling(
             prompt += "\n"
 
             response = llama.create_completion(
+                stopping_criteria=stopping_criteria,
                 prompt=prompt,
                 temperature=temperature,
                 top_p=top_p,
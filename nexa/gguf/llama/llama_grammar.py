@@ -1,11 +1,18 @@
 """Python implementation of llama grammar parser directly translated from C++ source file in vendor/llama.cpp/common/grammar-parser.cpp."""
 
 # flake8: noqa
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 
 from itertools import groupby
 from typing import (
     Any,
+    Callable,
+    Dict,
     Set,
     List,
     Optional,
@@ -16,6 +23,82 @@ from typing import (
 LLAMA_GRAMMAR_DEFAULT_ROOT = "root"
 
 
+class LlamaGrammarCache:
+    """Process-wide LRU cache of `LlamaGrammar` objects.
+
+    Keys are sha256 digests of the grammar source: GBNF text as is, JSON
+    schemas re-serialized without whitespace. The key order of a schema is
+    kept since it decides the order of the generated properties. The schema
+    text as sent is kept as an alias, so repeated requests skip the
+    re-serialization. Grammars are immutable, so one object is shared by all
+    requests using the same source. A capacity of 0 disables the cache.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self._grammars: "OrderedDict[str, LlamaGrammar]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.build_seconds = 0.0
+
+    @staticmethod
+    def key(kind: str, source: str) -> str:
+        return hashlib.sha256(f"{kind}\0{source}".encode("utf-8")).hexdigest()
+
+    def peek(self, key: str) -> Optional["LlamaGrammar"]:
+        """The cached grammar of `key`, or None without counting a miss."""
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+            return grammar
+
+    def put(self, key: str, grammar: "LlamaGrammar"):
+        with self._lock:
+            if self.capacity <= 0:
+                return
+            self._grammars[key] = grammar
+            self._grammars.move_to_end(key)
+            while len(self._grammars) > self.capacity:
+                self._grammars.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key: str, build: Callable[[], "LlamaGrammar"]) -> "LlamaGrammar":
+        grammar = self.peek(key)
+        if grammar is not None:
+            return grammar
+        # Build outside the lock, a concurrent miss on the same key only builds it twice
+        t_start = time.perf_counter()
+        grammar = build()
+        elapsed = time.perf_counter() - t_start
+        with self._lock:
+            self.misses += 1
+            self.build_seconds += elapsed
+        self.put(key, grammar)
+        return grammar
+
+    def clear(self):
+        with self._lock:
+            self._grammars.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._grammars),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "build_seconds": self.build_seconds,
+            }
+
+
+GRAMMAR_CACHE = LlamaGrammarCache()
+
+
 class LlamaGrammar:
     def __init__(self, *args, _grammar: str, **kwargs):
         self._grammar = _grammar
@@ -23,7 +106,9 @@ class LlamaGrammar:
 
     @classmethod
     def from_string(cls, grammar: str, verbose: bool = True) -> "LlamaGrammar":
-        return cls(_grammar=grammar)
+        return GRAMMAR_CACHE.get(
+            GRAMMAR_CACHE.key("gbnf", grammar), lambda: cls(_grammar=grammar)
+        )
 
     @classmethod
     def from_file(cls, file: Union[str, Path], verbose: bool = True) -> "LlamaGrammar":
@@ -44,7 +129,18 @@ class LlamaGrammar:
 
     @classmethod
     def from_json_schema(cls, json_schema: str, verbose: bool = True) -> "LlamaGrammar":
-        return cls.from_string(json_schema_to_gbnf(json_schema), verbose=verbose)
+        alias = GRAMMAR_CACHE.key("json_schema", json_schema)
+        grammar = GRAMMAR_CACHE.peek(alias)
+        if grammar is None:
+            canonical = json.dumps(
+                json.loads(json_schema), separators=(",", ":"), ensure_ascii=False
+            )
+            grammar = GRAMMAR_CACHE.get(
+                GRAMMAR_CACHE.key("json_schema", canonical),
+                lambda: cls(_grammar=json_schema_to_gbnf(canonical)),
+            )
+            GRAMMAR_CACHE.put(alias, grammar)
+        return grammar
 
 
 """llama.cpp gbnf rules from vendor/llama.cpp/grammars"""
@@ -0,0 +1,319 @@
+import os
+import mmap
+import struct
+
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import nexa.gguf.llama.llama_cpp as llama_cpp
+
+# KV cache types offered by the planner: ggml type and bytes per element
+KV_CACHE_TYPES: Dict[str, Tuple[int, float]] = {
+    "f16": (llama_cpp.GGML_TYPE_F16, 2.0),
+    "q8_0": (llama_cpp.GGML_TYPE_Q8_0, 34 / 32),
+    "q4_0": (llama_cpp.GGML_TYPE_Q4_0, 18 / 32),
+}
+
+# llama.cpp pads the context to a multiple of 256 cells
+N_CTX_PAD = 256
+
+# Compute buffers, the output buffer and the runtime, on top of weights and KV cache
+DEFAULT_RESERVE_BYTES = 512 << 20
+
+_GGUF_SCALARS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d",
+}
+_GGUF_STRING = 8
+_GGUF_ARRAY = 9
+
+
+def kv_cache_type(name: str) -> int:
+    """ggml type of a KV cache type name ("f16", "q8_0" or "q4_0").
+
+    Raises:
+        ValueError: If the name is unknown.
+    """
+    if name not in KV_CACHE_TYPES:
+        raise ValueError(f"Unknown KV cache type {name!r}, choose from {list(KV_CACHE_TYPES)}")
+    return KV_CACHE_TYPES[name][0]
+
+
+def read_gguf_metadata(path: str) -> Dict[str, Any]:
+    """Read the key-value metadata of a GGUF file without loading the model.
+
+    Numeric arrays are returned as lists. String arrays (the vocabulary and
+    merges) are returned as their number of elements, decoding them would
+    cost more than the rest of the header.
+
+    Raises:
+        ValueError: If the file is not a GGUF file.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if buf[:4] != b"GGUF":
+            raise ValueError(f"{path} is not a GGUF file")
+        (version,) = struct.unpack_from("<I", buf, 4)
+        # Version 1 used 32-bit counts
+        count = "<I" if version == 1 else "<Q"
+        offset = 8 + 2 * struct.calcsize(count)
+        (n_kv,) = struct.unpack_from(count, buf, 8 + struct.calcsize(count))
+
+        def read(fmt):
+            nonlocal offset
+            (value,) = struct.unpack_from(fmt, buf, offset)
+            offset += struct.calcsize(fmt)
+            return value
+
+        def read_string():
+            nonlocal offset
+            length = read(count)
+            value = buf[offset : offset + length].decode("utf-8", errors="replace")
+            offset += length
+            return value
+
+        def read_value(value_type):
+            nonlocal offset
+            if value_type in _GGUF_SCALARS:
+                return read(_GGUF_SCALARS[value_type])
+            if value_type == _GGUF_STRING:
+                return read_string()
+            if value_type != _GGUF_ARRAY:
+                raise ValueError(f"Unknown GGUF value type {value_type} in {path}")
+            item_type = read("<I")
+            n_items = read(count)
+            if item_type in _GGUF_SCALARS:
+                fmt = "<" + str(n_items) + _GGUF_SCALARS[item_type][1]
+                values = list(struct.unpack_from(fmt, buf, offset))
+                offset += struct.calcsize(fmt)
+                return values
+            if item_type == _GGUF_STRING:
+                for _ in range(n_items):
+                    offset += struct.unpack_from(count, buf, offset)[0] + struct.calcsize(count)
+                return n_items
+            return [read_value(item_type) for _ in range(n_items)]
+
+        metadata: Dict[str, Any] = {}
+        for _ in range(n_kv):
+            key = read_string()
+            metadata[key] = read_value(read("<I"))
+        return metadata
+
+
+@dataclass
+class LlamaModelDims:
+    """Dimensions of a model that size its KV cache."""
+
+    architecture: str
+    n_layer: int
+    n_head: List[int]
+    n_head_kv: List[int]
+    n_embd_head_k: int
+    n_embd_head_v: int
+    n_vocab: int
+    n_ctx_train: int
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any]) -> "LlamaModelDims":
+        """Read the dimensions from GGUF metadata.
+
+        Raises:
+            ValueError: If the model has no attention layers described in the metadata.
+        """
+        arch = metadata.get("general.architecture", "llama")
+
+        def get(key, default=None):
+            return metadata.get(f"{arch}.{key}", default)
+
+        n_layer = get("block_count")
+        n_head = get("attention.head_count")
+        n_embd = get("embedding_length")
+        if n_layer is None or not n_head or n_embd is None:
+            raise ValueError(f"The metadata of the {arch} model does not describe attention layers")
+
+        def per_layer(value):
+            return list(value) if isinstance(value, list) else [value] * n_layer
+
+        n_head = per_layer(n_head)
+        n_head_kv = per_layer(get("attention.head_count_kv", n_head))
+        head_dim = n_embd // max(n_head)
+        n_vocab = get("vocab_size", metadata.get("tokenizer.ggml.tokens", 0))
+        return cls(
+            architecture=arch,
+            n_layer=n_layer,
+            n_head=n_head,
+            n_head_kv=n_head_kv,
+            n_embd_head_k=get("attention.key_length", head_dim),
+            n_embd_head_v=get("attention.value_length", head_dim),
+            n_vocab=n_vocab if isinstance(n_vocab, int) else len(n_vocab),
+            n_ctx_train=get("context_length", 0),
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "LlamaModelDims":
+        return cls.from_metadata(read_gguf_metadata(path))
+
+    def kv_bytes_per_token(self, type_k: str = "f16", type_v: str = "f16") -> float:
+        """Bytes of K and V cache per context cell, summed over the layers."""
+        bytes_k = KV_CACHE_TYPES[type_k][1]
+        bytes_v = KV_CACHE_TYPES[type_v][1]
+        return sum(
+            n_kv * (self.n_embd_head_k * bytes_k + self.n_embd_head_v * bytes_v)
+            for n_kv in self.n_head_kv
+        )
+
+
+@dataclass
+class LlamaKVPlan:
+    """Context size, KV cache types and slot count picked by `plan_kv_cache`.
+
+    `n_ctx` is the total number of KV cells (the `n_ctx` of `Llama`), shared
+    by `n_slots` sequences of up to `n_ctx_per_slot` tokens. `kv_bytes`
+    also counts the logits kept per cell when planned with `logits_all`.
+    `candidates` lists, per KV type, the bytes per token and the largest
+    context fitting the budget.
+    """
+
+    n_ctx: int
+    n_slots: int
+    n_ctx_per_slot: int
+    type_k: str
+    type_v: str
+    flash_attn: bool
+    budget_bytes: int
+    weights_bytes: int
+    reserve_bytes: int
+    kv_bytes: int
+    decision: str
+    candidates: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def type_k_id(self) -> int:
+        return kv_cache_type(self.type_k)
+
+    @property
+    def type_v_id(self) -> int:
+        return kv_cache_type(self.type_v)
+
+    def report(self) -> str:
+        mib = 1 << 20
+        lines = [
+            f"KV plan: n_ctx={self.n_ctx} ({self.n_slots} x {self.n_ctx_per_slot}) "
+            f"type_k={self.type_k} type_v={self.type_v} flash_attn={self.flash_attn}",
+            f"  budget {self.budget_bytes / mib:.0f} MiB = weights {self.weights_bytes / mib:.0f} MiB "
+            f"+ KV {self.kv_bytes / mib:.0f} MiB + reserve {self.reserve_bytes / mib:.0f} MiB "
+            f"+ free {(self.budget_bytes - self.weights_bytes - self.kv_bytes - self.reserve_bytes) / mib:.0f} MiB",
+            f"  {self.decision}",
+        ]
+        for c in self.candidates:
+            lines.append(
+                f"  {c['type_k']:>5}/{c['type_v']:<5} {c['bytes_per_token'] / 1024:8.1f} KiB/token "
+                f"max n_ctx {c['max_n_ctx']}"
+            )
+        return "\n".join(lines)
+
+
+def available_memory() -> int:
+    """Memory available to new allocations (MemAvailable on Linux, free physical pages elsewhere)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def kv_type_candidates(flash_attn: bool) -> List[Tuple[str, str]]:
+    """KV cache types by decreasing precision; llama.cpp quantizes V only with flash attention."""
+    if flash_attn:
+        return [("f16", "f16"), ("q8_0", "q8_0"), ("q4_0", "q4_0")]
+    return [("f16", "f16"), ("q8_0", "f16"), ("q4_0", "f16")]
+
+
+def plan_kv_cache(
+    model_path: str,
+    memory_budget: Optional[int] = None,
+    n_ctx: Optional[int] = None,
+    n_slots: int = 1,
+    flash_attn: bool = False,
+    logits_all: bool = False,
+    kv_types: Optional[Sequence[Tuple[str, str]]] = None,
+    reserve: int = DEFAULT_RESERVE_BYTES,
+    min_ctx: int = 512,
+    dims: Optional[LlamaModelDims] = None,
+) -> LlamaKVPlan:
+    """Pick the context size, KV cache types and slot count that fit `model_path` in `memory_budget` bytes.
+
+    The budget holds the weights (the size of the file), the KV cache,
+    `reserve` bytes for compute buffers and, with `logits_all`, the logits
+    kept for every cell. The wanted context is `n_slots` slots of `n_ctx`
+    tokens (default: the training context). The most precise of `kv_types`
+    (default: `kv_type_candidates(flash_attn)`) fitting all of it is used.
+    Otherwise the most compact type is used with fewer slots, and the
+    context of a single slot shrinks as a last resort.
+
+    Raises:
+        ValueError: If not even `min_ctx` tokens fit the budget.
+    """
+    dims = dims or LlamaModelDims.from_file(model_path)
+    budget = memory_budget if memory_budget is not None else available_memory()
+    weights = os.path.getsize(model_path)
+    n_ctx = n_ctx or dims.n_ctx_train or 4096
+    n_slots = max(n_slots, 1)
+    kv_types = list(kv_types or kv_type_candidates(flash_attn))
+    logits_per_token = 4 * dims.n_vocab if logits_all else 0
+    free = budget - weights - reserve
+
+    candidates = []
+    for type_k, type_v in kv_types:
+        per_token = dims.kv_bytes_per_token(type_k, type_v) + logits_per_token
+        max_n_ctx = max(int(free // per_token) // N_CTX_PAD * N_CTX_PAD, 0)
+        candidates.append(
+            {"type_k": type_k, "type_v": type_v, "bytes_per_token": per_token, "max_n_ctx": max_n_ctx}
+        )
+
+    wanted = n_ctx * n_slots
+    for candidate in candidates:
+        if candidate["max_n_ctx"] >= wanted:
+            chosen, slots, slot_ctx = candidate, n_slots, n_ctx
+            decision = f"{n_slots} x {n_ctx} tokens fit with {chosen['type_k']}/{chosen['type_v']}"
+            break
+    else:
+        chosen = max(candidates, key=lambda c: c["max_n_ctx"])
+        max_n_ctx = chosen["max_n_ctx"]
+        if max_n_ctx < min_ctx:
+            raise ValueError(
+                f"The model needs {weights / (1 << 20):.0f} MiB for weights and "
+                f"{chosen['bytes_per_token'] * min_ctx / (1 << 20):.0f} MiB for a {min_ctx} token KV cache, "
+                f"more than the {budget / (1 << 20):.0f} MiB budget"
+            )
+        if max_n_ctx >= n_ctx:
+            slots, slot_ctx = max_n_ctx // n_ctx, n_ctx
+            decision = f"{n_slots} x {n_ctx} tokens do not fit, {slots} slots with {chosen['type_k']}/{chosen['type_v']}"
+        else:
+            slots, slot_ctx = 1, max_n_ctx
+            decision = f"{n_ctx} tokens do not fit, 1 slot of {max_n_ctx} with {chosen['type_k']}/{chosen['type_v']}"
+
+    total = slots * slot_ctx
+    return LlamaKVPlan(
+        n_ctx=total,
+        n_slots=slots,
+        n_ctx_per_slot=slot_ctx,
+        type_k=chosen["type_k"],
+        type_v=chosen["type_v"],
+        flash_attn=flash_attn,
+        budget_bytes=budget,
+        weights_bytes=weights,
+        reserve_bytes=reserve,
+        kv_bytes=int(chosen["bytes_per_token"] * total),
+        decision=decision,
+        candidates=candidates,
+    )
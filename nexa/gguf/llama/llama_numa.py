@@ -0,0 +1,136 @@
+import os
+import sys
+import ctypes
+import platform
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+_NODE_ROOT = "/sys/devices/system/node"
+_CPU_ROOT = "/sys/devices/system/cpu"
+
+# set_mempolicy(2) is not wrapped by glibc, it is called by number
+_SYS_SET_MEMPOLICY = {"x86_64": 238, "aarch64": 237, "arm64": 237}
+_MPOL_BIND = 2
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Parse a kernel CPU list such as "0-3,8,10-11"."""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _read_cpu_list(path: str) -> Optional[List[int]]:
+    try:
+        with open(path) as f:
+            return parse_cpu_list(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def numa_nodes() -> Dict[int, List[int]]:
+    """CPUs of each NUMA node with CPUs, a single node 0 with all CPUs when the topology is unknown."""
+    nodes: Dict[int, List[int]] = {}
+    if os.path.isdir(_NODE_ROOT):
+        for name in os.listdir(_NODE_ROOT):
+            if name.startswith("node") and name[4:].isdigit():
+                cpus = _read_cpu_list(os.path.join(_NODE_ROOT, name, "cpulist"))
+                if cpus:
+                    nodes[int(name[4:])] = cpus
+    if not nodes:
+        nodes[0] = list(range(os.cpu_count() or 1))
+    return dict(sorted(nodes.items()))
+
+
+def physical_core_cpus(cpus: List[int]) -> List[int]:
+    """Keep the first hardware thread of each physical core among `cpus`."""
+    allowed = set(cpus)
+    kept = []
+    for cpu in cpus:
+        siblings = _read_cpu_list(
+            os.path.join(_CPU_ROOT, f"cpu{cpu}", "topology", "thread_siblings_list")
+        )
+        if not siblings or min(s for s in siblings if s in allowed or s == cpu) == cpu:
+            kept.append(cpu)
+    return kept
+
+
+def numa_node_cpus(node: int, physical_cores: bool = True) -> List[int]:
+    """CPUs of `node` usable by this process, one per physical core if `physical_cores`.
+
+    Raises:
+        ValueError: If the node does not exist or none of its CPUs are usable.
+    """
+    nodes = numa_nodes()
+    if node not in nodes:
+        raise ValueError(f"NUMA node {node} does not exist, nodes with CPUs: {sorted(nodes)}")
+    cpus = nodes[node]
+    if hasattr(os, "sched_getaffinity"):
+        allowed = os.sched_getaffinity(0)
+        cpus = [cpu for cpu in cpus if cpu in allowed]
+    if not cpus:
+        raise ValueError(f"No CPU of NUMA node {node} is usable by this process")
+    return physical_core_cpus(cpus) if physical_cores else cpus
+
+
+def pin_process(cpus: List[int]):
+    """Restrict every thread of the process to `cpus`, threads created later inherit it.
+
+    Raises:
+        OSError: If the platform does not support CPU affinity.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        raise OSError(f"CPU affinity is not supported on {sys.platform}")
+    for tid in os.listdir("/proc/self/task"):
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except (ProcessLookupError, ValueError):
+            # Thread exited meanwhile
+            pass
+
+
+def bind_memory(node: int) -> bool:
+    """Allocate the memory of the calling thread, and of the threads it creates, on `node` only.
+
+    Returns:
+        Whether the policy was set; False on kernels or architectures without set_mempolicy.
+    """
+    number = _SYS_SET_MEMPOLICY.get(platform.machine().lower())
+    if number is None or sys.platform != "linux":
+        return False
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (node // bits + 1))()
+    mask[node // bits] = 1 << (node % bits)
+    libc = ctypes.CDLL(None, use_errno=True)
+    # The kernel reads maxnode - 1 bits of the mask
+    return (
+        libc.syscall(
+            ctypes.c_long(number), ctypes.c_long(_MPOL_BIND), mask, ctypes.c_ulong(len(mask) * bits + 1)
+        )
+        == 0
+    )
+
+
+def pin_numa_node(node: int, physical_cores: bool = True, membind: bool = True) -> List[int]:
+    """Run the process on the cores of `node` and allocate from its memory, like `numactl -N node -m node`.
+
+    Memory is bound for the calling thread, which should be the one loading
+    the model. Pages already in the page cache stay where they are, so load
+    with `use_mmap=False` to get a node-local copy of shared weights.
+
+    Returns:
+        The CPUs the process is pinned to.
+    """
+    cpus = numa_node_cpus(node, physical_cores=physical_cores)
+    pin_process(cpus)
+    if membind and not bind_memory(node):
+        print(f"Could not bind memory to NUMA node {node}, using first-touch allocation", file=sys.stderr)
+    return cpus
@@ -0,0 +1,493 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import tempfile
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
+import numpy.typing as npt
+
+import nexa.gguf.llama.llama
+
+# Llama.generate and Llama.eval always work on this sequence
+WORKING_SEQ_ID = 0
+
+
+@dataclass
+class LlamaSessionStats:
+    """Prefix reuse statistics of a chat session."""
+
+    requests: int = 0
+    prompt_tokens: int = 0
+    prefix_hit_tokens: int = 0
+    last_prefix_hit: int = 0
+    evictions: int = 0
+    spills: int = 0
+    restores: int = 0
+
+    @property
+    def prefilled_tokens(self) -> int:
+        return self.prompt_tokens - self.prefix_hit_tokens
+
+
+class LlamaSessionStore:
+    """Size-bounded spill directory for the KV state of idle chat sessions.
+
+    Each file holds the state of one sequence (`llama_state_seq_get_data`),
+    compressed with zstd or lz4 (zlib if neither is installed), and is keyed by a hash of the tokens it
+    covers. A small `sessions.json` index maps session ids to those keys, so
+    spilled sessions survive a restart. When the directory grows beyond
+    `capacity_bytes` the least recently used files are removed.
+
+    The directory must only be shared between processes running the same model
+    file, the saved state is not portable across models.
+    """
+
+    MAGIC = b"NXKV"
+    INDEX_FILE = "sessions.json"
+    COMPRESSIONS = ("zstd", "lz4", "zlib", "none")
+
+    def __init__(
+        self,
+        directory: str,
+        capacity_bytes: int = (2 << 30),
+        compression: Optional[str] = None,
+    ):
+        if compression is None:
+            compression = self.default_compression()
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression!r}, expected one of {self.COMPRESSIONS}"
+            )
+        self.directory = directory
+        self.capacity_bytes = capacity_bytes
+        self.compression = compression
+        self._compress, _ = self._codec(compression)
+        os.makedirs(directory, exist_ok=True)
+        self._sessions: Dict[str, str] = self._read_index()
+        # Drop index entries whose files were removed behind our back
+        self._sessions = {
+            session_id: key
+            for session_id, key in self._sessions.items()
+            if os.path.exists(self._path(key))
+        }
+
+    @staticmethod
+    def default_compression() -> str:
+        for compression, module in (("zstd", "zstandard"), ("lz4", "lz4.frame")):
+            try:
+                __import__(module)
+                return compression
+            except ImportError:
+                continue
+        return "zlib"
+
+    @staticmethod
+    def _codec(compression: str):
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError(
+                    "zstd compression requires the zstandard package. "
+                    "You can install it with `pip install zstandard`."
+                )
+            return (
+                lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data),
+            )
+        if compression == "lz4":
+            try:
+                import lz4.frame
+            except ImportError:
+                raise ImportError(
+                    "lz4 compression requires the lz4 package. "
+                    "You can install it with `pip install lz4`."
+                )
+            return lz4.frame.compress, lz4.frame.decompress
+        if compression == "zlib":
+            return (lambda data: zlib.compress(data, 1)), zlib.decompress
+        return bytes, bytes
+
+    @property
+    def cache_size(self) -> int:
+        return sum(os.path.getsize(path) for path in self._files())
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def save(self, session_id: str, tokens: npt.NDArray[np.intc], state: bytes):
+        """Write the sequence `state` covering `tokens` for `session_id`."""
+        tokens = np.ascontiguousarray(tokens, dtype=np.intc)
+        key = hashlib.sha1(tokens.tobytes()).hexdigest()
+        payload = self._compress(state)
+        header = json.dumps(
+            {
+                "compression": self.compression,
+                "n_tokens": int(tokens.shape[0]),
+                "state_size": len(state),
+            }
+        ).encode("utf-8")
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.MAGIC)
+                f.write(struct.pack("<I", len(header)))
+                f.write(header)
+                f.write(tokens.tobytes())
+                f.write(payload)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        previous = self._sessions.get(session_id)
+        self._sessions[session_id] = key
+        if previous is not None and previous != key:
+            self._remove_if_unreferenced(previous)
+        self._enforce_capacity(keep=key)
+        self._write_index()
+
+    def load(self, session_id: str) -> Optional[Tuple[npt.NDArray[np.intc], bytes]]:
+        """Return `(tokens, state)` for `session_id`, or None if it was never spilled."""
+        key = self._sessions.get(session_id)
+        if key is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                if f.read(4) != self.MAGIC:
+                    raise ValueError(f"Not a session state file: {path}")
+                (header_size,) = struct.unpack("<I", f.read(4))
+                header = json.loads(f.read(header_size).decode("utf-8"))
+                tokens = np.frombuffer(
+                    f.read(header["n_tokens"] * np.dtype(np.intc).itemsize),
+                    dtype=np.intc,
+                ).copy()
+                payload = f.read()
+            if tokens.shape[0] != header["n_tokens"]:
+                raise ValueError(f"Truncated session state file: {path}")
+            _, decompress = self._codec(header["compression"])
+            state = decompress(payload)
+            if len(state) != header["state_size"]:
+                raise ValueError(f"Truncated session state file: {path}")
+        except Exception:
+            # Truncated or corrupt files (struct, codec errors) and codecs missing since the spill,
+            # the session is prefilled again instead
+            self.discard(session_id)
+            return None
+        os.utime(path)  # mtime is the LRU clock
+        return tokens, state
+
+    def discard(self, session_id: str):
+        key = self._sessions.pop(session_id, None)
+        if key is None:
+            return
+        self._remove_if_unreferenced(key)
+        self._write_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.kvs")
+
+    def _files(self) -> List[str]:
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".kvs")
+        ]
+
+    def _remove_if_unreferenced(self, key: str):
+        if key in self._sessions.values():
+            return
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _enforce_capacity(self, keep: str):
+        files = sorted(self._files(), key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.capacity_bytes:
+                break
+            key = os.path.basename(path)[: -len(".kvs")]
+            if key == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self._sessions = {
+                session_id: k for session_id, k in self._sessions.items() if k != key
+            }
+
+    def _read_index(self) -> Dict[str, str]:
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE), "r") as f:
+                return dict(json.load(f))
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._sessions, f)
+        os.replace(tmp_path, os.path.join(self.directory, self.INDEX_FILE))
+
+
+@dataclass
+class _SessionSlot:
+    seq_id: int
+    # None while the session is active, i.e. its state lives in the working sequence
+    tokens: Optional[npt.NDArray[np.intc]] = None
+
+
+class LlamaSessionSlots:
+    """Keep the KV state of several chat sessions resident in one llama.cpp context.
+
+    The working sequence (0) is the one `Llama.generate` prefix-matches against.
+    Every known session additionally owns a sequence id in `1..n_slots`. When a
+    different session becomes active, the working sequence is copied into the
+    previous session's slot and the new session's slot is copied into the
+    working sequence. In the unified KV cache `llama_kv_cache_seq_cp` only tags
+    the existing cells, so switching sessions costs no recomputation and the
+    next request only prefills the new turn.
+
+    Slots are evicted least-recently-used first, either when all slots are taken,
+    when the parked sessions would hold more than `max_parked_tokens` cells, or
+    when a completion needs more cells than the parked sessions leave free
+    (`Llama.on_kv_request`).
+    With a `store`, evicted sessions are spilled to disk and restored from there
+    with `llama_state_seq_set_data` when they come back, instead of re-prefilled.
+
+    The Llama instance must be created with `n_seq_max >= n_slots + 1`.
+    Anything that clears the whole KV cache (e.g. `Llama.embed`) invalidates
+    the parked sessions, call `reset()` afterwards.
+
+    A parked session shares the cells of its common prefix with the working
+    sequence, and a context shift of the working sequence moves the positions
+    of every sequence in a cell. Before a shift, the parked sessions sharing
+    the moved cells are evicted (spilled with a `store`).
+    """
+
+    def __init__(
+        self,
+        llama: "nexa.gguf.llama.Llama",
+        n_slots: Optional[int] = None,
+        max_parked_tokens: Optional[int] = None,
+        store: Optional[LlamaSessionStore] = None,
+    ):
+        n_seq_max = llama.context_params.n_seq_max
+        if n_slots is None:
+            n_slots = n_seq_max - 1
+        if n_slots < 1 or n_slots >= n_seq_max:
+            raise ValueError(
+                f"n_slots={n_slots} requires Llama(n_seq_max={n_slots + 1}), got n_seq_max={n_seq_max}"
+            )
+        self.llama = llama
+        self.store = store
+        self.n_slots = n_slots
+        self.max_parked_tokens = (
+            max_parked_tokens if max_parked_tokens is not None else llama.n_ctx() // 2
+        )
+        self._slots: "OrderedDict[str, _SessionSlot]" = OrderedDict()
+        self._free_seq_ids: List[int] = list(range(n_slots, 0, -1))
+        self._active: Optional[str] = None
+        self._stats: Dict[str, LlamaSessionStats] = {}
+        llama.on_context_shift = self._detach_working
+        llama.on_kv_request = self._make_room
+
+    @property
+    def active_session(self) -> Optional[str]:
+        return self._active
+
+    @property
+    def parked_tokens(self) -> int:
+        return sum(
+            len(slot.tokens) for slot in self._slots.values() if slot.tokens is not None
+        )
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._slots
+
+    def activate(self, session_id: Optional[str]) -> int:
+        """Make `session_id` the owner of the working sequence.
+
+        Must be called before each request. `None` parks the active session
+        and leaves the working sequence to an anonymous request.
+
+        Returns:
+            The number of tokens restored into the working sequence.
+        """
+        self._collect_stats()
+        if session_id is not None and session_id == self._active:
+            self._slots.move_to_end(session_id)
+            return self.llama.n_tokens
+
+        self._park_active()
+
+        if session_id is None:
+            return 0
+
+        self._stats.setdefault(session_id, LlamaSessionStats())
+        slot = self._slots.get(session_id)
+        if slot is None:
+            slot = _SessionSlot(seq_id=self._allocate_seq_id())
+            self._slots[session_id] = slot
+            self._active = session_id
+            restored = self._restore_spilled(session_id)
+            if restored is not None:
+                return restored
+            # A new session starts from whatever is in the working sequence,
+            # so a shared system prompt is still reused by the prefix match.
+            return self.llama.n_tokens
+
+        self._slots.move_to_end(session_id)
+        restored = self._restore(slot)
+        self._active = session_id
+        return restored
+
+    def evict(self, session_id: str, spill: bool = True):
+        """Drop the KV state held for `session_id`, spilling it to the store first."""
+        slot = self._slots.pop(session_id, None)
+        if slot is None:
+            return
+        stats = self._stats.setdefault(session_id, LlamaSessionStats())
+        stats.evictions += 1
+        if session_id == self._active:
+            seq_id, tokens = WORKING_SEQ_ID, self.llama.input_ids[: self.llama.n_tokens]
+            self._active = None
+        else:
+            seq_id, tokens = slot.seq_id, slot.tokens
+        if spill and self.store is not None and tokens is not None and len(tokens) > 0:
+            self.store.save(session_id, tokens, self.llama._ctx.get_seq_state_data(seq_id))
+            stats.spills += 1
+        if seq_id != WORKING_SEQ_ID:
+            self.llama._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        self._free_seq_ids.append(slot.seq_id)
+
+    def spill_all(self):
+        """Spill every resident session to the store, e.g. before shutting down."""
+        for session_id in list(self._slots):
+            self.evict(session_id, spill=True)
+
+    def reset(self):
+        """Forget all sessions, e.g. after the KV cache was cleared externally."""
+        for session_id in list(self._slots):
+            self.evict(session_id, spill=False)
+        self._active = None
+
+    def stats(self, session_id: Optional[str] = None):
+        """Return the stats of one session, or a dict of all sessions."""
+        self._collect_stats()
+        if session_id is not None:
+            return self._stats.get(session_id)
+        return dict(self._stats)
+
+    def _allocate_seq_id(self) -> int:
+        if not self._free_seq_ids:
+            lru = next(iter(self._slots))
+            self.evict(lru)
+        return self._free_seq_ids.pop()
+
+    def _park_active(self):
+        if self._active is None:
+            return
+        slot = self._slots[self._active]
+        ctx = self.llama._ctx
+        n_tokens = self.llama.n_tokens
+        ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+        ctx.kv_cache_seq_cp(WORKING_SEQ_ID, slot.seq_id, 0, n_tokens)
+        slot.tokens = self.llama.input_ids[:n_tokens].copy()
+        self._active = None
+        self._evict_parked(self.max_parked_tokens)
+
+    def _evict_parked(self, max_tokens: int):
+        """Evict parked sessions, least recently used first, until they hold at most `max_tokens` cells."""
+        while self.parked_tokens > max_tokens:
+            lru = next(
+                session_id
+                for session_id, slot in self._slots.items()
+                if slot.tokens is not None
+            )
+            self.evict(lru)
+
+    def _make_room(self, n_cells: int):
+        """Leave `n_cells` cells of the KV cache to the working sequence."""
+        # Prefixes shared with the working sequence are counted twice, so this
+        # may evict a session more than needed but never leaves too few cells
+        self._evict_parked(self.llama.n_ctx() - n_cells)
+
+    def _detach_working(self, pos: int):
+        """Evict the parked sessions sharing cells from `pos` on with the working sequence."""
+        working = self.llama.input_ids[: self.llama.n_tokens]
+        for session_id, slot in list(self._slots.items()):
+            # Cells are only shared within the common prefix, the rest was decoded apart
+            if (
+                slot.tokens is not None
+                and min(len(slot.tokens), len(working)) > pos
+                and np.array_equal(slot.tokens[: pos + 1], working[: pos + 1])
+            ):
+                self.evict(session_id)
+
+    def _restore(self, slot: _SessionSlot) -> int:
+        assert slot.tokens is not None
+        ctx = self.llama._ctx
+        n_tokens = len(slot.tokens)
+        ctx.kv_cache_seq_rm(WORKING_SEQ_ID, -1, -1)
+        ctx.kv_cache_seq_cp(slot.seq_id, WORKING_SEQ_ID, 0, n_tokens)
+        # The working sequence now owns the cells, release the parked copy
+        ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+        self.llama.input_ids[:n_tokens] = slot.tokens
+        self.llama.n_tokens = n_tokens
+        slot.tokens = None
+        return n_tokens
+
+    def _restore_spilled(self, session_id: str) -> Optional[int]:
+        if self.store is None:
+            return None
+        spilled = self.store.load(session_id)
+        if spilled is None:
+            return None
+        tokens, state = spilled
+        ctx = self.llama._ctx
+        ctx.kv_cache_seq_rm(WORKING_SEQ_ID, -1, -1)
+        if len(tokens) > self.llama.n_ctx() or not ctx.set_seq_state_data(
+            state, WORKING_SEQ_ID
+        ):
+            # No room in the KV cache (or a stale file), fall back to prefill
+            ctx.kv_cache_seq_rm(WORKING_SEQ_ID, -1, -1)
+            self.llama.n_tokens = 0
+            self.store.discard(session_id)
+            return None
+        n_tokens = len(tokens)
+        self.llama.input_ids[:n_tokens] = tokens
+        self.llama.n_tokens = n_tokens
+        self._stats[session_id].restores += 1
+        return n_tokens
+
+    def _collect_stats(self):
+        # Requests are generated lazily (streaming), so the prefix match of the
+        # active session's last request is picked up here rather than in activate.
+        last = self.llama.last_prefix_match
+        if last is None:
+            return
+        self.llama.last_prefix_match = None
+        if self._active is None:
+            return
+        prompt_tokens, prefix_hit = last
+        stats = self._stats[self._active]
+        stats.requests += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.prefix_hit_tokens += prefix_hit
+        stats.last_prefix_hit = prefix_hit
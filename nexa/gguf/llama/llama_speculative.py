@@ -1,6 +1,10 @@
+import os
 import abc
+import sys
+import tempfile
 
-from typing import Any
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import numpy.typing as npt
@@ -13,6 +17,25 @@ class LlamaDraftModel(abc.ABC):
     ) -> npt.NDArray[np.intc]:
         raise NotImplementedError()
 
+    def draft_distributions(
+        self,
+    ) -> Optional[List[Tuple[npt.NDArray[np.intc], npt.NDArray[np.single]]]]:
+        """Sparse `(token ids, probabilities)` the last drafted tokens were sampled from.
+
+        Returning None (the default) means the draft is deterministic, in which
+        case the target accepts a drafted token iff its own sample matches it.
+        Otherwise `Llama.generate` verifies the draft by rejection sampling.
+        """
+        return None
+
+    def update(self, n_drafted: int, n_accepted: int) -> None:
+        """Called by `Llama.generate` after verifying a draft of `n_drafted` tokens."""
+        pass
+
+    def begin(self, n_prompt_tokens: int) -> None:
+        """Called by `Llama.generate` before a generation, the context holds `n_prompt_tokens` prompt tokens."""
+        pass
+
 
 class LlamaPromptLookupDecoding(LlamaDraftModel):
     """Based on https://github.com/apoorvumang/prompt-lookup-decoding"""
@@ -62,3 +85,495 @@ class LlamaPromptLookupDecoding(LlamaDraftModel):
             max_ngram_size=self.max_ngram_size,
             num_pred_tokens=self.num_pred_tokens,
         )
+
+
+class LlamaGGUFDraftModel(LlamaDraftModel):
+    """Speculative decoding with a second, smaller GGUF model sharing the target's vocabulary.
+
+    The draft model keeps its own KV cache, which is synced with the target's
+    tokens by prefix match on every call, so rejected draft tokens are rolled
+    back implicitly. The draft length adapts to the observed acceptance rate:
+    with a per-token acceptance rate `a` the expected run of accepted tokens is
+    `a / (1 - a)`, which is what gets drafted next (within `min_pred_tokens`
+    and `max_pred_tokens`). Past the draft's own context, it drafts from a
+    window of the most recent tokens.
+
+    Args:
+        model_path: Path to the draft GGUF model.
+        num_pred_tokens: Initial draft length.
+        min_pred_tokens: Lower bound of the adaptive draft length.
+        max_pred_tokens: Upper bound of the adaptive draft length.
+        acceptance: "greedy" drafts the argmax token, the target accepts it when
+            its own sample matches. "rejection" samples the draft from the top
+            `top_k` tokens at temperature `temp` and lets the target accept by
+            rejection sampling, which keeps the target's output distribution.
+        p_min: Stop drafting early when the draft's probability of its greedy
+            token falls below this value (0 disables the check).
+        adapt_decay: Decay of the acceptance statistics, closer to 1 is smoother.
+        **kwargs: Passed to the draft `Llama`, e.g. `n_ctx` or `n_gpu_layers`.
+    """
+
+    ACCEPTANCE_MODES = ("greedy", "rejection")
+
+    def __init__(
+        self,
+        model_path: str,
+        num_pred_tokens: int = 8,
+        min_pred_tokens: int = 1,
+        max_pred_tokens: int = 16,
+        acceptance: str = "greedy",
+        top_k: int = 40,
+        temp: float = 0.8,
+        p_min: float = 0.0,
+        adapt_decay: float = 0.9,
+        seed: Optional[int] = None,
+        **kwargs: Any,
+    ):
+        # Imported here, llama.py imports this module
+        from nexa.gguf.llama.llama import Llama
+
+        if acceptance not in self.ACCEPTANCE_MODES:
+            raise ValueError(
+                f"Unknown acceptance {acceptance!r}, expected one of {self.ACCEPTANCE_MODES}"
+            )
+        kwargs.setdefault("verbose", False)
+        kwargs.setdefault("n_ctx", 2048)
+        self.llama = Llama(model_path=model_path, logits_all=False, **kwargs)
+        self.n_vocab = self.llama.n_vocab()
+        self.num_pred_tokens = num_pred_tokens
+        self.min_pred_tokens = min_pred_tokens
+        self.max_pred_tokens = max_pred_tokens
+        self.acceptance = acceptance
+        self.top_k = top_k
+        self.temp = temp
+        self.p_min = p_min
+        self.adapt_decay = adapt_decay
+        self._rng = np.random.default_rng(seed)
+        self._distributions: Optional[
+            List[Tuple[npt.NDArray[np.intc], npt.NDArray[np.single]]]
+        ] = None
+        # Decayed counts of accepted tokens and verification trials
+        self._n_accepted = 0.0
+        self._n_trials = 0.0
+        self.n_drafted_total = 0
+        self.n_accepted_total = 0
+        self._disabled_reported = False
+
+    @property
+    def acceptance_rate(self) -> float:
+        """Smoothed per-token acceptance rate of the recent drafts."""
+        if self._n_trials == 0:
+            return 0.0
+        return self._n_accepted / self._n_trials
+
+    def draft_distributions(self):
+        return self._distributions
+
+    def update(self, n_drafted: int, n_accepted: int) -> None:
+        if n_drafted <= 0:
+            return
+        self.n_drafted_total += n_drafted
+        self.n_accepted_total += n_accepted
+        # Verification stops at the first rejection, so a full acceptance is
+        # n_drafted successes and anything else is n_accepted successes + 1 failure
+        n_trials = n_accepted if n_accepted == n_drafted else n_accepted + 1
+        self._n_accepted = self.adapt_decay * self._n_accepted + n_accepted
+        self._n_trials = self.adapt_decay * self._n_trials + n_trials
+
+        rate = self.acceptance_rate
+        expected_run = rate / (1.0 - rate) if rate < 1.0 else float(self.max_pred_tokens)
+        self.num_pred_tokens = int(
+            min(max(round(expected_run) + 1, self.min_pred_tokens), self.max_pred_tokens)
+        )
+
+    def _sync(self, input_ids: npt.NDArray[np.intc]):
+        llama = self.llama
+        n_common = min(llama.n_tokens, len(input_ids))
+        mismatch = np.nonzero(llama.input_ids[:n_common] != input_ids[:n_common])[0]
+        n_prefix = int(mismatch[0]) if len(mismatch) > 0 else n_common
+        # Re-evaluate at least one token to get fresh logits for the last position
+        n_prefix = min(n_prefix, len(input_ids) - 1)
+        new_tokens = input_ids[n_prefix:]
+        if len(new_tokens) > 0 and int(new_tokens.max()) >= self.n_vocab:
+            raise ValueError("The draft model does not share the target model's vocabulary")
+        llama.n_tokens = n_prefix
+        llama.eval(new_tokens.tolist())
+
+    def _window_start(self, n_input: int) -> Optional[int]:
+        """First token of the context fed to the draft model, None if its context is too small to draft.
+
+        The window moves by half its size at a time, so the draft's KV cache is
+        re-prefilled once per half window instead of on every call.
+        """
+        limit = self.llama.n_ctx() - self.max_pred_tokens
+        if limit < 2:
+            return None
+        if n_input <= limit:
+            return 0
+        step = max(limit // 2, 1)
+        return -(-(n_input - limit) // step) * step
+
+    def _next_token(self, logits: npt.NDArray[np.single]) -> Optional[int]:
+        if self.acceptance == "greedy":
+            token = int(np.argmax(logits))
+            if self.p_min > 0.0:
+                shifted = np.exp(logits - logits[token])
+                if 1.0 / shifted.sum() < self.p_min:
+                    return None
+            return token
+
+        k = min(self.top_k, self.n_vocab) if self.top_k > 0 else self.n_vocab
+        ids = np.argpartition(logits, -k)[-k:].astype(np.intc)
+        scaled = logits[ids] / max(self.temp, 1e-5)
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+        token = int(self._rng.choice(ids, p=probs))
+        assert self._distributions is not None
+        self._distributions.append((ids, probs.astype(np.single)))
+        return token
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        llama = self.llama
+        self._distributions = [] if self.acceptance == "rejection" else None
+        start = self._window_start(len(input_ids))
+        if start is None:
+            if not self._disabled_reported:
+                self._disabled_reported = True
+                print(
+                    f"Speculative decoding disabled: the draft context ({llama.n_ctx()}) "
+                    f"cannot hold {self.max_pred_tokens} drafted tokens",
+                    file=sys.stderr,
+                )
+            return np.array([], dtype=np.intc)
+        input_ids = input_ids[start:]
+        n_pred = min(self.num_pred_tokens, llama.n_ctx() - len(input_ids))
+        if n_pred <= 0 or len(input_ids) == 0:
+            return np.array([], dtype=np.intc)
+
+        self._sync(input_ids)
+        draft: List[int] = []
+        for i in range(n_pred):
+            logits = np.ctypeslib.as_array(
+                llama._ctx.get_logits_ith(-1), shape=(self.n_vocab,)
+            )
+            token = self._next_token(logits)
+            if token is None:
+                break
+            draft.append(token)
+            if i < n_pred - 1:
+                llama.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+    def close(self):
+        self.llama.close()
+
+
+class LlamaPromptLookupIndex(LlamaDraftModel):
+    """Prompt lookup decoding backed by an incremental n-gram index.
+
+    Unlike `LlamaPromptLookupDecoding`, which rescans the whole context for
+    every n-gram size on every call, this keeps a hash index from each n-gram
+    (sizes 1..`max_ngram_size`) to the positions that followed it and the
+    counts of the tokens that followed it. New tokens are indexed as they are
+    accepted and un-indexed when the target rolls them back, so a lookup is a
+    dict access regardless of the context length.
+
+    Args:
+        max_ngram_size: Longest n-gram to match, longer matches are preferred.
+        num_pred_tokens: Number of tokens to draft.
+        continuation: "recent" copies what followed the most recent occurrence
+            of the n-gram, "frequent" chains the most frequent next token.
+    """
+
+    CONTINUATIONS = ("recent", "frequent")
+
+    def __init__(
+        self,
+        max_ngram_size: int = 3,
+        num_pred_tokens: int = 10,
+        continuation: str = "recent",
+    ):
+        if continuation not in self.CONTINUATIONS:
+            raise ValueError(
+                f"Unknown continuation {continuation!r}, expected one of {self.CONTINUATIONS}"
+            )
+        self.max_ngram_size = max_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+        self.continuation = continuation
+        self._tokens: List[int] = []
+        # Mirror of _tokens for vectorized comparisons in sync
+        self._buffer = np.zeros(1024, dtype=np.intc)
+        # n-gram -> positions of the tokens that followed it, oldest first
+        self._positions: Dict[Tuple[int, ...], List[int]] = {}
+        # n-gram -> next token -> count
+        self._counts: Dict[Tuple[int, ...], Dict[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def reset(self):
+        self._tokens.clear()
+        self._positions.clear()
+        self._counts.clear()
+
+    def append(self, token: int):
+        """Index `token` as the next token of the context."""
+        tokens = self._tokens
+        pos = len(tokens)
+        for n in range(1, min(self.max_ngram_size, pos) + 1):
+            key = tuple(tokens[pos - n : pos])
+            self._positions.setdefault(key, []).append(pos)
+            counts = self._counts.setdefault(key, {})
+            counts[token] = counts.get(token, 0) + 1
+        tokens.append(token)
+        if pos >= len(self._buffer):
+            self._buffer = np.concatenate([self._buffer, np.zeros_like(self._buffer)])
+        self._buffer[pos] = token
+
+    def pop(self):
+        """Un-index the last token of the context."""
+        tokens = self._tokens
+        token = tokens.pop()
+        pos = len(tokens)
+        for n in range(1, min(self.max_ngram_size, pos) + 1):
+            key = tuple(tokens[pos - n : pos])
+            positions = self._positions[key]
+            positions.pop()
+            if not positions:
+                del self._positions[key]
+            counts = self._counts[key]
+            counts[token] -= 1
+            if counts[token] == 0:
+                del counts[token]
+                if not counts:
+                    del self._counts[key]
+
+    def sync(self, input_ids: npt.NDArray[np.intc]) -> int:
+        """Roll back and extend the index so that it covers exactly `input_ids`.
+
+        Returns:
+            The number of previously indexed tokens that were kept.
+        """
+        n_common = min(len(self._tokens), len(input_ids))
+        if n_common > 0:
+            # Vectorized prefix check, the index itself is only touched for the diff
+            mismatch = np.nonzero(self._buffer[:n_common] != input_ids[:n_common])[0]
+            if len(mismatch) > 0:
+                n_common = int(mismatch[0])
+        while len(self._tokens) > n_common:
+            self.pop()
+        for token in input_ids[n_common:].tolist():
+            self.append(token)
+        return n_common
+
+    def _recent(self) -> List[int]:
+        tokens = self._tokens
+        for n in range(min(self.max_ngram_size, len(tokens) - 1), 0, -1):
+            positions = self._positions.get(tuple(tokens[-n:]))
+            if positions:
+                start = positions[-1]
+                return tokens[start : start + self.num_pred_tokens]
+        return []
+
+    def _frequent(self) -> List[int]:
+        context = self._tokens[-self.max_ngram_size :]
+        draft: List[int] = []
+        for _ in range(self.num_pred_tokens):
+            for n in range(min(self.max_ngram_size, len(context)), 0, -1):
+                counts = self._counts.get(tuple(context[-n:]))
+                if counts:
+                    token = max(counts, key=counts.__getitem__)
+                    break
+            else:
+                break
+            draft.append(token)
+            context = (context + [token])[-self.max_ngram_size :]
+        return draft
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        self.sync(input_ids)
+        draft = self._recent() if self.continuation == "recent" else self._frequent()
+        return np.array(draft, dtype=np.intc)
+
+
+class LlamaNgramCache:
+    """Corpus-wide n-gram statistics collected from previous requests.
+
+    Maps n-grams (sizes `min_ngram_size..max_ngram_size`) to the counts of the
+    tokens that followed them. Memory is bounded by `max_ngrams` keys, evicted
+    least recently used first, and `max_continuations` next tokens per key.
+    The statistics can be persisted with `save` and reloaded with `load`.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(
+        self,
+        max_ngrams: int = 1_000_000,
+        min_ngram_size: int = 2,
+        max_ngram_size: int = 4,
+        max_continuations: int = 8,
+    ):
+        self.max_ngrams = max_ngrams
+        self.min_ngram_size = min_ngram_size
+        self.max_ngram_size = max_ngram_size
+        self.max_continuations = max_continuations
+        self._stats: "OrderedDict[Tuple[int, ...], Dict[int, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def add(self, tokens: List[int], start: int = 0):
+        """Count the continuations of every n-gram that ends before a token in `tokens[start:]`."""
+        stats = self._stats
+        for pos in range(max(start, self.min_ngram_size), len(tokens)):
+            token = tokens[pos]
+            for n in range(self.min_ngram_size, min(self.max_ngram_size, pos) + 1):
+                key = tuple(tokens[pos - n : pos])
+                counts = stats.get(key)
+                if counts is None:
+                    counts = stats[key] = {}
+                    if len(stats) > self.max_ngrams:
+                        stats.popitem(last=False)
+                else:
+                    stats.move_to_end(key)
+                if token not in counts and len(counts) >= self.max_continuations:
+                    del counts[min(counts, key=counts.__getitem__)]
+                counts[token] = counts.get(token, 0) + 1
+
+    def propose(
+        self,
+        context: List[int],
+        num_pred_tokens: int,
+        min_count: int = 2,
+        min_ratio: float = 0.5,
+    ) -> List[int]:
+        """Chain the most frequent continuations of the longest known n-gram ending `context`.
+
+        A step is only taken when the best continuation was seen at least
+        `min_count` times and accounts for `min_ratio` of what followed.
+        """
+        context = list(context[-self.max_ngram_size :])
+        draft: List[int] = []
+        while len(draft) < num_pred_tokens:
+            token = None
+            for n in range(min(self.max_ngram_size, len(context)), self.min_ngram_size - 1, -1):
+                counts = self._stats.get(tuple(context[-n:]))
+                if not counts:
+                    continue
+                best = max(counts, key=counts.__getitem__)
+                if counts[best] >= min_count and counts[best] >= min_ratio * sum(counts.values()):
+                    token = best
+                break
+            if token is None:
+                break
+            draft.append(token)
+            context = (context + [token])[-self.max_ngram_size :]
+        return draft
+
+    def save(self, path: str):
+        """Write the statistics to an `.npz` file (atomically replaced)."""
+        keys = np.full((len(self._stats), self.max_ngram_size), -1, dtype=np.intc)
+        offsets = np.zeros(len(self._stats) + 1, dtype=np.int64)
+        next_tokens: List[int] = []
+        counts: List[int] = []
+        for i, (key, continuation) in enumerate(self._stats.items()):
+            keys[i, self.max_ngram_size - len(key) :] = key
+            next_tokens.extend(continuation.keys())
+            counts.extend(continuation.values())
+            offsets[i + 1] = len(next_tokens)
+        meta = np.array(
+            [self.FORMAT_VERSION, self.min_ngram_size, self.max_ngram_size], dtype=np.int64
+        )
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    meta=meta,
+                    keys=keys,
+                    offsets=offsets,
+                    next_tokens=np.array(next_tokens, dtype=np.intc),
+                    counts=np.array(counts, dtype=np.int64),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load(self, path: str):
+        """Merge statistics previously written with `save` (LRU order is kept)."""
+        with np.load(path, allow_pickle=False) as data:
+            version, min_ngram_size, max_ngram_size = data["meta"].tolist()
+            if version != self.FORMAT_VERSION:
+                raise ValueError(f"Unsupported n-gram cache format version {version}")
+            keys = data["keys"]
+            offsets = data["offsets"]
+            next_tokens = data["next_tokens"].tolist()
+            counts = data["counts"].tolist()
+        for i, row in enumerate(keys.tolist()):
+            key = tuple(token for token in row if token >= 0)
+            if not self.min_ngram_size <= len(key) <= self.max_ngram_size:
+                continue
+            continuation = self._stats.setdefault(key, {})
+            self._stats.move_to_end(key)
+            for j in range(offsets[i], offsets[i + 1]):
+                continuation[next_tokens[j]] = continuation.get(next_tokens[j], 0) + counts[j]
+        while len(self._stats) > self.max_ngrams:
+            self._stats.popitem(last=False)
+
+
+class LlamaNgramCacheDraft(LlamaDraftModel):
+    """Draft from the current context first, then from a shared `LlamaNgramCache`.
+
+    Every token the target generates is added to the shared cache (prompts
+    are not, only what followed them), so repetitive
+    traffic (templated reports, JSON tool calls, boilerplate code) gets drafts
+    even when the current prompt has no match. One cache can back the draft
+    models of several requests or `Llama` instances.
+    """
+
+    def __init__(
+        self,
+        cache: LlamaNgramCache,
+        num_pred_tokens: int = 10,
+        max_ngram_size: int = 3,
+        min_count: int = 2,
+    ):
+        self.cache = cache
+        self.num_pred_tokens = num_pred_tokens
+        self.min_count = min_count
+        self._context = LlamaPromptLookupIndex(
+            max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens
+        )
+        # Tokens of the current context already added to the shared cache
+        self._n_recorded = 0
+        # Position of the first generated token of the current request
+        self._completion_start = 0
+
+    def begin(self, n_prompt_tokens: int) -> None:
+        self._completion_start = n_prompt_tokens
+        self._n_recorded = n_prompt_tokens
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        context = self._context
+        n_kept = context.sync(input_ids)
+        tokens = context._tokens
+        # A rollback below the watermark means rejected tokens, the prompt is never recorded
+        self._n_recorded = max(min(self._n_recorded, n_kept), self._completion_start)
+        self.cache.add(tokens, start=self._n_recorded)
+        self._n_recorded = len(tokens)
+
+        draft = context._recent()
+        if not draft:
+            draft = self.cache.propose(tokens, self.num_pred_tokens, min_count=self.min_count)
+        return np.array(draft, dtype=np.intc)
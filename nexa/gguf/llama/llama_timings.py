@@ -0,0 +1,236 @@
+import time
+import bisect
+import threading
+
+from dataclasses import dataclass, field
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# Phases of a completion request, in the order they happen
+TIMING_PHASES = (
+    "template",
+    "tokenize",
+    "prefill",
+    "decode",
+    "sample",
+    "draft",
+    "detokenize",
+    "stop_check",
+)
+
+# Upper bounds in seconds of the histogram buckets, the last one catches the rest
+DEFAULT_TIMING_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"),
+)
+
+
+@dataclass
+class LlamaTimings:
+    """Seconds spent in each phase of one completion request.
+
+    `template` and `tokenize` cover the prompt (chat template rendering,
+    including the tokenization done by the chat formatter's prefix cache),
+    `prefill` the evaluation of the prompt tokens that were not cached. The
+    generated tokens split into `decode` (model evaluation), `sample` (sampler
+    chain, grammar, jump-forward), `draft` (speculative draft model),
+    `detokenize` and `stop_check` (stop sequences and stopping criteria).
+    `total` is the wall time from the request to its last chunk, including
+    the time a stream waited for its reader. Parallel samples and beam search
+    only record the prompt phases and `total`.
+    """
+
+    template: float = 0.0
+    tokenize: float = 0.0
+    prefill: float = 0.0
+    decode: float = 0.0
+    sample: float = 0.0
+    draft: float = 0.0
+    detokenize: float = 0.0
+    stop_check: float = 0.0
+    total: float = 0.0
+    prompt_tokens: int = 0
+    prefill_tokens: int = 0
+    completion_tokens: int = 0
+    decode_steps: int = 0
+    start_time: float = field(default_factory=time.perf_counter, repr=False)
+    _mark: float = field(default=0.0, repr=False)
+
+    def mark(self):
+        """Start timing the next phase now."""
+        self._mark = time.perf_counter()
+
+    def lap(self, phase: str):
+        """Add the time since the last `mark` or `lap` to `phase`."""
+        now = time.perf_counter()
+        setattr(self, phase, getattr(self, phase) + now - self._mark)
+        self._mark = now
+
+    def timed(self, phase: str) -> "_TimedPhase":
+        """Context manager adding the time of its block to `phase`."""
+        return _TimedPhase(self, phase)
+
+    def phases(self) -> Dict[str, float]:
+        """Seconds per phase, with `total` and `overhead`, the time outside of all phases."""
+        phases = {phase: getattr(self, phase) for phase in TIMING_PHASES}
+        phases["total"] = self.total
+        phases["overhead"] = max(self.total - sum(phases[phase] for phase in TIMING_PHASES), 0.0)
+        return phases
+
+
+class _TimedPhase:
+    __slots__ = ("timings", "phase", "start")
+
+    def __init__(self, timings: LlamaTimings, phase: str):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.timings
+
+    def __exit__(self, *exc_info):
+        setattr(
+            self.timings,
+            self.phase,
+            getattr(self.timings, self.phase) + time.perf_counter() - self.start,
+        )
+
+
+class LlamaTimingHistogram:
+    """Counts of observed durations per bucket, the upper bounds are `buckets`."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_TIMING_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def add(self, other: "LlamaTimingHistogram"):
+        """Add the observations of `other`, which has the same buckets."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def cumulative_counts(self) -> List[int]:
+        """Number of observations up to each bucket bound, as in Prometheus histograms."""
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile, 0 without observations."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.cumulative_counts()):
+            if count >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class LlamaTimingCollector:
+    """Collects the `LlamaTimings` of the requests of one or more models.
+
+    Pass it as `Llama(timing_collector=...)`. Every finished request updates
+    one histogram per phase and calls the callbacks with its timings. Without
+    a collector, models record no timings at all.
+
+    Models decoding on different threads may share a collector: each thread
+    writes histograms of its own, summed when `histograms` is read. A read
+    racing a write may count the observation in its bucket but not yet in the
+    count and sum of the histogram, never more than one per thread.
+
+    Examples:
+        >>> timings = LlamaTimingCollector()
+        >>> timings.callbacks.append(lambda t: print(t.phases()))
+        >>> llm = Llama(model_path="model.gguf", timing_collector=timings)
+        >>> llm.create_completion("Q: Name the planets. A:")["timings"].decode
+        >>> timings.histograms["sample"].quantile(0.99)
+    """
+
+    def __init__(
+        self,
+        callbacks: Optional[List[Callable[[LlamaTimings], None]]] = None,
+        buckets: Tuple[float, ...] = DEFAULT_TIMING_BUCKETS,
+    ):
+        self.callbacks = list(callbacks or [])
+        self.buckets = buckets
+        self._threads: Dict[threading.Thread, _ThreadTimings] = {}
+        # Observations of the threads that ended, they write no more
+        self._ended = _ThreadTimings(buckets)
+        self._lock = threading.Lock()
+
+    @property
+    def histograms(self) -> Dict[str, LlamaTimingHistogram]:
+        """Histogram per phase of the requests of all threads."""
+        return self._merged().histograms
+
+    @property
+    def requests(self) -> int:
+        return self._merged().requests
+
+    def observe(self, timings: LlamaTimings):
+        thread = threading.current_thread()
+        own = self._threads.get(thread)
+        if own is None:
+            own = _ThreadTimings(self.buckets)
+            with self._lock:
+                self._threads[thread] = own
+        own.requests += 1
+        for phase, seconds in timings.phases().items():
+            own.histograms[phase].observe(seconds)
+        for callback in self.callbacks:
+            callback(timings)
+
+    def _merged(self) -> "_ThreadTimings":
+        merged = _ThreadTimings(self.buckets)
+        with self._lock:
+            for thread in [thread for thread in self._threads if not thread.is_alive()]:
+                self._ended.add(self._threads.pop(thread))
+            for timings in [self._ended, *self._threads.values()]:
+                merged.add(timings)
+        return merged
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, mean, p50 and p99 bucket bound in seconds per phase."""
+        return {
+            phase: {
+                "count": histogram.count,
+                "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+            }
+            for phase, histogram in self.histograms.items()
+        }
+
+
+class _ThreadTimings:
+    """Histograms of the requests observed by one thread of a `LlamaTimingCollector`."""
+
+    __slots__ = ("histograms", "requests")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.histograms: Dict[str, LlamaTimingHistogram] = {
+            phase: LlamaTimingHistogram(buckets)
+            for phase in TIMING_PHASES + ("total", "overhead")
+        }
+        self.requests = 0
+
+    def add(self, other: "_ThreadTimings"):
+        self.requests += other.requests
+        for phase, histogram in other.histograms.items():
+            self.histograms[phase].add(histogram)
@@ -2,8 +2,11 @@ from __future__ import annotations
 
 import abc
 from typing import (
+    Dict,
     List,
     Optional,
+    Sequence,
+    Tuple,
     Any,
 )
 
@@ -75,8 +78,13 @@ class LlamaTokenizer(BaseLlamaTokenizer):
 
 
 class LlamaHFTokenizer(BaseLlamaTokenizer):
+    # Tokens before the end of `prev_tokens` decoded along with the new tokens
+    DETOKENIZE_WINDOW = 6
+
     def __init__(self, hf_tokenizer: Any):
         self.hf_tokenizer = hf_tokenizer
+        # Text of single tokens, keyed by (token, skip_special_tokens)
+        self._token_text: Dict[Tuple[int, bool], str] = {}
 
     def tokenize(
         self, text: bytes, add_bos: bool = True, special: bool = True
@@ -93,11 +101,16 @@ class LlamaHFTokenizer(BaseLlamaTokenizer):
     ) -> bytes:
         skip_special_tokens = not special
         if prev_tokens is not None:
+            # Decode from a prefix offset a few tokens before the read offset
+            # (the end of prev_tokens) rather than from the first token, so
+            # the cost does not grow with the prompt
+            prefix_offset = self._prefix_offset(prev_tokens, skip_special_tokens)
+            context = list(prev_tokens[prefix_offset:])
             text = self.hf_tokenizer.decode(
-                prev_tokens + tokens, skip_special_tokens=skip_special_tokens
+                context + list(tokens), skip_special_tokens=skip_special_tokens
             ).encode("utf-8", errors="ignore")
             prev_text = self.hf_tokenizer.decode(
-                prev_tokens, skip_special_tokens=skip_special_tokens
+                context, skip_special_tokens=skip_special_tokens
             ).encode("utf-8", errors="ignore")
             return text[len(prev_text) :]
         else:
@@ -105,6 +118,30 @@ class LlamaHFTokenizer(BaseLlamaTokenizer):
                 tokens, skip_special_tokens=skip_special_tokens
             ).encode("utf-8", errors="ignore")
 
+    def _prefix_offset(self, prev_tokens: Sequence[int], skip_special_tokens: bool) -> int:
+        """Start of the decoded context for text following `prev_tokens`.
+
+        The context starts on a token that decodes to text of its own: not a
+        byte of a multi-byte character split across tokens (byte fallback,
+        byte-level BPE) and not a skipped special or bare whitespace token.
+        Decoding then gives the same text from there on as decoding from the
+        first token, and a whitespace-prefix tokenizer strips the leading
+        space of the same token in both decodes.
+        """
+        prefix_offset = max(len(prev_tokens) - self.DETOKENIZE_WINDOW, 0)
+        while prefix_offset > 0:
+            key = (prev_tokens[prefix_offset], skip_special_tokens)
+            text = self._token_text.get(key)
+            if text is None:
+                text = self.hf_tokenizer.decode(
+                    [key[0]], skip_special_tokens=skip_special_tokens
+                )
+                self._token_text[key] = text
+            if text.strip() and "\ufffd" not in text:
+                break
+            prefix_offset -= 1
+        return prefix_offset
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path: str) -> "LlamaHFTokenizer":
         try:
@@ -62,6 +62,8 @@ class CreateCompletionResponse(TypedDict):
     model: str
     choices: List[CompletionChoice]
     usage: NotRequired[CompletionUsage]
+    # LlamaTimings of the request, on the last chunk, with Llama(timing_collector=...)
+    timings: NotRequired[Any]
 
 
 class ChatCompletionResponseFunctionCall(TypedDict):
@@ -114,6 +116,7 @@ class CreateChatCompletionResponse(TypedDict):
     model: str
     choices: List["ChatCompletionResponseChoice"]
     usage: CompletionUsage
+    timings: NotRequired[Any]
 
 
 class ChatCompletionMessageToolCallChunkFunction(TypedDict):
@@ -161,6 +164,7 @@ class CreateChatCompletionStreamResponse(TypedDict):
     object: Literal["chat.completion.chunk"]
     created: int
     choices: List[ChatCompletionStreamResponseChoice]
+    timings: NotRequired[Any]
 
 
 class ChatCompletionFunctions(TypedDict):
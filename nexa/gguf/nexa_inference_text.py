@@ -5,7 +5,9 @@ import logging
 import os
 import time
 from pathlib import Path
-from typing import Iterator, List, Union
+from typing import Iterator, List, Optional, Union
+
+import numpy as np
 
 from nexa.constants import (
     DEFAULT_TEXT_GEN_PARAMS,
@@ -16,6 +18,7 @@ from nexa.constants import (
 from nexa.gguf.lib_utils import is_gpu_available
 from nexa.general import pull_model
 from nexa.gguf.llama.llama_grammar import LlamaGrammar
+from nexa.gguf.llama._internals_transformers import encode_embeddings
 from nexa.utils import SpinningCursorAnimation, nexa_prompt
 from nexa.gguf.llama._utils_transformers import suppress_stdout_stderr
 
@@ -46,6 +49,19 @@ class NexaTextInference:
     max_new_tokens (int): Maximum number of new tokens to generate.
     top_k (int): Top-k sampling parameter.
     top_p (float): Top-p sampling parameter
+    prefetch (str): Page-cache warm-up policy for the model file (none, willneed, readahead, mlock).
+    draft_model_path (str, optional): Local path of a smaller GGUF model sharing the vocabulary, enables speculative decoding.
+    draft_max_tokens (int): Upper bound of the adaptive draft length.
+    draft_acceptance (str): Draft verification, "greedy" or "rejection" sampling.
+    max_samples (int): Largest n / best_of accepted by create_completion and create_chat_completion.
+    context_shift (bool): Discard the oldest tokens when the context is full instead of dropping the conversation history.
+    jump_forward (bool): In structure_output and function_calling, insert the text forced by the JSON schema without sampling it.
+    autotune (bool): Measure and use the fastest thread counts and batch size of this host at load, cached per host and model.
+    numa_node (int, optional): Pin inference to the physical cores of this NUMA node and allocate from its memory.
+    type_k (str, optional): KV cache type of K, "f16", "q8_0" or "q4_0".
+    type_v (str, optional): KV cache type of V, "f16", "q8_0" or "q4_0" (quantized V requires flash_attn).
+    flash_attn (bool): Use flash attention.
+    memory_budget_gb (float, optional): Memory for the weights and KV cache; nctx and the KV cache types are planned to fit it (0 for the available memory, nctx 0 for the training context).
     """
 
     def __init__(self, model_path=None, local_path=None, stop_words=None, device="auto", function_calling: bool = False, **kwargs):
@@ -98,6 +114,8 @@ class NexaTextInference:
         input: Union[str, List[str]],
         normalize: bool = False,
         truncate: bool = True,
+        encoding_format: str = "float",
+        dimensions: Optional[int] = None,
     ):
         """Embed a string.
 
@@ -105,34 +123,53 @@ class NexaTextInference:
             input: The utf-8 encoded string or a list of string to embed.
             normalize: Normalize the embeddings.
             truncate: Truncate the embeddings.
+            encoding_format: "float" for lists of floats, "base64" (float32), "float16", "int8" or "binary" (sign bits) for compact encodings.
+            dimensions: Keep only the first dimensions of each embedding (Matryoshka models), before normalizing.
 
         Returns:
             Embeddings or list of embeddings
         """
-        return self.model.embed(input, normalize, truncate)
+        if encoding_format == "float":
+            return self.model.embed(input, normalize, truncate, dimensions=dimensions)
+        embeddings = self.model.embed_array(
+            input, normalize=normalize, truncate=truncate, dimensions=dimensions)
+        if isinstance(embeddings, np.ndarray) and embeddings.ndim == 1:
+            return encode_embeddings(embeddings[None, :], encoding_format)[0]
+        if isinstance(embeddings, np.ndarray):
+            return encode_embeddings(embeddings, encoding_format)
+        # Models without pooling return the token embeddings of each input
+        return [encode_embeddings(matrix, encoding_format) for matrix in embeddings]
 
     @SpinningCursorAnimation()
     def _load_model(self):
         logging.debug(
             f"Loading model from {self.downloaded_path}, use gpu : {is_gpu_available()}")
         start_time = time.time()
+        kv_cache_params = self._kv_cache_params()
         with suppress_stdout_stderr():
             from nexa.gguf.llama.llama import Llama
+            if self.device == "auto" or self.device == "gpu":
+                n_gpu_layers = -1 if is_gpu_available() else 0
+            elif self.device == "cpu":
+                n_gpu_layers = 0
+            # Loaded once, the CPU fallback of the model keeps it
+            draft_model = self._load_draft_model(n_gpu_layers, kv_cache_params["n_ctx"])
             try:
-                if self.device == "auto" or self.device == "gpu":
-                    n_gpu_layers = -1 if is_gpu_available() else 0
-                elif self.device == "cpu":
-                    n_gpu_layers = 0
-
                 self.model = Llama(
                     embedding=self.params.get("embedding", False),
                     model_path=self.downloaded_path,
                     verbose=self.profiling,
                     chat_format=self.chat_format,
-                    n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=n_gpu_layers,
                     lora_path=self.params.get("lora_path", ""),
                     logits_all=self.params.get("logits_all", False),
+                    prefetch=self.params.get("prefetch", "none"),
+                    n_seq_max=self.params.get("max_samples", 1),
+                    context_shift=self.params.get("context_shift", False),
+                    autotune=self.params.get("autotune", False),
+                    numa_node=self.params.get("numa_node"),
+                    draft_model=draft_model,
+                    **kv_cache_params,
                 )
             except Exception as e:
                 logging.error(
@@ -141,15 +178,25 @@ class NexaTextInference:
                     model_path=self.downloaded_path,
                     verbose=self.profiling,
                     chat_format=self.chat_format,
-                    n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=0,  # hardcode to use CPU
                     lora_path=self.params.get("lora_path", ""),
                     logits_all=self.params.get("logits_all", False),
+                    prefetch=self.params.get("prefetch", "none"),
+                    n_seq_max=self.params.get("max_samples", 1),
+                    context_shift=self.params.get("context_shift", False),
+                    autotune=self.params.get("autotune", False),
+                    numa_node=self.params.get("numa_node"),
+                    draft_model=draft_model,
+                    **kv_cache_params,
                 )
 
         load_time = time.time() - start_time
         if self.profiling:
             logging.debug(f"Model loaded in {load_time:.2f} seconds")
+            logging.debug(
+                "Load breakdown: "
+                + ", ".join(f"{k}={v:.3f}s" for k, v in self.model.load_timings.items())
+            )
         if (
             self.completion_template is None
             and (
@@ -162,6 +209,59 @@ class NexaTextInference:
 
         self.conversation_history = [] if self.chat_format else None
 
+    def _kv_cache_params(self):
+        """n_ctx and KV cache settings of the model, planned to fit `memory_budget_gb` when it is set."""
+        from nexa.gguf.llama.llama_kv_planner import kv_cache_type, plan_kv_cache
+        n_ctx = self.params.get("nctx", 2048)
+        type_k = self.params.get("type_k")
+        type_v = self.params.get("type_v")
+        flash_attn = self.params.get("flash_attn", False)
+        memory_budget_gb = self.params.get("memory_budget_gb")
+        if memory_budget_gb is not None:
+            plan = plan_kv_cache(
+                self.downloaded_path,
+                memory_budget=int(memory_budget_gb * (1 << 30)) if memory_budget_gb > 0 else None,
+                n_ctx=n_ctx or None,
+                flash_attn=flash_attn,
+                logits_all=self.params.get("logits_all", False),
+                kv_types=[(type_k or "f16", type_v or "f16")] if type_k or type_v else None,
+            )
+            logging.info(plan.report())
+            n_ctx, type_k, type_v = plan.n_ctx, plan.type_k, plan.type_v
+        return dict(
+            n_ctx=n_ctx,
+            type_k=kv_cache_type(type_k) if type_k else None,
+            type_v=kv_cache_type(type_v) if type_v else None,
+            flash_attn=flash_attn,
+        )
+
+    def _load_draft_model(self, n_gpu_layers, n_ctx):
+        """Speculative decoding draft model from the `draft_model_path` param, if any, with the context of the target.
+
+        Falls back to CPU when it fails to load with `n_gpu_layers`.
+        """
+        draft_model_path = self.params.get("draft_model_path")
+        if not draft_model_path:
+            return None
+        from nexa.gguf.llama.llama_speculative import LlamaGGUFDraftModel
+
+        def load(n_gpu_layers):
+            return LlamaGGUFDraftModel(
+                model_path=draft_model_path,
+                max_pred_tokens=self.params.get("draft_max_tokens", 16),
+                acceptance=self.params.get("draft_acceptance", "greedy"),
+                n_ctx=n_ctx,
+                n_gpu_layers=n_gpu_layers,
+            )
+
+        try:
+            return load(n_gpu_layers)
+        except Exception as e:
+            if n_gpu_layers == 0:
+                raise
+            logging.error(f"Failed to load draft model: {e}. Falling back to CPU.", exc_info=True)
+            return load(0)
+
     def run(self):
         """
         CLI interactive session. Not for SDK.
@@ -219,7 +319,8 @@ class NexaTextInference:
                         generated_text += delta
 
                 if self.chat_format:
-                    if len(self.conversation_history) >= 2:
+                    # With context shift the model drops the oldest tokens itself
+                    if len(self.conversation_history) >= 2 and not self.params.get("context_shift", False):
                         self.conversation_history = self.conversation_history[2:]
 
                     self.conversation_history.append(
@@ -372,7 +473,8 @@ class NexaTextInference:
             "top_k": self.params.get("top_k", 50),
             "top_p": self.params.get("top_p", 1.0),
             "stop": self.stop_words,
-            "logprobs": self.logprobs
+            "logprobs": self.logprobs,
+            "jump_forward": self.params.get("jump_forward", False),
         }
         params.update(kwargs)
         # We'll try to generate a completion that looks like JSON
@@ -460,7 +562,8 @@ class NexaTextInference:
             return processed_output
 
         response = self.model.create_chat_completion(
-            messages=messages, tools=tools, function_call='none')
+            messages=messages, tools=tools, function_call='none',
+            jump_forward=self.params.get("jump_forward", False))
         response = response['choices'][0]['message']['tool_calls']
         try:
             # print(response)
@@ -554,6 +657,60 @@ if __name__ == "__main__":
         type=str,
         help="Path to a LoRA file to apply to the model.",
     )
+    parser.add_argument(
+        "--prefetch",
+        type=str,
+        choices=["none", "willneed", "readahead", "mlock"],
+        help="Page-cache warm-up policy for the model weights at load time",
+    )
+    parser.add_argument(
+        "--draft_model_path",
+        type=str,
+        help="Local path to a smaller GGUF model with the same vocabulary, used for speculative decoding",
+    )
+    parser.add_argument(
+        "--draft_max_tokens",
+        type=int,
+        help="Maximum number of tokens drafted per step, the draft length adapts to the acceptance rate",
+    )
+    parser.add_argument(
+        "--draft_acceptance",
+        type=str,
+        choices=["greedy", "rejection"],
+        help="How drafted tokens are verified by the target model",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Probe and use the fastest thread counts and batch size at load, cached per host and model",
+    )
+    parser.add_argument(
+        "--numa_node",
+        type=int,
+        help="Pin inference threads to the physical cores of this NUMA node and bind memory to it",
+    )
+    parser.add_argument(
+        "--type_k",
+        type=str,
+        choices=["f16", "q8_0", "q4_0"],
+        help="KV cache type of K",
+    )
+    parser.add_argument(
+        "--type_v",
+        type=str,
+        choices=["f16", "q8_0", "q4_0"],
+        help="KV cache type of V, quantized types require --flash_attn",
+    )
+    parser.add_argument(
+        "--flash_attn",
+        action="store_true",
+        help="Use flash attention",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        help="Plan nctx and the KV cache types to fit the weights and KV cache in this many GB (0: available memory)",
+    )
     parser.add_argument(
         "-d",
         "--device",
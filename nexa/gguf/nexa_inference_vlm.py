@@ -88,6 +88,8 @@ class NexaVLMInference:
     max_new_tokens (int): Maximum number of new tokens to generate.
     top_k (int): Top-k sampling parameter.
     top_p (float): Top-p sampling parameter
+    autotune (bool): Measure and use the fastest thread counts and batch size of this host at load, cached per host and model.
+    numa_node (int, optional): Pin inference to the physical cores of this NUMA node and allocate from its memory.
     """
 
     def __init__(self, model_path=None, local_path=None, projector_local_path=None, stop_words=None, device="auto", **kwargs):
@@ -185,6 +187,8 @@ class NexaVLMInference:
                     chat_format=self.chat_format,
                     n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=n_gpu_layers,
+                    autotune=self.params.get("autotune", False),
+                    numa_node=self.params.get("numa_node"),
                 )
             except Exception as e:
                 logging.error(
@@ -198,6 +202,8 @@ class NexaVLMInference:
                     chat_format=self.chat_format,
                     n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=0,  # hardcode to use CPU
+                    autotune=self.params.get("autotune", False),
+                    numa_node=self.params.get("numa_node"),
                 )
 
         load_time = time.time() - start_time
@@ -433,6 +439,16 @@ if __name__ == "__main__":
         action="store_true",
         help="Run the inference in Streamlit UI",
     )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Probe and use the fastest thread counts and batch size at load, cached per host and model",
+    )
+    parser.add_argument(
+        "--numa_node",
+        type=int,
+        help="Pin inference threads to the physical cores of this NUMA node and bind memory to it",
+    )
     parser.add_argument(
         "-d",
         "--device",
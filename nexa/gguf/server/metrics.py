@@ -0,0 +1,260 @@
+import math
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+
+from nexa.gguf.llama.llama_timings import (
+    DEFAULT_TIMING_BUCKETS,
+    LlamaTimingCollector,
+    LlamaTimingHistogram,
+    LlamaTimings,
+)
+
+T = TypeVar("T")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Label value of the models past ServerMetrics.max_models
+OTHER_MODEL = "other"
+
+_COUNTERS = {
+    "nexa_requests_total": "Requests by endpoint, model and status (ok, error, cancelled).",
+    "nexa_prompt_tokens_total": "Prompt tokens of the finished requests.",
+    "nexa_completion_tokens_total": "Generated tokens of the finished requests.",
+    "nexa_prefix_cache_hit_tokens_total": "Prompt tokens reused from the KV cache instead of being evaluated.",
+    "nexa_model_loads_total": "Model loads.",
+}
+
+_HISTOGRAMS = {
+    "nexa_time_to_first_token_seconds": "Time from the arrival of a streamed request to its first chunk.",
+    "nexa_inter_token_latency_seconds": "Time between consecutive chunks of a streamed response.",
+    "nexa_queue_wait_seconds": "Time a request waited for the decode thread.",
+    "nexa_request_duration_seconds": "Time from the arrival of a request to its last byte.",
+}
+
+
+class RequestRecord:
+    """Progress of one request, written by the event loop and, for `started`, the decode thread."""
+
+    __slots__ = (
+        "endpoint", "model", "arrived", "started", "last_chunk", "timings", "finished",
+    )
+
+    def __init__(self, endpoint: str, model: str):
+        self.endpoint = endpoint
+        self.model = model
+        self.arrived = time.perf_counter()
+        self.started: Optional[float] = None
+        self.last_chunk: Optional[float] = None
+        self.timings: Optional[LlamaTimings] = None
+        self.finished = False
+
+
+class ServerMetrics:
+    """Request metrics of the server in the Prometheus text format.
+
+    Requests are tracked with `start`, `decoding`, `chunk` and `finish`, all
+    called from the event loop except the function wrapped by `decoding`,
+    which runs on the decode thread of the model. Each value has a single
+    writer thread, the phase timings of the decode threads are kept apart by
+    `LlamaTimingCollector` and summed at scrape time, so nothing is locked: a
+    scrape may see a histogram one observation ahead of its counter, which
+    Prometheus tolerates. Models loaded with `timing_collector=metrics.timings`
+    also report token counts, prefix cache hits and per-phase timings.
+
+    Labels are bounded: endpoints are the routes of the server, and models
+    past the first `max_models` are reported as "other".
+    """
+
+    def __init__(self, max_models: int = 8, buckets: Tuple[float, ...] = DEFAULT_TIMING_BUCKETS):
+        self.max_models = max_models
+        self.buckets = buckets
+        self.timings = LlamaTimingCollector(callbacks=[self._on_timings], buckets=buckets)
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], LlamaTimingHistogram] = {}
+        self.model_load_seconds: Dict[str, float] = {}
+        self.active: Dict[int, RequestRecord] = {}
+        # Request whose generation is running, per decode thread since each resident model has its own
+        self._decoding = threading.local()
+        self._models: Set[str] = set()
+
+    def model_label(self, model: Optional[str]) -> str:
+        model = model or ""
+        if model in self._models:
+            return model
+        if len(self._models) >= self.max_models:
+            return OTHER_MODEL
+        self._models.add(model)
+        return model
+
+    def start(self, endpoint: str, model: Optional[str]) -> RequestRecord:
+        record = RequestRecord(endpoint, self.model_label(model))
+        self.active[id(record)] = record
+        return record
+
+    def decoding(self, record: RequestRecord, func: Callable[..., T]) -> Callable[..., T]:
+        """Wrap `func`, to be run on the decode thread, to mark when `record` leaves the queue."""
+
+        def run(*args: Any, **kwargs: Any) -> T:
+            record.started = time.perf_counter()
+            self._decoding.record = record
+            return func(*args, **kwargs)
+
+        return run
+
+    def chunk(self, record: RequestRecord):
+        """Record a streamed chunk of `record` leaving the server."""
+        now = time.perf_counter()
+        labels = (("endpoint", record.endpoint), ("model", record.model))
+        if record.last_chunk is None:
+            self._observe("nexa_time_to_first_token_seconds", labels, now - record.arrived)
+        else:
+            self._observe("nexa_inter_token_latency_seconds", labels, now - record.last_chunk)
+        record.last_chunk = now
+
+    def finish(self, record: RequestRecord, status: str = "ok"):
+        """Count `record` once, later calls are ignored."""
+        if record.finished:
+            return
+        record.finished = True
+        self.active.pop(id(record), None)
+        now = time.perf_counter()
+        labels = (("endpoint", record.endpoint), ("model", record.model))
+        self._inc("nexa_requests_total", labels + (("status", status),))
+        self._observe("nexa_request_duration_seconds", labels, now - record.arrived)
+        if record.started is not None:
+            self._observe("nexa_queue_wait_seconds", labels, record.started - record.arrived)
+        timings = record.timings
+        if timings is not None:
+            self._inc("nexa_prompt_tokens_total", labels, timings.prompt_tokens)
+            self._inc("nexa_completion_tokens_total", labels, timings.completion_tokens)
+            self._inc(
+                "nexa_prefix_cache_hit_tokens_total",
+                labels,
+                max(timings.prompt_tokens - timings.prefill_tokens, 0),
+            )
+
+    def model_loaded(self, model: Optional[str], seconds: float):
+        label = self.model_label(model)
+        self.model_load_seconds[label] = seconds
+        self._inc("nexa_model_loads_total", (("model", label),))
+
+    def render(self, gauges: Iterable[Tuple[str, str, Dict[str, str], float]] = ()) -> str:
+        """Prometheus text exposition of all metrics, plus `gauges` as (name, help, labels, value)."""
+        lines: List[str] = []
+        in_flight = list(self.active.values())
+        gauge_rows = [
+            ("nexa_requests_in_flight", "Requests received and not finished yet.", {}, len(in_flight)),
+            (
+                "nexa_requests_queued",
+                "Requests waiting for the decode thread.",
+                {},
+                sum(1 for record in in_flight if record.started is None),
+            ),
+        ]
+        gauge_rows += [
+            ("nexa_model_load_seconds", "Duration of the last load of each model.", {"model": model}, seconds)
+            for model, seconds in self.model_load_seconds.items()
+        ]
+        gauge_rows += self._prefix_cache_ratios()
+        gauge_rows += list(gauges)
+
+        for name, help_text in _COUNTERS.items():
+            rows = [(labels, value) for (n, labels), value in self.counters.items() if n == name]
+            if rows:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                lines += [f"{name}{_labels(labels)} {_number(value)}" for labels, value in rows]
+
+        written = set()
+        for name, help_text, labels, value in gauge_rows:
+            if name not in written:
+                written.add(name)
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines.append(f"{name}{_labels(tuple(labels.items()))} {_number(value)}")
+
+        for name, help_text in _HISTOGRAMS.items():
+            rows = [(labels, h) for (n, labels), h in self.histograms.items() if n == name]
+            if rows:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for labels, histogram in rows:
+                    lines += _histogram_lines(name, labels, histogram)
+
+        name = "nexa_llama_phase_seconds"
+        lines += [
+            f"# HELP {name} Time per request spent in each phase of a completion.",
+            f"# TYPE {name} histogram",
+        ]
+        for phase, histogram in self.timings.histograms.items():
+            lines += _histogram_lines(name, (("phase", phase),), histogram)
+        return "\n".join(lines) + "\n"
+
+    def _on_timings(self, timings: LlamaTimings):
+        # Called on the decode thread at the end of each generation
+        record = getattr(self._decoding, "record", None)
+        if record is not None and not record.finished:
+            record.timings = timings
+
+    def _prefix_cache_ratios(self) -> List[Tuple[str, str, Dict[str, str], float]]:
+        prompt: Dict[str, float] = {}
+        hits: Dict[str, float] = {}
+        for (name, labels), value in list(self.counters.items()):
+            if name in ("nexa_prompt_tokens_total", "nexa_prefix_cache_hit_tokens_total"):
+                model = dict(labels)["model"]
+                totals = prompt if name == "nexa_prompt_tokens_total" else hits
+                totals[model] = totals.get(model, 0.0) + value
+        return [
+            (
+                "nexa_prefix_cache_hit_ratio",
+                "Share of the prompt tokens reused from the KV cache.",
+                {"model": model},
+                hits.get(model, 0.0) / total,
+            )
+            for model, total in prompt.items()
+            if total > 0
+        ]
+
+    def _inc(self, name: str, labels: Tuple[Tuple[str, str], ...], value: float = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name: str, labels: Tuple[Tuple[str, str], ...], seconds: float):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LlamaTimingHistogram(self.buckets)
+        histogram.observe(seconds)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _histogram_lines(
+    name: str, labels: Tuple[Tuple[str, str], ...], histogram: LlamaTimingHistogram
+) -> List[str]:
+    counts = histogram.cumulative_counts()
+    lines = [
+        f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {count}"
+        for bound, count in zip(histogram.buckets, counts)
+    ]
+    # The +Inf bucket and the count must agree even while the histogram is written
+    count = counts[-1]
+    if not math.isinf(histogram.buckets[-1]):
+        count = histogram.count
+        lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+    lines.append(f"{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+    lines.append(f"{name}_count{_labels(labels)} {count}")
+    return lines
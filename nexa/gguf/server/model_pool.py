@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class ModelPoolFull(RuntimeError):
+    """No room for a model: the resident models that could make it are in use or pinned."""
+
+
+class PooledModel:
+    """A model resident in a `ModelPool`."""
+
+    __slots__ = ("model_id", "value", "size_bytes", "refs", "last_used", "pinned", "removed")
+
+    def __init__(self, model_id: str, value: Any, size_bytes: int = 0):
+        self.model_id = model_id
+        self.value = value
+        self.size_bytes = size_bytes
+        # Requests using the model, it is not closed while any is in flight
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.pinned = False
+        self.removed = False
+
+
+class ModelPool:
+    """Loaded models keyed by model id, kept resident within a memory budget.
+
+    `acquire` returns the entry of a model, loading it on a miss, and counts
+    the request using it until `release`. Room is made by closing the least
+    recently used models that are neither in use nor pinned. A model in use
+    is never closed and the limits are never exceeded: when the models in use
+    or pinned leave no room for a model, `acquire` raises `ModelPoolFull`
+    without loading it or closing anything. Concurrent requests for a model
+    being loaded wait for that load.
+
+    The pool is used from the event loop only, nothing is locked.
+
+    Args:
+        budget_bytes: Memory of the resident models, None for no limit.
+        max_models: Number of resident models, None for no limit.
+        close: Called with the value of each model leaving the pool.
+    """
+
+    def __init__(
+        self,
+        budget_bytes: Optional[int] = None,
+        max_models: Optional[int] = None,
+        close: Optional[Callable[[Any], None]] = None,
+    ):
+        self.budget_bytes = budget_bytes
+        self.max_models = max_models
+        self._close = close
+        # Least recently used first
+        self.entries: "OrderedDict[str, PooledModel]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Event] = {}
+        # Bytes reserved by the loads in progress
+        self._reserved: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self.entries.values())
+
+    async def acquire(
+        self, model_id: str, load: Callable[[Callable[[int], None]], Awaitable[Any]]
+    ) -> PooledModel:
+        """Entry of `model_id`, in use until `release`.
+
+        On a miss, the model is loaded with `await load(reserve)`. The loader
+        calls `reserve(size_bytes)` with the memory the model will take before
+        allocating it, which closes idle models until it fits.
+
+        Raises:
+            ModelPoolFull: The model is not resident and there is no room for
+                it, raised before `load` is called or by `reserve`.
+        """
+        while model_id not in self.entries and model_id in self._loading:
+            await self._loading[model_id].wait()
+        entry = self.entries.get(model_id)
+        if entry is None:
+            # A failed load leaves no entry, the waiters then load it themselves
+            self.misses += 1
+            return await self._load(model_id, load)
+        self.hits += 1
+        self.entries.move_to_end(model_id)
+        entry.refs += 1
+        entry.last_used = time.monotonic()
+        return entry
+
+    async def _load(self, model_id, load) -> PooledModel:
+        # Checked before loading, the size is known once the loader reserves it
+        if not self._make_room(0, 1):
+            raise ModelPoolFull(f"No room in the model pool for model {model_id}")
+        loaded = self._loading[model_id] = asyncio.Event()
+
+        def reserve(size_bytes: int):
+            if not self._make_room(size_bytes, 1):
+                raise ModelPoolFull(
+                    f"No room in the model pool for model {model_id} ({size_bytes} bytes)")
+            self._reserved[model_id] = size_bytes
+
+        try:
+            value = await load(reserve)
+        finally:
+            size_bytes = self._reserved.pop(model_id, 0)
+            del self._loading[model_id]
+            loaded.set()
+        entry = PooledModel(model_id, value, size_bytes)
+        entry.refs = 1
+        self.entries[model_id] = entry
+        self._make_room()
+        return entry
+
+    def release(self, entry: PooledModel):
+        """End a request using `entry`."""
+        entry.refs -= 1
+        entry.last_used = time.monotonic()
+        if entry.refs > 0:
+            return
+        if entry.removed:
+            self._close_entry(entry)
+        else:
+            # Models in use may have kept the pool over budget
+            self._make_room()
+
+    def pin(self, model_id: str, pinned: bool = True):
+        """Keep `model_id` resident while pinned, whether or not requests use it."""
+        if model_id in self.entries:
+            self.entries[model_id].pinned = pinned
+            if not pinned:
+                self._make_room()
+
+    def remove(self, model_id: str) -> bool:
+        """Drop `model_id`, closing it now or when its last request is released.
+
+        Returns:
+            Whether the model was resident.
+        """
+        entry = self.entries.pop(model_id, None)
+        if entry is None:
+            return False
+        entry.removed = True
+        if entry.refs == 0:
+            self._close_entry(entry)
+        return True
+
+    def close(self):
+        """Drop every model."""
+        for model_id in list(self.entries):
+            self.remove(model_id)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Resident models, least recently used first."""
+        return [
+            {
+                "model": entry.model_id,
+                "size_bytes": entry.size_bytes,
+                "requests": entry.refs,
+                "pinned": entry.pinned,
+                "idle_seconds": time.monotonic() - entry.last_used,
+            }
+            for entry in self.entries.values()
+        ]
+
+    def _fits(self, size_bytes: int, n_models: int) -> bool:
+        if (
+            self.max_models is not None
+            and len(self.entries) + len(self._reserved) + n_models > self.max_models
+        ):
+            return False
+        return (
+            self.budget_bytes is None
+            or self.used_bytes + sum(self._reserved.values()) + size_bytes <= self.budget_bytes
+        )
+
+    def _make_room(self, size_bytes: int = 0, n_models: int = 0) -> bool:
+        """Close idle models, least recently used first, until `n_models` more of `size_bytes` fit.
+
+        Returns:
+            Whether they fit. Nothing is closed when closing every idle model
+            would not be enough.
+        """
+        idle = [entry for entry in self.entries.values() if entry.refs == 0 and not entry.pinned]
+        if not self._fits(size_bytes - sum(entry.size_bytes for entry in idle), n_models - len(idle)):
+            return False
+        for entry in idle:
+            if self._fits(size_bytes, n_models):
+                break
+            logging.info(f"Evicting model {entry.model_id} from the model pool")
+            self.evictions += 1
+            self.remove(entry.model_id)
+        return True
+
+    def _close_entry(self, entry: PooledModel):
+        if self._close is None:
+            return
+        try:
+            self._close(entry.value)
+        except Exception as e:
+            logging.warning(f"Failed to close model {entry.model_id}: {e}")
@@ -13,12 +13,14 @@ import tempfile
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Query, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, HttpUrl, AnyUrl, Field
 import requests
 from io import BytesIO
 from urllib.parse import urlparse
 import asyncio
+import functools
+import multiprocessing
 
 
 from nexa.constants import (
@@ -48,6 +50,11 @@ from nexa.gguf.llama.llama_chat_format import (
 from nexa.gguf.llama._utils_transformers import suppress_stdout_stderr
 from nexa.general import add_model_to_list, default_use_processes, download_file_with_progress, get_model_info, is_model_exists, pull_model, remove_model
 from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_async import AsyncLlama
+from nexa.gguf.llama._internals_transformers import EMBEDDING_ENCODING_FORMATS, encode_embeddings, normalize_embeddings
+from nexa.gguf.llama.llama_session import LlamaSessionSlots, LlamaSessionStore
+from nexa.gguf.server.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, ServerMetrics
+from nexa.gguf.server.model_pool import ModelPool, ModelPoolFull
 from faster_whisper import WhisperModel
 import numpy as np
 import argparse
@@ -96,6 +103,36 @@ default_function_call_system_prompt = [
 model_path = None
 whisper_model_path = "faster-whisper-tiny"  # by default, use tiny whisper model
 n_ctx = None
+prefetch = "none"
+context_shift = False
+autotune = False
+numa_node = None
+kv_type_k = None
+kv_type_v = None
+flash_attn = False
+memory_budget_gb = None
+n_sessions = 4
+max_samples = 4
+session_slots = None
+session_spill_dir = None
+session_spill_size = 2 << 30
+draft_model_path = None
+draft_max_tokens = 16
+draft_acceptance = "greedy"
+use_ngram_cache = False
+ngram_cache_dir = None
+# n-gram cache of each model file
+ngram_caches = {}
+embedding_wait = 0.005
+jump_forward = False
+server_metrics = ServerMetrics()
+# Resident models, the default model (model_path) is pinned and serves requests naming no model
+model_pool = ModelPool(max_models=1, close=lambda served: served.close())
+default_served = None
+# Source of the models loaded by model id, to reload them after an eviction
+model_configs = {}
+# Whether requests may load hub and local models named in their model field
+load_on_request = False
 is_local_path = False
 model_type = None
 is_huggingface = False
@@ -105,6 +142,7 @@ SAMPLING_RATE = 16000
 
 # Request Classes
 class GenerationRequest(BaseModel):
+    model: Optional[str] = None
     prompt: str = "Tell me a story"
     temperature: float = 0.8
     max_new_tokens: int = 128
@@ -113,6 +151,8 @@ class GenerationRequest(BaseModel):
     stop_words: Optional[List[str]] = []
     logprobs: Optional[int] = None
     stream: Optional[bool] = False
+    n: int = 1
+    best_of: Optional[int] = None
 
 
 class TextContent(BaseModel):
@@ -142,6 +182,7 @@ class ImageResponse(BaseModel):
 
 
 class ChatCompletionRequest(BaseModel):
+    model: Optional[str] = None
     messages: List[Message] = [
         {"role": "user", "content": "Tell me a story"}]
     max_tokens: Optional[int] = 128
@@ -152,9 +193,13 @@ class ChatCompletionRequest(BaseModel):
     top_logprobs: Optional[int] = 4
     top_k: Optional[int] = 40
     top_p: Optional[float] = 0.95
+    session_id: Optional[str] = None
+    n: int = 1
+    best_of: Optional[int] = None
 
 
 class VLMChatCompletionRequest(BaseModel):
+    model: Optional[str] = None
     messages: List[Message] = [
         {"role": "user", "content": [
             {"type": "text", "text": "What's in this image?"},
@@ -207,9 +252,13 @@ class FunctionCallRequest(BaseModel):
             Defines the available function calls that can be executed.
         messages (List[Dict[str, Any]]):
             A list of messages representing the conversation history.
-        model_path (str):
-            The path to the model used for function calling.
+        model (Optional[str]):
+            The model used for function calling, the default model if not given.
+        tool_choice (Optional[Union[str, Dict[str, Any]]]):
+            "none", "auto" or the tool to call.
     """
+    model: Optional[str] = None
+    tool_choice: Optional[Union[str, Dict[str, Any]]] = None
     tools: List[Dict[str, Any]] = [
         {
             "type": "function",
@@ -243,10 +292,15 @@ class FunctionCallRequest(BaseModel):
 
 # New request class for embeddings
 class EmbeddingRequest(BaseModel):
+    model: Optional[str] = None
     input: Union[str, List[str]] = Field(
         ..., description="The input text to get embeddings for. Can be a string or an array of strings.")
     normalize: Optional[bool] = False
     truncate: Optional[bool] = True
+    encoding_format: Optional[str] = Field(
+        "float", description="One of float, base64 (float32), float16, int8 or binary (sign bits).")
+    dimensions: Optional[int] = Field(
+        None, description="Keep only the first dimensions of each embedding (Matryoshka models), applied before normalize.")
 
 
 class LoadModelRequest(BaseModel):
@@ -351,11 +405,284 @@ class MetricsResult:
         return json.dumps(self.to_dict())
 
 
+class EmbeddingBatcher:
+    """Embeds the texts of concurrent /v1/embeddings requests in shared batches.
+
+    Requests are tokenized on arrival and queued. The first queued request
+    waits at most `max_wait` seconds for others, or until the queue holds
+    n_batch tokens, then all of them are embedded with one `Llama.embed_array`
+    call, made with `run` (the decode thread of the model), while the next
+    requests queue up.
+    """
+
+    def __init__(self, llm, run=None, max_wait=0.005):
+        self.llm = llm
+        self.run = run
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    async def embed(self, texts, truncate=True):
+        """Return the embeddings of `texts` and their number of tokens."""
+        inputs_tokens = [self.llm.tokenize_array(text.encode("utf-8")) for text in texts]
+        if truncate:
+            inputs_tokens = [tokens[: self.llm.n_batch] for tokens in inputs_tokens]
+        elif any(len(tokens) > self.llm.n_batch for tokens in inputs_tokens):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Input exceeds the batch size of {self.llm.n_batch} tokens, set truncate to true")
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((inputs_tokens, future))
+        try:
+            embeddings = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The model is in use until the batch holding the texts is embedded
+            await asyncio.wait([future])
+            raise
+        return embeddings, sum(len(tokens) for tokens in inputs_tokens)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            n_tokens = sum(len(tokens) for tokens in requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while n_tokens < self.llm.n_batch:
+                try:
+                    if self.queue.empty():
+                        request = await asyncio.wait_for(
+                            self.queue.get(), max(deadline - loop.time(), 0))
+                    else:
+                        request = self.queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                n_tokens += sum(len(tokens) for tokens in request[0])
+
+            batch = [tokens for inputs_tokens, _ in requests for tokens in inputs_tokens]
+            try:
+                if self.run is not None:
+                    embeddings = await self.run(self.llm.embed_array, batch)
+                else:
+                    embeddings = await loop.run_in_executor(None, self.llm.embed_array, batch)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for inputs_tokens, future in requests:
+                if not future.done():
+                    future.set_result(embeddings[start : start + len(inputs_tokens)])
+                start += len(inputs_tokens)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class ServedModel:
+    """A loaded model with its per-model server state, the value of a model pool entry."""
+
+    def __init__(
+        self,
+        model_id,
+        model,
+        model_type,
+        downloaded_path=None,
+        chat_format=None,
+        completion_template=None,
+        session_slots=None,
+        system_prompt=True,
+    ):
+        self.model_id = model_id
+        self.model = model
+        self.model_type = model_type
+        self.downloaded_path = downloaded_path
+        self.chat_format = chat_format
+        self.completion_template = completion_template
+        self.session_slots = session_slots
+        # Whether chat completions get the default system prompt, not for local or Hugging Face models
+        self.system_prompt = system_prompt
+        self.async_model = None
+        self.embedding_batcher = None
+
+    def decoder(self):
+        """Decode thread of the model, started on first use."""
+        if self.async_model is None:
+            self.async_model = AsyncLlama(self.model)
+        return self.async_model
+
+    def embedder(self):
+        """Embedding batcher of the model, started on first use."""
+        if self.embedding_batcher is None:
+            self.embedding_batcher = EmbeddingBatcher(
+                self.model, run=self.decoder().run, max_wait=embedding_wait)
+        return self.embedding_batcher
+
+    def close(self):
+        # Spilled sessions and the n-gram cache are picked up again when the model is reloaded
+        if self.session_slots is not None:
+            self.session_slots.spill_all()
+            self.session_slots = None
+        if self.downloaded_path is not None:
+            _save_ngram_cache(self.downloaded_path)
+        if self.async_model is not None:
+            self.async_model.close()
+        if self.embedding_batcher is not None:
+            self.embedding_batcher.close()
+        if hasattr(self.model, "close"):
+            self.model.close()
+
+
 # helper functions
-async def load_model():
-    global model, chat_format, completion_template, model_path, n_ctx, is_local_path, model_type, is_huggingface, is_modelscope, projector_path
-    global use_function_calling
+def _model_key(downloaded_path):
+    stat = os.stat(downloaded_path)
+    return f"{Path(downloaded_path).stem}-{stat.st_size}"
+
+
+def _session_store_for(downloaded_path):
+    """Spill directory for idle chat sessions, one per model file since KV state is model specific."""
+    if not session_spill_dir:
+        return None
+    return LlamaSessionStore(
+        os.path.join(session_spill_dir, _model_key(downloaded_path)),
+        capacity_bytes=session_spill_size,
+    )
+
+
+def _ngram_cache_path(downloaded_path):
+    if not ngram_cache_dir:
+        return None
+    return os.path.join(ngram_cache_dir, f"{_model_key(downloaded_path)}.npz")
+
+
+def _save_ngram_cache(downloaded_path=None):
+    """Persist the n-gram cache of `downloaded_path`, or of every model, to --ngram_cache_dir."""
+    paths = [downloaded_path] if downloaded_path is not None else list(ngram_caches)
+    for path in paths:
+        if path in ngram_caches and _ngram_cache_path(path) is not None:
+            ngram_caches[path].save(_ngram_cache_path(path))
+
+
+def _ngram_cache_for(downloaded_path):
+    """Cross-request n-gram cache of a model, token ids are model specific."""
+    from nexa.gguf.llama.llama_speculative import LlamaNgramCache
+    if downloaded_path in ngram_caches:
+        return ngram_caches[downloaded_path]
+    cache = ngram_caches[downloaded_path] = LlamaNgramCache()
+    path = _ngram_cache_path(downloaded_path)
+    if path is not None and os.path.exists(path):
+        try:
+            cache.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable n-gram cache {path}: {e}")
+    return cache
+
+
+def _kv_cache_params(downloaded_path, n_slots):
+    """Llama n_ctx and KV cache settings and the number of sessions, planned to fit --memory_budget_gb when set.
+
+    With a budget, --nctx is the context of each of the n_slots sessions (0 for the training context).
+    """
+    from nexa.gguf.llama.llama_kv_planner import kv_cache_type, plan_kv_cache
+    if memory_budget_gb is None:
+        params = dict(
+            n_ctx=n_ctx,
+            type_k=kv_cache_type(kv_type_k) if kv_type_k else None,
+            type_v=kv_cache_type(kv_type_v) if kv_type_v else None,
+            flash_attn=flash_attn,
+        )
+        return params, n_slots
+    plan = plan_kv_cache(
+        downloaded_path,
+        memory_budget=int(memory_budget_gb * (1 << 30)) if memory_budget_gb > 0 else None,
+        n_ctx=n_ctx or None,
+        n_slots=n_slots,
+        flash_attn=flash_attn,
+        logits_all=True,
+        kv_types=[(kv_type_k or "f16", kv_type_v or "f16")] if kv_type_k or kv_type_v else None,
+    )
+    logging.info(plan.report())
+    params = dict(n_ctx=plan.n_ctx, type_k=plan.type_k_id, type_v=plan.type_v_id, flash_attn=flash_attn)
+    return params, plan.n_slots if n_slots > 0 else 0
+
+
+def _draft_model_for(model_type, downloaded_path, target_n_ctx):
+    """Speculative decoding draft model for NLP models, from --draft_model_path or --ngram_cache.
+
+    The draft model gets the planned context of the target, 0 being the training context of each. It is
+    loaded on the GPU when there is one, and falls back to CPU on its own, independently of the target.
+    """
+    if model_type != "NLP":
+        return None
+    if draft_model_path:
+        from nexa.gguf.llama.llama_speculative import LlamaGGUFDraftModel
+
+        def load(n_gpu_layers):
+            return LlamaGGUFDraftModel(
+                model_path=draft_model_path,
+                max_pred_tokens=draft_max_tokens,
+                acceptance=draft_acceptance,
+                n_ctx=target_n_ctx,
+                n_gpu_layers=n_gpu_layers,
+            )
+
+        if not is_gpu_available():
+            return load(0)
+        try:
+            return load(-1)
+        except Exception as e:
+            logging.error(f"Failed to load draft model: {e}. Falling back to CPU.", exc_info=True)
+            return load(0)
+    if use_ngram_cache:
+        from nexa.gguf.llama.llama_speculative import LlamaNgramCacheDraft
+        return LlamaNgramCacheDraft(_ngram_cache_for(downloaded_path))
+    return None
+
+
+def _resident_bytes(model_type, paths):
+    """Estimated memory of a model: its files, plus the KV cache of the text models."""
+    size = sum(os.path.getsize(path) for path in paths if path and os.path.isfile(path))
+    if model_type in ("NLP", "Text Embedding") and paths[0] and os.path.isfile(paths[0]):
+        from nexa.gguf.llama.llama_kv_planner import LlamaModelDims
+        try:
+            dims = LlamaModelDims.from_file(paths[0])
+        except Exception as e:
+            logging.warning(f"Cannot estimate the KV cache of {paths[0]}: {e}")
+            return size
+        size += int(dims.kv_bytes_per_token(kv_type_k or "f16", kv_type_v or "f16") * (n_ctx or dims.n_ctx_train))
+        if memory_budget_gb:
+            # The KV cache is planned to fit the budget with the weights
+            size = min(size, int(memory_budget_gb * (1 << 30)))
+    return size
+
+
+async def _load_served_model(model_path, reserve, model_type=None, is_local_path=False, is_huggingface=False, is_modelscope=False, projector_path=None):
+    """Load a model for the model pool, calling `reserve` with its estimated memory before allocating it.
 
+    Pulling and loading run in the default executor, requests to resident models are served meanwhile.
+    """
+    loop = asyncio.get_running_loop()
+    load_start = time.perf_counter()
+    downloaded_path, projector_downloaded_path, model_type = await loop.run_in_executor(
+        None, functools.partial(
+            _pull_served_model, model_path, model_type, is_local_path, is_huggingface, is_modelscope, projector_path))
+    reserve(_resident_bytes(model_type, [downloaded_path, projector_downloaded_path]))
+    served = await loop.run_in_executor(
+        None, functools.partial(
+            _build_served_model, model_path, model_type, downloaded_path,
+            system_prompt=not (is_local_path or is_huggingface or is_modelscope)))
+    server_metrics.model_loaded(model_path, time.perf_counter() - load_start)
+    return served
+
+
+def _pull_served_model(model_path, model_type, is_local_path, is_huggingface, is_modelscope, projector_path):
+    """Files of a model, pulled unless local: (downloaded_path, projector_downloaded_path, model_type)."""
+    projector_downloaded_path = None
     if is_local_path:
         if model_type == "Multimodal":
             if not projector_path:
@@ -401,14 +728,27 @@ async def load_model():
             "Function calling is only supported for NLP models. "
             "Please ensure that you are using a compatible NLP model before enabling this feature."
         )
+    return downloaded_path, projector_downloaded_path, model_type
+
+
+def _build_served_model(model_path, model_type, downloaded_path, system_prompt=True):
+    """Load the pulled files of a model, allocating its memory."""
+    model = None
+    chat_format = None
+    completion_template = None
+    session_slots = None
 
     if model_type == "NLP" or model_type == "Text Embedding":
         if model_type == "NLP" and use_function_calling:
             from nexa.gguf.nexa_inference_text import NexaTextInference
             model = NexaTextInference(
-                model_path=model_path, function_calling=True)
+                model_path=model_path, function_calling=True, prefetch=prefetch,
+                jump_forward=jump_forward, autotune=autotune, numa_node=numa_node,
+                nctx=n_ctx, type_k=kv_type_k, type_v=kv_type_v, flash_attn=flash_attn,
+                memory_budget_gb=memory_budget_gb)
         elif model_path in NEXA_RUN_MODEL_MAP_FUNCTION_CALLING:
             chat_format = "chatml-function-calling"
+            kv_cache_params, _ = _kv_cache_params(downloaded_path, 1)
             with suppress_stdout_stderr():
                 try:
                     model = Llama(
@@ -417,8 +757,14 @@ async def load_model():
                         chat_format=chat_format,
                         n_gpu_layers=-1 if is_gpu_available() else 0,
                         logits_all=True,
-                        n_ctx=n_ctx,
-                        embedding=False
+                        embedding=False,
+                        prefetch=prefetch,
+                        autotune=autotune,
+                        numa_node=numa_node,
+                        # A node-local copy of the weights rather than page cache shared across nodes
+                        use_mmap=numa_node is None,
+                        timing_collector=server_metrics.timings,
+                        **kv_cache_params,
                     )
                 except Exception as e:
                     logging.error(
@@ -430,8 +776,14 @@ async def load_model():
                         chat_format=chat_format,
                         n_gpu_layers=0,  # hardcode to use CPU,
                         logits_all=True,
-                        n_ctx=n_ctx,
-                        embedding=False
+                        embedding=False,
+                        prefetch=prefetch,
+                        autotune=autotune,
+                        numa_node=numa_node,
+                        # A node-local copy of the weights rather than page cache shared across nodes
+                        use_mmap=numa_node is None,
+                        timing_collector=server_metrics.timings,
+                        **kv_cache_params,
                     )
 
                 logging.info(f"NLP model loaded as {model}")
@@ -440,7 +792,13 @@ async def load_model():
             chat_format = NEXA_RUN_CHAT_TEMPLATE_MAP.get(model_name, None)
             completion_template = NEXA_RUN_COMPLETION_TEMPLATE_MAP.get(
                 model_name, None)
+            kv_cache_params, sessions = _kv_cache_params(
+                downloaded_path, n_sessions if model_type == "NLP" else 0)
+            # Session slots use the lowest sequence ids, parallel samples (n, best_of) the highest
+            n_seq_max = sessions + max_samples if model_type == "NLP" else 1
             with suppress_stdout_stderr():
+                # Loaded once, the CPU fallback of the model keeps it
+                draft_model = _draft_model_for(model_type, downloaded_path, kv_cache_params["n_ctx"])
                 try:
                     model = Llama(
                         model_path=downloaded_path,
@@ -448,8 +806,17 @@ async def load_model():
                         chat_format=chat_format,
                         n_gpu_layers=-1 if is_gpu_available() else 0,
                         logits_all=True,
-                        n_ctx=n_ctx,
-                        embedding=model_type == "Text Embedding"
+                        n_seq_max=n_seq_max,
+                        embedding=model_type == "Text Embedding",
+                        prefetch=prefetch,
+                        context_shift=context_shift,
+                        autotune=autotune,
+                        numa_node=numa_node,
+                        # A node-local copy of the weights rather than page cache shared across nodes
+                        use_mmap=numa_node is None,
+                        timing_collector=server_metrics.timings,
+                        draft_model=draft_model,
+                        **kv_cache_params,
                     )
                 except Exception as e:
                     logging.error(
@@ -461,10 +828,28 @@ async def load_model():
                         chat_format=chat_format,
                         n_gpu_layers=0,  # hardcode to use CPU
                         logits_all=True,
-                        n_ctx=n_ctx,
-                        embedding=model_type == "Text Embedding"
+                        n_seq_max=n_seq_max,
+                        embedding=model_type == "Text Embedding",
+                        prefetch=prefetch,
+                        context_shift=context_shift,
+                        autotune=autotune,
+                        numa_node=numa_node,
+                        # A node-local copy of the weights rather than page cache shared across nodes
+                        use_mmap=numa_node is None,
+                        timing_collector=server_metrics.timings,
+                        draft_model=draft_model,
+                        **kv_cache_params,
                     )
                 logging.info(f"model loaded as {model}")
+                session_slots = (
+                    LlamaSessionSlots(
+                        model,
+                        n_slots=sessions,
+                        store=_session_store_for(downloaded_path),
+                    )
+                    if model_type == "NLP" and sessions > 0
+                    else None
+                )
                 chat_format = model.metadata.get(
                     "tokenizer.chat_template", None)
 
@@ -509,7 +894,9 @@ async def load_model():
                 try:
                     model = NexaVLMInference(
                         model_path=model_path,
-                        device="gpu" if is_gpu_available() else "cpu"
+                        device="gpu" if is_gpu_available() else "cpu",
+                        autotune=autotune,
+                        numa_node=numa_node,
                     )
                 except Exception as e:
                     logging.error(
@@ -518,7 +905,9 @@ async def load_model():
                     )
                     model = NexaVLMInference(
                         model_path=model_path,
-                        device="cpu"
+                        device="cpu",
+                        autotune=autotune,
+                        numa_node=numa_node,
                     )
         logging.info(f"Model loaded as {model}")
     elif model_type == "AudioLM":
@@ -542,6 +931,48 @@ async def load_model():
     else:
         raise ValueError(
             f"Model {model_path} not found in Model Hub. If you are using local path, be sure to add --local_path and --model_type flags.")
+    return ServedModel(
+        model_path,
+        model,
+        model_type,
+        downloaded_path=downloaded_path,
+        chat_format=chat_format,
+        completion_template=completion_template,
+        session_slots=session_slots,
+        system_prompt=system_prompt,
+    )
+
+
+async def load_model():
+    """Make model_path the default model, loading it into the model pool unless it is resident."""
+    global model, chat_format, completion_template, model_type, session_slots, default_served
+    model_configs[model_path] = dict(
+        model_type=model_type,
+        is_local_path=is_local_path,
+        is_huggingface=is_huggingface,
+        is_modelscope=is_modelscope,
+        projector_path=projector_path,
+    )
+    previous = default_served.model_id if default_served is not None else None
+    if previous is not None:
+        # The previous default model stays resident while the pool has room for it
+        model_pool.pin(previous, False)
+    try:
+        entry = await model_pool.acquire(
+            model_path, functools.partial(_load_served_model, model_path, **model_configs[model_path]))
+    except Exception:
+        if previous is not None:
+            model_pool.pin(previous)
+        raise
+    model_pool.pin(model_path)
+    model_pool.release(entry)
+
+    default_served = entry.value
+    model = default_served.model
+    model_type = default_served.model_type
+    chat_format = default_served.chat_format
+    completion_template = default_served.completion_template
+    session_slots = default_served.session_slots
 
 
 async def load_whisper_model(custom_whisper_model_path=None):
@@ -563,23 +994,28 @@ async def load_whisper_model(custom_whisper_model_path=None):
 
 
 def nexa_run_text_generation(
-    prompt, temperature, stop_words, max_new_tokens, top_k, top_p, messages=[], logprobs=None, stream=False, is_chat_completion=True, **kwargs
+    prompt, temperature, stop_words, max_new_tokens, top_k, top_p, messages=[], logprobs=None, stream=False, is_chat_completion=True, served=None, **kwargs
 ) -> Dict[str, Any]:
-    global model, chat_format, completion_template
-    if model is None:
+    served = served or default_served
+    if served is None or served.model is None:
         raise ValueError(
             "Model is not loaded. Please check the model path and try again.")
+    model = served.model
+    session_slots = served.session_slots
 
     generated_text = ""
     logprobs_or_none = None
+    n = kwargs.get("n", 1)
+    best_of = kwargs.get("best_of") or n
+
+    if session_slots is not None:
+        # Requests without a session_id still park the active session first
+        session_slots.activate(kwargs.get("session_id"))
 
     if is_chat_completion:
         # do not add system prompt if local path or huggingface or modelscope
-        if is_local_path or is_huggingface or is_modelscope:
-            pass
-        else:
-            if messages[0]['role'] != 'system':
-                messages = default_chat_completion_system_prompt + messages
+        if served.system_prompt and messages[0]['role'] != 'system':
+            messages = default_chat_completion_system_prompt + messages
 
         params = {
             'messages': messages,
@@ -592,10 +1028,16 @@ def nexa_run_text_generation(
             'logprobs': logprobs
         }
 
+        if n > 1 or best_of > 1:
+            params.update(stream=False, logprobs=None, n=n, best_of=best_of)
+            completion = model.create_chat_completion(**params)
+            results = [choice["message"]["content"] for choice in completion["choices"]]
+            return {"result": results[0], "results": results, "logprobs": None}
+
         streamer = model.create_chat_completion(**params)
     else:
-        if completion_template:
-            formatted_prompt = completion_template.format(input=prompt)
+        if served.completion_template:
+            formatted_prompt = served.completion_template.format(input=prompt)
         else:
             formatted_prompt = prompt
 
@@ -610,6 +1052,12 @@ def nexa_run_text_generation(
             'logprobs': logprobs,
         }
 
+        if n > 1 or best_of > 1:
+            params.update(stream=False, logprobs=None, n=n, best_of=best_of)
+            completion = model.create_completion(**params)
+            results = [choice["text"] for choice in completion["choices"]]
+            return {"result": results[0], "results": results, "logprobs": None}
+
         streamer = model.create_completion(**params)
 
     if stream:
@@ -817,7 +1265,8 @@ def load_audio_from_bytes(audio_bytes: bytes):
 
 
 def run_nexa_ai_service(model_path_arg=None, is_local_path_arg=False, model_type_arg=None, huggingface=False, modelscope=False, function_calling=False, projector_local_path_arg=None, **kwargs):
-    global model_path, n_ctx, is_local_path, model_type, is_huggingface, is_modelscope, projector_path, use_function_calling
+    global model_path, n_ctx, prefetch, context_shift, autotune, numa_node, kv_type_k, kv_type_v, flash_attn, memory_budget_gb, n_sessions, max_samples, session_spill_dir, session_spill_size, is_local_path, model_type, is_huggingface, is_modelscope, projector_path, use_function_calling
+    global draft_model_path, draft_max_tokens, draft_acceptance, use_ngram_cache, ngram_cache_dir, embedding_wait, jump_forward, load_on_request
     is_local_path = is_local_path_arg
     is_huggingface = huggingface
     is_modelscope = modelscope
@@ -837,14 +1286,95 @@ def run_nexa_ai_service(model_path_arg=None, is_local_path_arg=False, model_type
         model_path = model_path_arg
         model_type = None
     n_ctx = kwargs.get("nctx", 2048)
+    prefetch = kwargs.get("prefetch", "none")
+    context_shift = kwargs.get("context_shift", False)
+    autotune = kwargs.get("autotune", False)
+    numa_node = kwargs.get("numa_node", None)
+    kv_type_k = kwargs.get("type_k", None)
+    kv_type_v = kwargs.get("type_v", None)
+    flash_attn = kwargs.get("flash_attn", False)
+    memory_budget_gb = kwargs.get("memory_budget_gb", None)
+    n_sessions = kwargs.get("sessions", 4)
+    max_samples = max(kwargs.get("max_samples", 4), 1)
+    session_spill_dir = kwargs.get("session_dir", None)
+    session_spill_size = int(kwargs.get("session_dir_gb", 2) * (1 << 30))
+    draft_model_path = kwargs.get("draft_model_path", None)
+    draft_max_tokens = kwargs.get("draft_max_tokens", 16)
+    draft_acceptance = kwargs.get("draft_acceptance", "greedy")
+    ngram_cache_dir = kwargs.get("ngram_cache_dir", None)
+    use_ngram_cache = kwargs.get("ngram_cache", False) or ngram_cache_dir is not None
+    embedding_wait = kwargs.get("embedding_wait_ms", 5) / 1000
+    jump_forward = kwargs.get("jump_forward", False)
+    pool_budget_gb = kwargs.get("pool_budget_gb", None)
+    if pool_budget_gb is not None:
+        from nexa.gguf.llama.llama_kv_planner import available_memory
+        model_pool.budget_bytes = int(pool_budget_gb * (1 << 30)) if pool_budget_gb > 0 else available_memory()
+    max_models = kwargs.get("max_models", None)
+    if max_models is None:
+        # One model at a time unless a memory budget bounds the pool
+        max_models = 1 if pool_budget_gb is None else 0
+    model_pool.max_models = max_models or None
+    load_on_request = kwargs.get("load_on_request", False)
     host = kwargs.get("host", "localhost")
     port = kwargs.get("port", 8000)
     reload = kwargs.get("reload", False)
 
-    uvicorn.run(app, host=host, port=port, reload=reload)
+    if kwargs.get("numa_workers", False):
+        from nexa.gguf.llama.llama_numa import numa_nodes
+
+        nodes = list(numa_nodes())
+        if len(nodes) > 1:
+            if reload:
+                raise ValueError("--reload cannot be used with --numa_workers")
+            service_args = dict(
+                model_path_arg=model_path_arg,
+                is_local_path_arg=is_local_path_arg,
+                model_type_arg=model_type_arg,
+                huggingface=huggingface,
+                modelscope=modelscope,
+                function_calling=function_calling,
+                projector_local_path_arg=projector_local_path_arg,
+            )
+            _run_numa_workers(nodes, service_args, kwargs)
+            return
+        numa_node = nodes[0]
+
+    sockets = kwargs.get("sockets")
+    if sockets is not None:
+        # A NUMA worker accepting on the socket bound by the parent process
+        uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=sockets)
+    else:
+        uvicorn.run(app, host=host, port=port, reload=reload)
     # uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
+def _run_numa_workers(nodes, service_args, kwargs):
+    """Serve from one process per NUMA node, each with its own model, all accepting on one socket."""
+    config = uvicorn.Config(app, host=kwargs.get("host", "localhost"), port=kwargs.get("port", 8000))
+    sock = config.bind_socket()
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for node in nodes:
+        worker_kwargs = dict(kwargs, numa_workers=False, numa_node=node, sockets=[sock])
+        worker = context.Process(
+            target=run_nexa_ai_service,
+            kwargs=dict(service_args, **worker_kwargs),
+            name=f"nexa-numa-worker-{node}",
+        )
+        worker.start()
+        workers.append(worker)
+    logging.info(f"Started {len(workers)} workers on NUMA nodes {nodes}")
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        sock.close()
+
+
 # Endpoints
 @app.on_event("startup")
 async def startup_event():
@@ -856,6 +1386,13 @@ async def startup_event():
             "No model path provided. Server started without loading a model.")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Spilled sessions and the n-gram caches are picked up again by the next server start
+    model_pool.close()
+    _save_ngram_cache()
+
+
 @app.get("/", response_class=HTMLResponse, tags=["Root"])
 async def read_root(request: Request):
     return HTMLResponse(
@@ -863,25 +1400,41 @@ async def read_root(request: Request):
     )
 
 
-def _resp_async_generator(streamer, start_time):
+async def _resp_async_generator(streamer, start_time, record=None, entry=None):
     _id = str(uuid.uuid4())
     ttft = 0
     decoding_times = 0
     first_token_time = 0
-    for token in streamer:
-        ttft = time.perf_counter() - start_time if ttft == 0 else ttft
-        first_token_time = time.perf_counter() if first_token_time == 0 else first_token_time
-        decoding_times += 1
-        chunk = {
-            "id": _id,
-            "object": "chat.completion.chunk",
-            "created": time.time(),
-            "choices": [{"delta": {"content": token}}],
-        }
-        yield f"data: {json.dumps(chunk)}\n\n"
+    status = "error"
+    try:
+        async for token in streamer:
+            ttft = time.perf_counter() - start_time if ttft == 0 else ttft
+            first_token_time = time.perf_counter() if first_token_time == 0 else first_token_time
+            decoding_times += 1
+            chunk = {
+                "id": _id,
+                "object": "chat.completion.chunk",
+                "created": time.time(),
+                "choices": [{"delta": {"content": token}}],
+            }
+            if record is not None:
+                server_metrics.chunk(record)
+            yield f"data: {json.dumps(chunk)}\n\n"
 
-    yield f"metrics: {MetricsResult(ttft=ttft, decoding_speed=decoding_times / (time.perf_counter() - first_token_time)).to_json()}\n\n"
-    yield "data: [DONE]\n\n"
+        yield f"metrics: {MetricsResult(ttft=ttft, decoding_speed=decoding_times / (time.perf_counter() - first_token_time)).to_json()}\n\n"
+        yield "data: [DONE]\n\n"
+        status = "ok"
+    except (GeneratorExit, asyncio.CancelledError):
+        # The client went away
+        status = "cancelled"
+        raise
+    finally:
+        if record is not None:
+            server_metrics.finish(record, status)
+        if entry is not None:
+            # The model is in use until its stream ends and the decode thread lets go of it
+            await streamer.aclose()
+            model_pool.release(entry)
 
 
 # Global variable for download progress tracking
@@ -1141,7 +1694,7 @@ async def get_download_progress(model_path: str):
 
 @app.post("/v1/load_model", tags=["Model"])
 async def load_different_model(request: LoadModelRequest):
-    """Load a different model while maintaining the global model state"""
+    """Make a model the default one, instantly when it is resident in the model pool"""
     try:
         global model_path, is_local_path, model_type, is_huggingface, is_modelscope, projector_path
 
@@ -1172,16 +1725,22 @@ async def load_different_model(request: LoadModelRequest):
 
 @app.post("/v1/unload_model", tags=["Model"])
 async def unload_different_model(request: LoadModelRequest):
-    """Load a different model while maintaining the global model state"""
+    """Unload a resident model of the model pool, or else the default model"""
     try:
-        global model
-        if model:
-            model.close()
+        global model, session_slots, default_served
+        unloaded = request.model_path if request.model_path in model_pool else model_path
+        unloaded_type = model_pool.entries[unloaded].value.model_type if unloaded in model_pool else model_type
+        # Closed once the requests using it are done
+        model_pool.remove(unloaded)
+        if default_served is not None and unloaded == default_served.model_id:
+            model = None
+            session_slots = None
+            default_served = None
 
         return {
             "status": "succeed",
-            "message": f"Successfully unloaded model: {model_path}",
-            "model_type": model_type
+            "message": f"Successfully unloaded model: {unloaded}",
+            "model_type": unloaded_type
         }
 
     except Exception as e:
@@ -1249,10 +1808,71 @@ async def delete_model(request: DeleteModelRequest):
         raise HTTPException(status_code=404, detail=f"Model not found: {request.model_path}")
     return JSONResponse(content={"status": "success", "message": f"Successfully deleted model: {request.model_path}"})
 
+def _model_id_for(requested):
+    """Model serving a request naming `requested`: a resident or loaded before model, else the default model.
+
+    Hub and local models that were never loaded are only served with --load_on_request. Unknown names
+    fall back to the default model, OpenAI clients often send one regardless of the server.
+    """
+    if not requested:
+        return default_served.model_id if default_served is not None else None
+    if requested in model_pool or requested in model_configs:
+        return requested
+    if load_on_request and (
+        requested in NEXA_RUN_MODEL_MAP
+        or requested in NEXA_RUN_MODEL_MAP_VLM
+        or requested in NEXA_RUN_OMNI_VLM_MAP
+        or requested in NEXA_RUN_MODEL_MAP_AUDIO_LM
+        or is_model_exists(requested)
+    ):
+        return requested
+    return default_served.model_id if default_served is not None else None
+
+
+async def _acquire_model(model_id):
+    """Model pool entry serving `model_id`, loaded on a miss and in use until `model_pool.release`.
+
+    When the pool has no room for the model, the request is served by the default model, or gets a 503
+    without one.
+    """
+    if model_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail="No model is loaded. Load one with /v1/load_model or name it in the model field.")
+    try:
+        return await model_pool.acquire(
+            model_id, functools.partial(_load_served_model, model_id, **model_configs.get(model_id, {})))
+    except ModelPoolFull as e:
+        if default_served is None or default_served.model_id == model_id:
+            raise HTTPException(status_code=503, detail=f"{e}, retry once the requests in flight are done")
+        logging.warning(f"{e}, serving the request with the default model {default_served.model_id}")
+        return await _acquire_model(default_served.model_id)
+
+
+def _check_samples(request):
+    best_of = request.best_of or request.n
+    if request.n < 1 or best_of < request.n:
+        raise HTTPException(
+            status_code=400, detail="Expected 1 <= n <= best_of")
+    if best_of > max_samples:
+        raise HTTPException(
+            status_code=400,
+            detail=f"n and best_of are limited to {max_samples}, see --max_samples")
+    if request.stream and best_of > 1:
+        raise HTTPException(
+            status_code=400, detail="n > 1 and best_of > 1 cannot be streamed")
+
+
 @app.post("/v1/completions", tags=["NLP"])
 async def generate_text(request: GenerationRequest):
+    _check_samples(request)
+    model_id = _model_id_for(request.model)
+    record = server_metrics.start("/v1/completions", model_id)
+    entry = None
     try:
-        if model_type != "NLP":
+        entry = await _acquire_model(model_id)
+        served = entry.value
+        if served.model_type != "NLP":
             raise HTTPException(
                 status_code=400,
                 detail="The model that is loaded is not an NLP model. Please use an NLP model for text generation."
@@ -1261,35 +1881,56 @@ async def generate_text(request: GenerationRequest):
         if request.stream:
             # Run the generation and stream the response
             start_time = time.perf_counter()
-            streamer = nexa_run_text_generation(
-                is_chat_completion=False, **generation_kwargs)
-            return StreamingResponse(_resp_async_generator(streamer, start_time), media_type="application/x-ndjson")
+            streamer = served.decoder().iterate(server_metrics.decoding(
+                record, lambda: nexa_run_text_generation(is_chat_completion=False, served=served, **generation_kwargs)))
+            response = StreamingResponse(_resp_async_generator(streamer, start_time, record, entry), media_type="application/x-ndjson")
+            # Released when the stream ends
+            entry = None
+            return response
         else:
-            # Generate text synchronously and return the response
-            result = nexa_run_text_generation(
-                is_chat_completion=False, **generation_kwargs)
+            # Generate text on the decode thread and return the response
+            result = await served.decoder().run(
+                server_metrics.decoding(record, nexa_run_text_generation),
+                is_chat_completion=False, served=served, **generation_kwargs)
+            server_metrics.finish(record)
             return JSONResponse(content={
                 "id": str(uuid.uuid4()),
                 "object": "text_completion",
                 "created": int(time.time()),
-                "model": model_path,
+                "model": served.model_id,
                 "choices": [{
-                    "text": result["result"],
-                    "index": 0,
+                    "text": text,
+                    "index": index,
                     "logprobs": result.get("logprobs"),
                     "finish_reason": "stop"
-                }]
+                } for index, text in enumerate(result.get("results", [result["result"]]))]
             })
+    except asyncio.CancelledError:
+        server_metrics.finish(record, "cancelled")
+        raise
+    except HTTPException as e:
+        server_metrics.finish(record, "error")
+        raise e
     except Exception as e:
+        server_metrics.finish(record, "error")
         logging.error(f"Error in text generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if entry is not None:
+            model_pool.release(entry)
 
 
 @app.post("/v1/chat/completions", tags=["NLP"])
 async def text_chat_completions(request: ChatCompletionRequest):
     """Endpoint for text-only chat completions using NLP models"""
+    _check_samples(request)
+    model_id = _model_id_for(request.model)
+    record = server_metrics.start("/v1/chat/completions", model_id)
+    entry = None
     try:
-        if model_type != "NLP":
+        entry = await _acquire_model(model_id)
+        served = entry.value
+        if served.model_type != "NLP":
             raise HTTPException(
                 status_code=400,
                 detail="The model that is loaded is not an NLP model. Please use an NLP model for text chat completion."
@@ -1303,34 +1944,110 @@ async def text_chat_completions(request: ChatCompletionRequest):
 
         if request.stream:
             start_time = time.perf_counter()
-            streamer = nexa_run_text_generation(
-                None, max_new_tokens=request.max_tokens, is_chat_completion=True, **request.dict())
-            return StreamingResponse(_resp_async_generator(streamer, start_time), media_type="application/x-ndjson")
-
-        result = nexa_run_text_generation(
-            None, max_new_tokens=request.max_tokens, is_chat_completion=True, **request.dict())
+            streamer = served.decoder().iterate(server_metrics.decoding(
+                record, lambda: nexa_run_text_generation(
+                    None, max_new_tokens=request.max_tokens, is_chat_completion=True, served=served, **request.dict())))
+            response = StreamingResponse(_resp_async_generator(streamer, start_time, record, entry), media_type="application/x-ndjson")
+            # Released when the stream ends
+            entry = None
+            return response
+
+        result = await served.decoder().run(
+            server_metrics.decoding(record, nexa_run_text_generation),
+            None, max_new_tokens=request.max_tokens, is_chat_completion=True, served=served, **request.dict())
+        server_metrics.finish(record)
         return {
             "id": str(uuid.uuid4()),
             "object": "chat.completion",
             "created": time.time(),
+            "model": served.model_id,
             "choices": [{
-                "message": Message(role="assistant", content=result["result"]),
+                "index": index,
+                "message": Message(role="assistant", content=text),
                 "logprobs": result["logprobs"] if "logprobs" in result else None,
-            }],
+            } for index, text in enumerate(result.get("results", [result["result"]]))],
         }
 
+    except asyncio.CancelledError:
+        server_metrics.finish(record, "cancelled")
+        raise
     except HTTPException as e:
+        server_metrics.finish(record, "error")
         raise e
+    except ValueError as e:
+        # Parameters the model cannot honor, e.g. n > 1 with a chat handler that does not take it
+        server_metrics.finish(record, "error")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        server_metrics.finish(record, "error")
         logging.error(f"Error in text chat completions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if entry is not None:
+            model_pool.release(entry)
+
+
+@app.get("/v1/sessions", tags=["NLP"])
+async def list_sessions():
+    """Prefix reuse statistics of the chat sessions (session_id) seen by the server"""
+    if session_slots is None:
+        return {"active_session": None, "sessions": {}}
+    return {
+        "active_session": session_slots.active_session,
+        "sessions": {
+            session_id: {
+                "resident": session_id in session_slots,
+                "requests": stats.requests,
+                "prompt_tokens": stats.prompt_tokens,
+                "prefix_hit_tokens": stats.prefix_hit_tokens,
+                "prefilled_tokens": stats.prefilled_tokens,
+                "last_prefix_hit": stats.last_prefix_hit,
+                "evictions": stats.evictions,
+                "spills": stats.spills,
+                "restores": stats.restores,
+            }
+            for session_id, stats in session_slots.stats().items()
+        },
+    }
+
+
+@app.get("/metrics", tags=["Metrics"])
+async def metrics():
+    """Prometheus metrics of the requests, decode phases, KV cache, model loads and model pool"""
+    resident, in_use, used_cells, usage = [], [], [], []
+    for entry in model_pool.entries.values():
+        labels = {"model": server_metrics.model_label(entry.model_id)}
+        resident.append(("nexa_model_resident_bytes", "Estimated memory of each resident model.",
+                         labels, entry.size_bytes))
+        in_use.append(("nexa_model_requests_in_flight", "Requests using each resident model.",
+                       labels, entry.refs))
+        llm = entry.value.model
+        # A model removed while in use is closed once released, no context is left to query then
+        if isinstance(llm, Llama) and llm._ctx.ctx is not None:
+            cells = llm.kv_cache_used_cells()
+            used_cells.append(("nexa_kv_cache_used_cells", "KV cache cells holding tokens of any sequence.",
+                               labels, cells))
+            usage.append(("nexa_kv_cache_usage_ratio", "Share of the KV cache cells in use.",
+                          labels, cells / llm.n_ctx()))
+    pool = [
+        ("nexa_model_pool_hits", "Model pool lookups served by a resident model.", {}, model_pool.hits),
+        ("nexa_model_pool_misses", "Model pool lookups that loaded the model.", {}, model_pool.misses),
+        ("nexa_model_pool_evictions", "Models closed to make room in the pool.", {}, model_pool.evictions),
+    ]
+    gauges = resident + in_use + used_cells + usage + pool
+    return Response(server_metrics.render(gauges), media_type=METRICS_CONTENT_TYPE)
 
 
 @app.post("/v1/vlm/chat/completions", tags=["Multimodal"])
 async def multimodal_chat_completions(request: VLMChatCompletionRequest):
     """Endpoint for multimodal chat completions using VLM models"""
+    model_id = _model_id_for(request.model)
+    record = server_metrics.start("/v1/vlm/chat/completions", model_id)
+    entry = None
     try:
-        if model_type != "Multimodal" or 'omni' in model_path.lower():
+        entry = await _acquire_model(model_id)
+        served = entry.value
+        if served.model_type != "Multimodal" or 'omni' in served.model_id.lower():
             raise HTTPException(
                 status_code=400,
                 detail="The model that is loaded is not a Multimodal model. Please use a Multimodal model (e.g. nanollava) for VLM."
@@ -1361,7 +2078,8 @@ async def multimodal_chat_completions(request: VLMChatCompletionRequest):
                     {"role": msg.role, "content": msg.content})
 
         start_time = time.perf_counter()
-        response = model.create_chat_completion(
+        create_chat_completion = functools.partial(
+            served.model.create_chat_completion,
             messages=processed_messages,
             max_tokens=request.max_tokens,
             temperature=request.temperature,
@@ -1372,15 +2090,30 @@ async def multimodal_chat_completions(request: VLMChatCompletionRequest):
         )
 
         if request.stream:
-
-            return StreamingResponse(_resp_async_generator(response, start_time), media_type="application/x-ndjson")
-        return response
-
+            streamer = served.decoder().iterate(
+                server_metrics.decoding(record, create_chat_completion))
+            response = StreamingResponse(_resp_async_generator(streamer, start_time, record, entry), media_type="application/x-ndjson")
+            # Released when the stream ends
+            entry = None
+            return response
+        completion = await served.decoder().run(
+            server_metrics.decoding(record, create_chat_completion))
+        server_metrics.finish(record)
+        return completion
+
+    except asyncio.CancelledError:
+        server_metrics.finish(record, "cancelled")
+        raise
     except HTTPException as e:
+        server_metrics.finish(record, "error")
         raise e
     except Exception as e:
+        server_metrics.finish(record, "error")
         logging.error(f"Error in multimodal chat completions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if entry is not None:
+            model_pool.release(entry)
 
 
 async def _resp_omnivlm_async_generator(model, prompt: str, image_path: str):
@@ -1520,28 +2253,44 @@ async def omnivlm_chat_completions(request: VLMChatCompletionRequest):
 
 @app.post("/v1/function-calling", tags=["NLP"])
 async def function_call(request: FunctionCallRequest):
+    model_id = _model_id_for(request.model)
+    record = server_metrics.start("/v1/function-calling", model_id)
+    entry = None
     try:
-        if model_type != "NLP":
+        entry = await _acquire_model(model_id)
+        served = entry.value
+        if served.model_type != "NLP":
             raise HTTPException(
                 status_code=400,
                 detail="The model that is loaded is not an NLP model. Please use an NLP model for function calling."
             )
         messages = default_function_call_system_prompt + [
-            {"role": msg.role, "content": msg.content} for msg in request.messages
+            {"role": msg["role"], "content": msg["content"]} for msg in request.messages
         ]
-        tools = [tool.dict() for tool in request.tools]
 
-        response = model.create_chat_completion(
+        # Generate on the decode thread of the model, like the other endpoints
+        response = await served.decoder().run(
+            server_metrics.decoding(record, served.model.create_chat_completion),
             messages=messages,
-            tools=tools,
+            tools=request.tools,
             tool_choice=request.tool_choice,
         )
-
+        server_metrics.finish(record)
         return response
 
+    except asyncio.CancelledError:
+        server_metrics.finish(record, "cancelled")
+        raise
+    except HTTPException as e:
+        server_metrics.finish(record, "error")
+        raise e
     except Exception as e:
+        server_metrics.finish(record, "error")
         logging.error(f"Error in function calling: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if entry is not None:
+            model_pool.release(entry)
 
 
 @app.post("/v1/txt2img", tags=["Computer Vision"])
@@ -1969,54 +2718,72 @@ async def audio_chat_completions(
 
 @app.post("/v1/embeddings", tags=["Embedding"])
 async def create_embedding(request: EmbeddingRequest):
+    model_id = _model_id_for(request.model)
+    record = server_metrics.start("/v1/embeddings", model_id)
+    entry = None
     try:
-        if model_type != "Text Embedding":
+        entry = await _acquire_model(model_id)
+        served = entry.value
+        if served.model_type != "Text Embedding":
             raise HTTPException(
                 status_code=400,
                 detail="The model that is loaded is not a Text Embedding model. Please use a Text Embedding model for embedding generation."
             )
-        if isinstance(request.input, list):
-            embeddings_results = [model.embed(
-                text, normalize=request.normalize, truncate=request.truncate) for text in request.input]
-        else:
-            embeddings_results = model.embed(
-                request.input, normalize=request.normalize, truncate=request.truncate)
-
-        # Prepare the response data
-        if isinstance(request.input, list):
-            data = [
-                {
-                    "object": "embedding",
-                    "embedding": embedding,
-                    "index": i
-                } for i, embedding in enumerate(embeddings_results)
-            ]
-        else:
-            data = [
-                {
-                    "object": "embedding",
-                    "embedding": embeddings_results,
-                    "index": 0
-                }
-            ]
-
-        # Calculate token usage
+        if request.encoding_format not in EMBEDDING_ENCODING_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"encoding_format must be one of {', '.join(EMBEDDING_ENCODING_FORMATS)}")
+        if request.dimensions is not None and not 0 < request.dimensions <= served.model.n_embd():
+            raise HTTPException(
+                status_code=400,
+                detail=f"dimensions must be between 1 and {served.model.n_embd()}")
+        # Concurrent requests are embedded together, each input is its own sequence
         input_texts = request.input if isinstance(
             request.input, list) else [request.input]
-        total_tokens = sum(len(text.split()) for text in input_texts)
+        embeddings, total_tokens = await served.embedder().embed(
+            input_texts, truncate=request.truncate)
+
+        # Models with pooling give one row per input, the others one matrix of token embeddings per input
+        pooled = not isinstance(embeddings, list)
+        matrices = [embeddings] if pooled else embeddings
+        if request.dimensions is not None:
+            matrices = [matrix[:, :request.dimensions].copy() for matrix in matrices]
+        if request.normalize:
+            for matrix in matrices:
+                normalize_embeddings(matrix)
+        encoded = [encode_embeddings(matrix, request.encoding_format) for matrix in matrices]
 
+        # Prepare the response data
+        data = [
+            {
+                "object": "embedding",
+                "embedding": embedding,
+                "index": i
+            } for i, embedding in enumerate(encoded[0] if pooled else encoded)
+        ]
+
+        server_metrics.finish(record)
         return {
             "object": "list",
             "data": data,
-            "model": model_path,
+            "model": served.model_id,
             "usage": {
                 "prompt_tokens": total_tokens,
                 "total_tokens": total_tokens
             }
         }
+    except asyncio.CancelledError:
+        server_metrics.finish(record, "cancelled")
+        raise
     except Exception as e:
+        server_metrics.finish(record, "error")
+        if isinstance(e, HTTPException):
+            raise e
         logging.error(f"Error in embedding generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if entry is not None:
+            model_pool.release(entry)
 
 
 @app.post("/v1/action", tags=["Actions"])
@@ -2107,6 +2874,132 @@ if __name__ == "__main__":
     parser.add_argument(
         "--nctx", type=int, default=2048, help="Length of context window"
     )
+    parser.add_argument(
+        "--prefetch",
+        type=str,
+        choices=["none", "willneed", "readahead", "mlock"],
+        default="none",
+        help="Page-cache warm-up policy for the model weights at load time",
+    )
+    parser.add_argument(
+        "--context_shift",
+        action="store_true",
+        help="Discard the oldest tokens after the system prompt when the context is full instead of failing",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Probe and use the fastest thread counts and batch size at load, cached per host and model",
+    )
+    parser.add_argument(
+        "--numa_node",
+        type=int,
+        help="Pin inference threads to the physical cores of this NUMA node and bind memory to it",
+    )
+    parser.add_argument(
+        "--numa_workers",
+        action="store_true",
+        help="Run one server worker per NUMA node on the same port, each pinned to its node with a local copy of the model",
+    )
+    parser.add_argument(
+        "--type_k",
+        type=str,
+        choices=["f16", "q8_0", "q4_0"],
+        help="KV cache type of K",
+    )
+    parser.add_argument(
+        "--type_v",
+        type=str,
+        choices=["f16", "q8_0", "q4_0"],
+        help="KV cache type of V, quantized types require --flash_attn",
+    )
+    parser.add_argument(
+        "--flash_attn",
+        action="store_true",
+        help="Use flash attention",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        help="Plan the context, KV cache types and sessions to fit the weights and KV cache in this many GB (0: available memory)",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=4,
+        help="Number of chat sessions (session_id) whose KV state is kept resident, 0 to disable",
+    )
+    parser.add_argument(
+        "--max_samples",
+        type=int,
+        default=4,
+        help="Maximum n / best_of of a request, the samples share the prompt and are decoded in one batch",
+    )
+    parser.add_argument(
+        "--session_dir",
+        type=str,
+        help="Directory where evicted chat sessions are spilled and restored from, also across restarts",
+    )
+    parser.add_argument(
+        "--session_dir_gb",
+        type=float,
+        default=2,
+        help="Maximum size of --session_dir in GB",
+    )
+    parser.add_argument(
+        "--draft_model_path",
+        type=str,
+        help="Local path to a smaller GGUF model with the same vocabulary, used for speculative decoding",
+    )
+    parser.add_argument(
+        "--draft_max_tokens",
+        type=int,
+        default=16,
+        help="Maximum number of tokens drafted per step, the draft length adapts to the acceptance rate",
+    )
+    parser.add_argument(
+        "--draft_acceptance",
+        type=str,
+        choices=["greedy", "rejection"],
+        default="greedy",
+        help="How drafted tokens are verified by the target model",
+    )
+    parser.add_argument(
+        "--ngram_cache",
+        action="store_true",
+        help="Draft tokens from n-gram statistics of previous requests (ignored with --draft_model_path)",
+    )
+    parser.add_argument(
+        "--ngram_cache_dir",
+        type=str,
+        help="Directory where the n-gram cache is persisted across restarts, implies --ngram_cache",
+    )
+    parser.add_argument(
+        "--embedding_wait_ms",
+        type=float,
+        default=5,
+        help="How long an embedding request waits for concurrent ones to share its batch",
+    )
+    parser.add_argument(
+        "--jump_forward",
+        action="store_true",
+        help="Insert the text forced by the function schema without sampling it token by token",
+    )
+    parser.add_argument(
+        "--pool_budget_gb",
+        type=float,
+        help="Keep several models resident within this many GB, least recently used idle models are unloaded first (0: available memory)",
+    )
+    parser.add_argument(
+        "--max_models",
+        type=int,
+        help="Maximum number of resident models, 0 for no limit (default 1, no limit with --pool_budget_gb)",
+    )
+    parser.add_argument(
+        "--load_on_request",
+        action="store_true",
+        help="Load the hub and local models named in the model field of requests, pulling them if needed",
+    )
     parser.add_argument(
         "--host", type=str, default="localhost", help="Host to bind the server to"
     )
@@ -2147,6 +3040,29 @@ if __name__ == "__main__":
         huggingface=args.huggingface,
         modelscope=args.modelscope,
         nctx=args.nctx,
+        prefetch=args.prefetch,
+        context_shift=args.context_shift,
+        autotune=args.autotune,
+        numa_node=args.numa_node,
+        numa_workers=args.numa_workers,
+        type_k=args.type_k,
+        type_v=args.type_v,
+        flash_attn=args.flash_attn,
+        memory_budget_gb=args.memory_budget_gb,
+        sessions=args.sessions,
+        max_samples=args.max_samples,
+        session_dir=args.session_dir,
+        session_dir_gb=args.session_dir_gb,
+        draft_model_path=args.draft_model_path,
+        draft_max_tokens=args.draft_max_tokens,
+        draft_acceptance=args.draft_acceptance,
+        ngram_cache=args.ngram_cache,
+        ngram_cache_dir=args.ngram_cache_dir,
+        embedding_wait_ms=args.embedding_wait_ms,
+        jump_forward=args.jump_forward,
+        pool_budget_gb=args.pool_budget_gb,
+        max_models=args.max_models,
+        load_on_request=args.load_on_request,
         host=args.host,
         port=args.port,
         reload=args.reload
@@ -0,0 +1,194 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_async import AsyncLlama
+
+
+class FakeLlama:
+    """Generates `n_tokens` chunks, checking `stopping_criteria` before each token like Llama."""
+
+    def __init__(self, n_tokens=5, delay=0.0):
+        self.n_tokens = n_tokens
+        self.delay = delay
+        self.generated = 0
+        self.threads = set()
+
+    def _chunks(self, prompt, stopping_criteria):
+        for i in range(self.n_tokens):
+            if stopping_criteria is not None and stopping_criteria(None, None):
+                return
+            time.sleep(self.delay)
+            self.threads.add(threading.get_ident())
+            self.generated += 1
+            yield {"choices": [{"text": f"{prompt}:{i} "}]}
+
+    def create_completion(self, prompt, stream=False, stopping_criteria=None):
+        chunks = self._chunks(prompt, stopping_criteria)
+        if stream:
+            return chunks
+        return {"choices": [{"text": "".join(chunk["choices"][0]["text"] for chunk in chunks)}]}
+
+
+# Test that waiting clients queue on the decode thread instead of holding threads
+def test_waiting_clients_share_one_thread():
+    llama = FakeLlama(n_tokens=3)
+    threads_before = threading.active_count()
+    peak_threads = 0
+
+    async def client(allm, i):
+        nonlocal peak_threads
+        if i % 2:
+            completion = await allm.create_completion(str(i))
+            text = completion["choices"][0]["text"]
+        else:
+            text = ""
+            async for chunk in await allm.create_completion(str(i), stream=True):
+                text += chunk["choices"][0]["text"]
+        peak_threads = max(peak_threads, threading.active_count())
+        return text
+
+    async def main():
+        allm = AsyncLlama(llama)
+        texts = await asyncio.gather(*(client(allm, i) for i in range(1000)))
+        allm.close()
+        return texts
+
+    texts = asyncio.run(main())
+    assert texts == [f"{i}:0 {i}:1 {i}:2 " for i in range(1000)]
+    assert len(llama.threads) == 1
+    assert peak_threads <= threads_before + 1
+
+
+# Test that a slow reader pauses decoding once the buffer is full
+def test_stream_buffer_is_bounded():
+    llama = FakeLlama(n_tokens=100)
+
+    async def main():
+        allm = AsyncLlama(llama, max_buffered=4)
+        stream = await allm.create_completion("a", stream=True)
+        await stream.__anext__()
+        await asyncio.sleep(0.1)
+        generated = llama.generated
+        await stream.aclose()
+        allm.close()
+        return generated
+
+    assert asyncio.run(main()) <= 1 + 4 + 1
+
+
+# Test that cancellation and leaving a stream early abort the generation between tokens
+def test_cancel_aborts_generation():
+    llama = FakeLlama(n_tokens=1000, delay=0.002)
+
+    async def main():
+        allm = AsyncLlama(llama)
+        task = asyncio.ensure_future(allm.create_completion("a"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Runs once the cancelled generation has returned
+        after_cancel = await allm.run(lambda: llama.generated)
+
+        stream = await allm.create_completion("b", stream=True)
+        async for chunk in stream:
+            if chunk["choices"][0]["text"] == "b:2 ":
+                break
+        await stream.aclose()
+        after_break = await allm.run(lambda: llama.generated)
+        allm.close()
+        return after_cancel, after_break
+
+    after_cancel, after_break = asyncio.run(main())
+    assert after_cancel < 500
+    # Three chunks read, at most a full buffer and one token more generated
+    assert after_break - after_cancel <= 3 + 16 + 1
+
+
+class BusyLlama(FakeLlama):
+    """Holds `busy` while it generates."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.busy = threading.Lock()
+
+    def create_completion(self, prompt, stream=False, stopping_criteria=None):
+        if stream:
+            return self._locked(super().create_completion(prompt, True, stopping_criteria))
+        with self.busy:
+            return super().create_completion(prompt, False, stopping_criteria)
+
+    def _locked(self, chunks):
+        with self.busy:
+            yield from chunks
+
+
+# Test that a cancelled call or a closed stream returns only once the decode thread let go of the model
+def test_cancel_waits_for_decode_thread():
+    llama = BusyLlama(n_tokens=1000, delay=0.002)
+
+    async def main():
+        allm = AsyncLlama(llama)
+        task = asyncio.ensure_future(allm.create_completion("a"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        idle_after_cancel = not llama.busy.locked()
+
+        stream = await allm.create_completion("b", stream=True)
+        await stream.__anext__()
+        await stream.aclose()
+        idle_after_close = not llama.busy.locked()
+        allm.close()
+        return idle_after_cancel, idle_after_close
+
+    assert asyncio.run(main()) == (True, True)
+
+
+def _chat_llama(fake):
+    """A Llama running `Llama.create_chat_completion` with a chat handler generating through `fake`."""
+    llama = Llama.__new__(Llama)
+    llama._stack = contextlib.ExitStack()
+    llama._chat_handlers = {}
+    llama.chat_format = None
+    llama.timing_collector = None
+    llama._timings = None
+
+    def chat_handler(*, llama, messages, stream=False, stopping_criteria=None, **kwargs):
+        return fake.create_completion(messages[-1]["content"], stream=stream, stopping_criteria=stopping_criteria)
+
+    llama.chat_handler = chat_handler
+    return llama
+
+
+# Test that chat completions go through the real create_chat_completion signature and can be cancelled
+def test_chat_completion_cancel():
+    fake = FakeLlama(n_tokens=1000, delay=0.002)
+
+    async def main():
+        allm = AsyncLlama(_chat_llama(fake))
+        fake.n_tokens = 3
+        completion = await allm.create_chat_completion([{"role": "user", "content": "a"}])
+        fake.n_tokens = 1000
+        task = asyncio.ensure_future(allm.create_chat_completion([{"role": "user", "content": "b"}]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        after_cancel = await allm.run(lambda: fake.generated)
+        allm.close()
+        return completion, after_cancel
+
+    completion, after_cancel = asyncio.run(main())
+    assert completion["choices"][0]["text"] == "a:0 a:1 a:2 "
+    assert after_cancel < 500
@@ -0,0 +1,107 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from fastapi import HTTPException
+
+from nexa.gguf.server.nexa_service import EmbeddingBatcher
+
+
+class FakeLlama:
+    """Tokenizes one token per byte and embeds each input as [first token, number of tokens]."""
+
+    def __init__(self, n_batch=64):
+        self.n_batch = n_batch
+        self.batches = []
+        self.error = None
+
+    def tokenize_array(self, text):
+        return np.frombuffer(text, dtype=np.uint8).astype(np.intc)
+
+    def embed_array(self, inputs_tokens):
+        self.batches.append([len(tokens) for tokens in inputs_tokens])
+        if self.error is not None:
+            raise self.error
+        return np.array([[tokens[0], len(tokens)] for tokens in inputs_tokens], dtype=np.single)
+
+
+def _rows(texts):
+    return [[ord(text[0]), len(text)] for text in texts]
+
+
+# Test that concurrent requests are embedded in one batch and each gets its own rows
+def test_concurrent_requests_share_a_batch():
+    llama = FakeLlama()
+    requests = [["ab"], ["cde", "f"], ["gh"]]
+
+    async def main():
+        batcher = EmbeddingBatcher(llama, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.embed(texts) for texts in requests))
+        batcher.close()
+        return results
+
+    results = asyncio.run(main())
+    assert llama.batches == [[2, 3, 1, 2]]
+    for texts, (embeddings, n_tokens) in zip(requests, results):
+        assert embeddings.tolist() == _rows(texts)
+        assert n_tokens == sum(len(text) for text in texts)
+
+
+# Test that a batch holding n_batch tokens is embedded without waiting for more requests
+def test_full_batch_is_flushed():
+    llama = FakeLlama(n_batch=4)
+
+    async def main():
+        batcher = EmbeddingBatcher(llama, max_wait=10.0)
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.embed(["ab"]), batcher.embed(["cd"])), timeout=1.0)
+        batcher.close()
+        return results
+
+    results = asyncio.run(main())
+    assert llama.batches == [[2, 2]]
+    assert [embeddings.tolist() for embeddings, _ in results] == [_rows(["ab"]), _rows(["cd"])]
+
+
+# Test that inputs longer than n_batch are truncated, or refused with truncate=False
+def test_long_inputs():
+    llama = FakeLlama(n_batch=4)
+
+    async def main():
+        batcher = EmbeddingBatcher(llama, max_wait=0.0)
+        embeddings, n_tokens = await batcher.embed(["abcdefgh"])
+        with pytest.raises(HTTPException) as error:
+            await batcher.embed(["abcdefgh"], truncate=False)
+        batcher.close()
+        return embeddings, n_tokens, error.value.status_code
+
+    embeddings, n_tokens, status_code = asyncio.run(main())
+    assert embeddings.tolist() == [[ord("a"), 4]] and n_tokens == 4
+    assert status_code == 400
+
+
+# Test that a failed batch fails each of its requests and the next batches still run
+def test_batch_errors_reach_every_request():
+    llama = FakeLlama()
+    llama.error = RuntimeError("llama_decode returned -1")
+    calls = []
+
+    async def run(func, *args):
+        calls.append(func)
+        return func(*args)
+
+    async def main():
+        batcher = EmbeddingBatcher(llama, run=run, max_wait=0.05)
+        failed = await asyncio.gather(batcher.embed(["ab"]), batcher.embed(["cd"]), return_exceptions=True)
+        llama.error = None
+        embeddings, _ = await batcher.embed(["ef"])
+        batcher.close()
+        return failed, embeddings
+
+    failed, embeddings = asyncio.run(main())
+    assert [str(error) for error in failed] == ["llama_decode returned -1"] * 2
+    assert embeddings.tolist() == _rows(["ef"])
+    assert llama.batches == [[2, 2], [2]]
+    # Embedded with the given run, e.g. on the decode thread of the model
+    assert calls == [llama.embed_array] * 2
@@ -0,0 +1,27 @@
+from nexa.gguf.llama.llama_autotune import (
+    LlamaAutotuneResult,
+    _load_cache,
+    _save_cache,
+    thread_candidates,
+)
+
+
+# Test the probed thread counts on a 16-CPU host with 8 physical cores
+def test_thread_candidates():
+    assert thread_candidates(n_cpus=16, n_cores=8) == [1, 2, 4, 7, 8, 16]
+    assert thread_candidates(n_cpus=1, n_cores=1) == [1]
+
+
+# Test that cached choices are stored without the cached flag and merged per key
+def test_autotune_cache(tmp_path):
+    path = str(tmp_path / "nexa" / "autotune.json")
+    measurement = {"phase": "decode", "n_threads": 4, "n_threads_batch": 8, "n_batch": 256, "tokens_per_second": 30.0}
+    _save_cache(path, "a", LlamaAutotuneResult(4, 8, 256, [measurement]))
+    _save_cache(path, "b", LlamaAutotuneResult(2, 2, 64))
+
+    entries = _load_cache(path)
+    assert set(entries) == {"a", "b"}
+    result = LlamaAutotuneResult(**entries["a"], cached=True)
+    assert (result.n_threads, result.n_threads_batch, result.n_batch) == (4, 8, 256)
+    assert "(cached)" in result.report() and "30.0 tok/s" in result.report()
+    assert _load_cache(str(tmp_path / "missing.json")) == {}
@@ -0,0 +1,122 @@
+import contextlib
+import random
+
+import pytest
+
+from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_chat_format import CHATML_CHAT_TEMPLATE, Jinja2ChatFormatter
+
+LLAMA2_CHAT_TEMPLATE = (
+    "{% if messages[0]['role'] == 'system' %}{% set loop_messages = messages[1:] %}"
+    "{% set system_message = messages[0]['content'] %}"
+    "{% else %}{% set loop_messages = messages %}{% set system_message = false %}{% endif %}"
+    "{% for message in loop_messages %}"
+    "{% if loop.index0 == 0 and system_message != false %}"
+    "{% set content = '<<SYS>>\\n' + system_message + '\\n<</SYS>>\\n\\n' + message['content'] %}"
+    "{% else %}{% set content = message['content'] %}{% endif %}"
+    "{% if message['role'] == 'user' %}{{ bos_token + '[INST] ' + content.strip() + ' [/INST]' }}"
+    "{% elif message['role'] == 'assistant' %}{{ ' ' + content.strip() + ' ' + eos_token }}{% endif %}"
+    "{% endfor %}"
+)
+
+# The assistant header depends on the last message and on the tools
+LAST_ROLE_CHAT_TEMPLATE = (
+    "{% for message in messages %}{{ message['role'] + ': ' + message['content'] + '\\n' }}{% endfor %}"
+    "{% if add_generation_prompt %}{% if tools %}[{{ tools | length }} tools]{% endif %}"
+    "{% if messages[-1]['role'] == 'tool' %}<result>{% endif %}assistant:{% endif %}"
+)
+
+
+class FakeTokenizer:
+    """Byte tokens, plus one token for the pair of bytes `merge`."""
+
+    def __init__(self, merge=b"tu"):
+        self.merge = merge
+
+    def tokenize(self, text, add_bos=False, special=True):
+        tokens, i = [], 0
+        while i < len(text):
+            if text[i : i + 2] == self.merge:
+                tokens.append(256)
+                i += 2
+            else:
+                tokens.append(text[i])
+                i += 1
+        return tokens
+
+
+def _check_against_full_renders(template, roles, system=True, tools=False, merge=b"tu"):
+    """Format 400 requests extending (or going back in) a few conversations, comparing each with a full render."""
+    rng = random.Random(0)
+    formatter = Jinja2ChatFormatter(template, eos_token="</s>", bos_token="<s>")
+    tokenizer = FakeTokenizer(merge)
+    conversations = [[{"role": "system", "content": f"system {i}"}] if system else [] for i in range(4)]
+    for request in range(400):
+        i = rng.randrange(len(conversations))
+        conversations[i] = conversations[i] + [{"role": rng.choice(roles), "content": f" turn {request}"}]
+        messages = conversations[i]
+        request_tools = [{"type": "function", "function": {"name": "f"}}] * rng.randrange(3) if tools else None
+        result = formatter(messages=messages, tools=request_tools, tokenizer=tokenizer)
+        full = formatter._render(
+            messages, True, dict(functions=None, function_call=None, tools=request_tools, tool_choice=None))
+        assert result.prompt == full
+        assert result.prompt_tokens is None or result.prompt_tokens == tokenizer.tokenize(full.encode("utf-8"))
+        if rng.random() < 0.1:
+            # A regenerated answer goes back to an earlier prefix
+            conversations[i] = messages[: rng.randrange(1, len(messages) + 1)]
+    return formatter
+
+
+# Test that cached ChatML prompts and tokens equal a full render, and that the cache is used
+def test_chatml_prefix_cache():
+    formatter = _check_against_full_renders(CHATML_CHAT_TEMPLATE, ["user", "assistant"])
+    assert formatter._append_stable is True
+
+
+# Test that a token merging across the end of the history and the generation prompt turns the cache off
+def test_boundary_merge_disables_cache():
+    formatter = _check_against_full_renders(CHATML_CHAT_TEMPLATE, ["user", "assistant"], merge=b"\n<")
+    assert formatter._append_stable is False
+
+
+# Test that Llama-2 prompts, whose first turn carries the system message, equal a full render
+def test_llama2_prefix_cache():
+    _check_against_full_renders(LLAMA2_CHAT_TEMPLATE, ["user", "assistant"])
+    _check_against_full_renders(LLAMA2_CHAT_TEMPLATE, ["user", "assistant"], system=False)
+
+
+# Test that a generation prompt rendered from the last message and the tools is never stale
+def test_last_role_generation_prompt():
+    formatter = _check_against_full_renders(
+        LAST_ROLE_CHAT_TEMPLATE, ["user", "assistant", "tool"], system=False, tools=True)
+    assert formatter._append_stable is True
+
+
+def _llama_with_handler(handler):
+    llama = Llama.__new__(Llama)
+    llama._stack = contextlib.ExitStack()
+    llama._chat_handlers = {}
+    llama.chat_format = "custom"
+    llama.chat_handler = handler
+    llama.timing_collector = None
+    llama._timings = None
+    return llama
+
+
+# Test that n, best_of and num_beams are refused by chat handlers without an n parameter
+def test_samples_need_a_handler_taking_n():
+    def sampling_handler(*, llama, messages, n=1, best_of=None, num_beams=1, **kwargs):
+        return {"n": n, "best_of": best_of, "num_beams": num_beams}
+
+    def plain_handler(*, llama, messages, **kwargs):
+        return {"kwargs": sorted(kwargs)}
+
+    messages = [{"role": "user", "content": "hi"}]
+    llama = _llama_with_handler(sampling_handler)
+    assert llama.create_chat_completion(messages, n=2, best_of=3) == {"n": 2, "best_of": 3, "num_beams": 1}
+
+    llama = _llama_with_handler(plain_handler)
+    assert "n" not in llama.create_chat_completion(messages)["kwargs"]
+    for samples in (dict(n=2), dict(best_of=2), dict(num_beams=2)):
+        with pytest.raises(ValueError):
+            llama.create_chat_completion(messages, **samples)
@@ -0,0 +1,68 @@
+import contextlib
+
+import numpy as np
+
+from nexa.gguf.llama.llama import Llama
+
+
+class _FakeContext:
+    def __init__(self):
+        self.calls = []
+
+    def kv_cache_seq_rm(self, seq_id, p0, p1):
+        self.calls.append(("rm", seq_id, p0, p1))
+
+    def kv_cache_seq_shift(self, seq_id, p0, p1, delta):
+        self.calls.append(("shift", seq_id, p0, p1, delta))
+
+
+def _fake_llama(n_tokens, n_ctx=16, n_vocab=4):
+    """A Llama holding tokens 0..n_tokens-1, the scores of each row filled with its position."""
+    llama = Llama.__new__(Llama)
+    llama._stack = contextlib.ExitStack()
+    llama._ctx = _FakeContext()
+    llama._n_ctx = n_ctx
+    llama.context_params = type("ContextParams", (), {"logits_all": True})()
+    llama.verbose = False
+    llama.shifts = []
+    llama.on_context_shift = llama.shifts.append
+    llama.input_ids = np.zeros(n_ctx, dtype=np.intc)
+    llama.scores = np.zeros((n_ctx, n_vocab), dtype=np.single)
+    llama.input_ids[:n_tokens] = np.arange(n_tokens)
+    llama.scores[:n_tokens] = np.arange(n_tokens)[:, None]
+    llama.n_tokens = n_tokens
+    return llama
+
+
+# Test that a context shift drops the tokens after n_keep from the cache, input_ids and scores
+def test_shift_context():
+    llama = _fake_llama(12)
+
+    assert llama.shift_context(2) == 5
+    assert llama._ctx.calls == [("rm", 0, 2, 7), ("shift", 0, 7, 12, -5)]
+    assert llama.shifts == [7]
+    assert llama.n_tokens == 7
+    assert llama._input_ids.tolist() == [0, 1, 7, 8, 9, 10, 11]
+    assert llama._scores[:, 0].tolist() == [0, 1, 7, 8, 9, 10, 11]
+
+    # At most the tokens after n_keep are discarded, none when there are none
+    assert llama.shift_context(2, n_discard=100) == 5
+    assert llama._input_ids.tolist() == [0, 1]
+    assert llama.shift_context(2) == 0
+    assert llama.shifts == [7, 7] and len(llama._ctx.calls) == 4
+
+
+# Test that a prompt continuing the shifted cache is cut where it reuses the cached tail
+def test_fit_prompt_reuses_shifted_cache():
+    llama = _fake_llama(12)
+    llama.shift_context(2)
+
+    # The next turn of a chat, the whole conversation no longer fits the context
+    prompt = list(range(20))
+    fitted = llama._fit_prompt(prompt, 2)
+    assert fitted == [0, 1] + list(range(7, 20))
+    assert fitted[: llama.n_tokens] == llama._input_ids.tolist()
+
+    # Another prompt keeps n_keep and the most recent half of the remaining window
+    other = [0, 1] + list(range(100, 118))
+    assert llama._fit_prompt(other, 2) == [0, 1] + list(range(111, 118))
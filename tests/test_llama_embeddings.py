@@ -0,0 +1,56 @@
+import base64
+
+import numpy as np
+import pytest
+
+from nexa.gguf.llama._internals_transformers import encode_embeddings
+
+
+def _embeddings():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((3, 37)).astype(np.single)
+    # A zero row, e.g. the embedding of an empty input
+    embeddings[1] = 0
+    return embeddings
+
+
+def _decode(row, dtype):
+    return np.frombuffer(base64.b64decode(row), dtype=dtype)
+
+
+# Test that base64 and float16 rows decode to the embeddings
+def test_float_encodings_round_trip():
+    embeddings = _embeddings()
+    assert encode_embeddings(embeddings, "float") == embeddings.tolist()
+    for row, encoded in zip(embeddings, encode_embeddings(embeddings, "base64")):
+        assert np.array_equal(_decode(encoded, "<f4"), row)
+    for row, encoded in zip(embeddings, encode_embeddings(embeddings, "float16")):
+        assert np.array_equal(_decode(encoded, "<f2"), row.astype(np.float16))
+
+
+# Test that int8 rows times their scale are within one step of the embeddings, and zero rows get scale 0
+def test_int8_encoding_round_trip():
+    embeddings = _embeddings()
+    encoded = encode_embeddings(embeddings, "int8")
+    for row, item in zip(embeddings, encoded):
+        data = _decode(item["data"], np.int8)
+        assert len(data) == len(row)
+        assert np.all(np.abs(data * item["scale"] - row) <= item["scale"])
+    assert encoded[1]["scale"] == 0
+    assert not _decode(encoded[1]["data"], np.int8).any()
+    assert np.abs(_decode(encoded[0]["data"], np.int8)).max() == 127
+
+
+# Test that binary rows hold the sign bits, most significant bit first
+def test_binary_encoding_round_trip():
+    embeddings = _embeddings()
+    for row, encoded in zip(embeddings, encode_embeddings(embeddings, "binary")):
+        bits = np.unpackbits(_decode(encoded, np.uint8))
+        assert np.array_equal(bits[: len(row)], row > 0)
+        assert not bits[len(row) :].any()
+
+
+# Test that unknown formats are refused
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        encode_embeddings(_embeddings(), "float64")
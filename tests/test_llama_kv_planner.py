@@ -0,0 +1,73 @@
+import os
+import struct
+
+import pytest
+
+from nexa.gguf.llama.llama_kv_planner import LlamaModelDims, plan_kv_cache, read_gguf_metadata
+
+
+def _string(value):
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _write_gguf(path, n_vocab=1000):
+    kv = [
+        (_string("general.architecture"), struct.pack("<I", 8) + _string("llama")),
+        (_string("llama.block_count"), struct.pack("<II", 4, 16)),
+        (_string("llama.embedding_length"), struct.pack("<II", 4, 2048)),
+        (_string("llama.attention.head_count"), struct.pack("<II", 4, 32)),
+        (_string("llama.attention.head_count_kv"), struct.pack("<II", 4, 8)),
+        (_string("llama.context_length"), struct.pack("<II", 4, 8192)),
+        (
+            _string("tokenizer.ggml.tokens"),
+            struct.pack("<IIQ", 9, 8, n_vocab) + b"".join(_string(f"t{i}") for i in range(n_vocab)),
+        ),
+        (_string("tokenizer.ggml.scores"), struct.pack("<IIQ", 9, 6, 2) + struct.pack("<2f", 0.5, -1.0)),
+    ]
+    with open(path, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, 0, len(kv)))
+        for key, value in kv:
+            f.write(key + value)
+        f.write(b"\0" * (64 << 20))  # stands in for the weights
+
+
+# Test reading the model dimensions from the GGUF header
+def test_gguf_dims(tmp_path):
+    path = str(tmp_path / "model.gguf")
+    _write_gguf(path)
+    metadata = read_gguf_metadata(path)
+    assert metadata["tokenizer.ggml.tokens"] == 1000
+    assert metadata["tokenizer.ggml.scores"] == [0.5, -1.0]
+
+    dims = LlamaModelDims.from_file(path)
+    assert (dims.n_layer, dims.n_embd_head_k, dims.n_vocab, dims.n_ctx_train) == (16, 64, 1000, 8192)
+    # 16 layers x 8 KV heads x (64 + 64) x 2 bytes
+    assert dims.kv_bytes_per_token() == 32768
+    assert dims.kv_bytes_per_token("q8_0", "q8_0") == 32768 * 34 / 64
+
+
+# Test that the planner quantizes the KV cache, then drops slots, then shrinks the context
+def test_plan_kv_cache(tmp_path):
+    path = str(tmp_path / "model.gguf")
+    _write_gguf(path)
+    mib = 1 << 20
+    fixed = os.path.getsize(path) + (512 << 20)
+
+    plan = plan_kv_cache(path, memory_budget=fixed + 256 * mib, n_ctx=4096, n_slots=2)
+    assert (plan.type_k, plan.type_v, plan.n_ctx, plan.n_slots) == ("f16", "f16", 8192, 2)
+
+    plan = plan_kv_cache(path, memory_budget=fixed + 160 * mib, n_ctx=4096, n_slots=2, flash_attn=True)
+    assert (plan.type_k, plan.type_v, plan.n_ctx) == ("q8_0", "q8_0", 8192)
+
+    plan = plan_kv_cache(path, memory_budget=fixed + 80 * mib, n_ctx=4096, n_slots=4, flash_attn=True)
+    assert (plan.type_k, plan.n_slots, plan.n_ctx_per_slot) == ("q4_0", 2, 4096)
+    assert plan.kv_bytes <= 80 * mib
+
+    plan = plan_kv_cache(path, memory_budget=fixed + 16 * mib, n_ctx=4096)
+    assert (plan.type_k, plan.type_v, plan.n_slots) == ("q4_0", "f16", 1)
+    assert 512 <= plan.n_ctx < 4096 and plan.n_ctx % 256 == 0
+    assert "do not fit" in plan.report()
+
+    with pytest.raises(ValueError):
+        plan_kv_cache(path, memory_budget=fixed, n_ctx=4096)
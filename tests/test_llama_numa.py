@@ -0,0 +1,22 @@
+from nexa.gguf.llama.llama_numa import numa_node_cpus, numa_nodes, parse_cpu_list
+
+
+# Test parsing the CPU lists of /sys/devices/system
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list("5") == [5]
+    assert parse_cpu_list("") == []
+
+
+# Test that every node lists CPUs and its physical cores are a subset of them
+def test_numa_node_cpus():
+    nodes = numa_nodes()
+    assert nodes and all(nodes.values())
+    for node, cpus in nodes.items():
+        try:
+            physical = numa_node_cpus(node)
+        except ValueError:
+            # None of the CPUs of this node are in the affinity of the test process
+            continue
+        assert physical and set(physical) <= set(cpus)
+        assert set(physical) <= set(numa_node_cpus(node, physical_cores=False))
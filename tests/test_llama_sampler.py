@@ -0,0 +1,54 @@
+import contextlib
+
+from collections import OrderedDict
+
+from nexa.gguf.llama.llama import Llama
+
+
+class _FakeChain:
+    def __init__(self, seed):
+        self.seed = seed
+        self.resets = 0
+        self.reseeds = []
+
+    def reset(self):
+        self.resets += 1
+
+    def reseed(self, seed):
+        self.reseeds.append(seed)
+        self.seed = seed
+
+
+def _fake_llama():
+    llama = Llama.__new__(Llama)
+    llama._stack = contextlib.ExitStack()
+    llama._sampler_cache = OrderedDict()
+    llama._seed = 1
+    llama.built = []
+
+    def init_sampler(seed=None, **kwargs):
+        llama.built.append(kwargs)
+        return _FakeChain(seed)
+
+    llama._init_sampler = init_sampler
+    return llama
+
+
+# Test that unseeded requests with equal parameters reuse one chain, only reseeded
+def test_unseeded_requests_share_a_chain():
+    llama = _fake_llama()
+    params = dict(top_k=40, top_p=0.95, temp=0.8, logit_bias=None, grammar=None, logits_processor=None)
+
+    first = llama._cached_sampler(seed=None, **params)
+    # Each unseeded completion draws a new seed
+    llama._seed = 2
+    second = llama._cached_sampler(seed=None, **params)
+    assert second is first and len(llama.built) == 1
+    assert first.resets == 1 and first.reseeds == [2]
+
+    # The same seed keeps the sampler, a reset restarts its generator
+    third = llama._cached_sampler(seed=2, **params)
+    assert third is first and first.reseeds == [2]
+
+    other = llama._cached_sampler(seed=None, **dict(params, temp=0.5))
+    assert other is not first and len(llama.built) == 2
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+
+from nexa.gguf.llama.llama_session import LlamaSessionSlots, LlamaSessionStore
+
+
+# Test that truncated and corrupted spill files are discarded instead of raising
+def test_store_discards_damaged_files(tmp_path):
+    store = LlamaSessionStore(str(tmp_path), compression="zlib")
+    tokens = np.arange(16, dtype=np.intc)
+    state = bytes(range(256)) * 16
+
+    store.save("intact", tokens, state)
+    loaded_tokens, loaded_state = store.load("intact")
+    assert np.array_equal(loaded_tokens, tokens) and loaded_state == state
+
+    for session_id, damage in (("truncated", 6), ("corrupted", None)):
+        store.save(session_id, tokens + len(session_id), state)
+        path = store._path(store._sessions[session_id])
+        with open(path, "r+b") as f:
+            if damage is not None:
+                # Cut inside the header length
+                f.truncate(damage)
+            else:
+                f.seek(-64, os.SEEK_END)
+                f.write(b"\xff" * 64)
+        assert store.load(session_id) is None
+        assert session_id not in store and not os.path.exists(path)
+    assert "intact" in store
+
+
+class _FakeContext:
+    def __init__(self):
+        self.calls = []
+
+    def kv_cache_seq_rm(self, seq_id, p0, p1):
+        self.calls.append(("rm", seq_id))
+
+    def kv_cache_seq_cp(self, seq_id_src, seq_id_dst, p0, p1):
+        self.calls.append(("cp", seq_id_src, seq_id_dst))
+
+    def get_seq_state_data(self, seq_id):
+        return b"state of %d" % seq_id
+
+
+class _FakeLlama:
+    def __init__(self, n_ctx=128, n_seq_max=4):
+        self.context_params = type("ContextParams", (), {"n_seq_max": n_seq_max})()
+        self._ctx = _FakeContext()
+        self._n_ctx = n_ctx
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.last_prefix_match = None
+        self.on_context_shift = None
+        self.on_kv_request = None
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def set_tokens(self, tokens):
+        self.input_ids[: len(tokens)] = tokens
+        self.n_tokens = len(tokens)
+
+
+# Test that a context shift evicts the parked sessions sharing the moved cells with the working sequence
+def test_context_shift_evicts_sharing_sessions(tmp_path):
+    llama = _FakeLlama()
+    store = LlamaSessionStore(str(tmp_path), compression="zlib")
+    slots = LlamaSessionSlots(llama, n_slots=3, store=store)
+
+    slots.activate("a")
+    llama.set_tokens(np.arange(20))
+    # b starts from a's tokens, the parked copy of a shares their cells
+    slots.activate("b")
+    llama.set_tokens(np.concatenate([np.arange(8), 100 + np.arange(12)]))
+    slots.activate("c")
+
+    # The shift moves cells of positions 10 and up, a only shares positions below 8 with c
+    llama.on_context_shift(10)
+    assert "a" in slots and "b" not in slots and "b" in store
+    assert slots.stats("b").spills == 1
+
+    # Positions 4 and up are shared with a
+    llama.on_context_shift(4)
+    assert "a" not in slots and "a" in store and slots.active_session == "c"
+
+
+# Test that parked sessions are evicted, least recently used first, until a completion fits the KV cache
+def test_completion_evicts_parked_sessions(tmp_path):
+    llama = _FakeLlama()
+    store = LlamaSessionStore(str(tmp_path), compression="zlib")
+    slots = LlamaSessionSlots(llama, n_slots=3, store=store)
+
+    for i, session_id in enumerate(("a", "b", "c")):
+        slots.activate(session_id)
+        llama.set_tokens(np.arange(30) + 100 * i)
+    assert slots.parked_tokens == 60
+
+    llama.on_kv_request(60)
+    assert "a" in slots and "b" in slots
+    llama.on_kv_request(80)
+    assert "a" not in slots and "a" in store and "b" in slots
+    llama.on_kv_request(128)
+    assert slots.parked_tokens == 0 and slots.active_session == "c"
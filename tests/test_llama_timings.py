@@ -0,0 +1,64 @@
+import threading
+import time
+
+from nexa.gguf.llama.llama_timings import LlamaTimingCollector, LlamaTimings
+
+
+# Test that laps and timed blocks add up to the phases and the rest counts as overhead
+def test_timings_phases():
+    timings = LlamaTimings()
+    timings.mark()
+    time.sleep(0.01)
+    timings.lap("decode")
+    time.sleep(0.01)
+    timings.lap("decode")
+    with timings.timed("tokenize"):
+        time.sleep(0.01)
+    timings.total = time.perf_counter() - timings.start_time
+
+    phases = timings.phases()
+    assert phases["decode"] >= 0.02
+    assert phases["tokenize"] >= 0.01
+    assert phases["sample"] == 0.0
+    assert abs(sum(phases[p] for p in phases if p != "total") - phases["total"]) < 1e-9
+
+
+# Test that the collector fills the histograms and calls the callbacks once per request
+def test_collector_histograms():
+    seen = []
+    collector = LlamaTimingCollector(callbacks=[seen.append])
+    for decode in (0.002, 0.002, 0.002, 0.2):
+        collector.observe(LlamaTimings(decode=decode, total=decode))
+
+    assert len(seen) == 4 and collector.requests == 4
+    histogram = collector.histograms["decode"]
+    assert histogram.count == 4
+    assert histogram.cumulative_counts()[-1] == 4
+    assert histogram.quantile(0.5) == 0.0025
+    assert histogram.quantile(0.99) == 0.25
+    summary = collector.summary()
+    assert summary["overhead"]["mean"] == 0.0
+    assert abs(summary["decode"]["mean"] - 0.0515) < 1e-9
+
+
+# Test that threads sharing a collector write their own histograms, summed when read
+def test_collector_threads():
+    collector = LlamaTimingCollector()
+
+    def decode_thread():
+        for _ in range(1000):
+            collector.observe(LlamaTimings(decode=0.002, total=0.002))
+
+    threads = [threading.Thread(target=decode_thread) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    collector.observe(LlamaTimings(decode=0.2, total=0.2))
+
+    assert collector.requests == 4001
+    assert collector.histograms["decode"].count == 4001
+    assert collector.histograms["decode"].cumulative_counts()[-1] == 4001
+    # The ended threads are folded into one set of histograms
+    assert len(collector._threads) == 1
+    assert collector.summary()["decode"]["p99"] == 0.0025
@@ -0,0 +1,61 @@
+import threading
+
+from collections import OrderedDict
+from contextlib import ExitStack
+
+import pytest
+
+from nexa.gguf.llama import _internals_transformers as internals
+
+
+def _fake_model(monkeypatch, token_cache_size):
+    """A LlamaModel whose llama_tokenize makes one token per byte and records the texts it tokenized."""
+    model = internals.LlamaModel.__new__(internals.LlamaModel)
+    model._exit_stack = ExitStack()
+    model.vocab = None
+    model.token_cache_size = token_cache_size
+    model._token_cache = OrderedDict()
+    model._token_cache_lock = threading.Lock()
+    model.tokenized = []
+
+    def llama_tokenize(vocab, text, text_len, tokens, n_tokens_max, add_special, parse_special):
+        model.tokenized.append(text)
+        for i, byte in enumerate(text):
+            tokens[i] = byte
+        return text_len
+
+    monkeypatch.setattr(internals.llama_cpp, "llama_tokenize", llama_tokenize)
+    return model
+
+
+# Test that the token cache keeps the most recently used texts and hands out read-only arrays
+def test_token_cache_lru(monkeypatch):
+    model = _fake_model(monkeypatch, token_cache_size=2)
+    a = model.tokenize_array(b"a", False, False)
+    model.tokenize_array(b"b", False, False)
+    assert model.tokenize_array(b"a", False, False) is a
+    # Evicts b, the least recently used
+    model.tokenize_array(b"c", False, False)
+    assert list(model._token_cache) == [(b"a", False, False), (b"c", False, False)]
+    model.tokenize_array(b"b", False, False)
+    # The flags are part of the key
+    model.tokenize_array(b"b", False, True)
+    assert model.tokenized == [b"a", b"b", b"c", b"b", b"b"]
+
+    assert a.tolist() == [ord("a")] and not a.flags.writeable
+    with pytest.raises(ValueError):
+        a[0] = 0
+    assert model.tokenize(b"ab", False, False) == [ord("a"), ord("b")]
+
+
+# Test that long texts and a cache size of 0 bypass the cache
+def test_token_cache_bypass(monkeypatch):
+    model = _fake_model(monkeypatch, token_cache_size=0)
+    first = model.tokenize_array(b"a", False, False)
+    model.tokenize_array(b"a", False, False)
+    assert model.tokenized == [b"a", b"a"] and first.flags.writeable
+
+    model.token_cache_size = 2
+    text = b"x" * (internals.LlamaModel.TOKEN_CACHE_MAX_BYTES + 1)
+    assert len(model.tokenize_array(text, False, False)) == len(text)
+    assert len(model._token_cache) == 0
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from nexa.gguf.server.model_pool import ModelPool, ModelPoolFull
+
+
+def _loader(loads, model_id, size_bytes):
+    async def load(reserve):
+        reserve(size_bytes)
+        loads.append(model_id)
+        await asyncio.sleep(0)
+        return model_id
+
+    return load
+
+
+# Test that idle models are evicted least recently used first and models in use never are
+def test_lru_eviction_within_budget():
+    async def run():
+        loads, closed = [], []
+        pool = ModelPool(budget_bytes=100, close=closed.append)
+
+        a = await pool.acquire("a", _loader(loads, "a", 40))
+        pool.release(a)
+        b = await pool.acquire("b", _loader(loads, "b", 40))
+        pool.release(b)
+        # Switching between resident models loads nothing
+        pool.release(await pool.acquire("a", _loader(loads, "a", 40)))
+        assert loads == ["a", "b"] and pool.hits == 1
+
+        # b is the least recently used
+        c = await pool.acquire("c", _loader(loads, "c", 40))
+        assert closed == ["b"] and list(pool.entries) == ["a", "c"]
+
+        # c is in use and evicting a alone leaves no room for d, so nothing is closed
+        with pytest.raises(ModelPoolFull):
+            await pool.acquire("d", _loader(loads, "d", 80))
+        assert closed == ["b"] and list(pool.entries) == ["a", "c"] and pool.used_bytes == 80
+        pool.release(c)
+        d = await pool.acquire("d", _loader(loads, "d", 80))
+        assert closed == ["b", "a", "c"] and pool.used_bytes == 80
+        pool.release(d)
+        assert pool.evictions == 3
+
+    asyncio.run(run())
+
+
+# Test concurrent loads of a model, pinning, the model count limit and removal of a model in use
+def test_shared_load_pin_and_remove():
+    async def run():
+        loads, closed = [], []
+        pool = ModelPool(max_models=2, close=closed.append)
+
+        first, second = await asyncio.gather(
+            pool.acquire("a", _loader(loads, "a", 0)), pool.acquire("a", _loader(loads, "a", 0)))
+        assert first is second and first.refs == 2 and loads == ["a"]
+        pool.release(first)
+        pool.release(second)
+        pool.pin("a")
+
+        pool.release(await pool.acquire("b", _loader(loads, "b", 0)))
+        pool.release(await pool.acquire("c", _loader(loads, "c", 0)))
+        # The pinned model stays although it is the least recently used
+        assert closed == ["b"] and list(pool.entries) == ["a", "c"]
+
+        c = await pool.acquire("c", _loader(loads, "c", 0))
+        assert pool.remove("c") and "c" not in pool and closed == ["b"]
+        pool.release(c)
+        assert closed == ["b", "c"]
+        assert not pool.remove("c")
+
+    asyncio.run(run())
+
+
+# Test that a pool full of pinned models refuses other models without loading them
+def test_full_pool_refuses_loads():
+    async def run():
+        loads, closed = [], []
+        pool = ModelPool(max_models=1, close=closed.append)
+        pool.release(await pool.acquire("a", _loader(loads, "a", 0)))
+        pool.pin("a")
+
+        for _ in range(3):
+            with pytest.raises(ModelPoolFull):
+                await pool.acquire("b", _loader(loads, "b", 0))
+        assert loads == ["a"] and closed == [] and list(pool.entries) == ["a"]
+        assert pool.misses == 4 and not pool._loading and not pool._reserved
+
+        # Refused by reserve once the size is known
+        pool.max_models = None
+        pool.budget_bytes = 100
+        pool.entries["a"].size_bytes = 60
+        with pytest.raises(ModelPoolFull):
+            await pool.acquire("b", _loader(loads, "b", 50))
+        assert loads == ["a"] and list(pool.entries) == ["a"] and not pool._reserved
+
+    asyncio.run(run())
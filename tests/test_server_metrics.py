@@ -0,0 +1,60 @@
+from nexa.gguf.llama.llama_timings import LlamaTimings
+from nexa.gguf.server.metrics import ServerMetrics
+
+
+def _samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+# Test a streamed and a failed request as they appear in the exposition
+def test_request_metrics():
+    metrics = ServerMetrics()
+    record = metrics.start("/v1/chat/completions", "llama3.2")
+    queued = _samples(metrics.render())
+    assert queued["nexa_requests_in_flight"] == 1
+    assert queued["nexa_requests_queued"] == 1
+
+    generate = metrics.decoding(record, lambda: metrics.timings.observe(
+        LlamaTimings(prompt_tokens=10, prefill_tokens=4, completion_tokens=3)))
+    generate()
+    for _ in range(3):
+        metrics.chunk(record)
+    metrics.finish(record)
+    metrics.finish(record)
+    metrics.finish(metrics.start("/v1/chat/completions", "llama3.2"), "error")
+
+    samples = _samples(metrics.render([("nexa_kv_cache_used_cells", "KV cells.", {"model": "llama3.2"}, 17)]))
+    labels = 'endpoint="/v1/chat/completions",model="llama3.2"'
+    assert samples[f'nexa_requests_total{{{labels},status="ok"}}'] == 1
+    assert samples[f'nexa_requests_total{{{labels},status="error"}}'] == 1
+    assert samples[f"nexa_prompt_tokens_total{{{labels}}}"] == 10
+    assert samples[f"nexa_completion_tokens_total{{{labels}}}"] == 3
+    assert samples[f"nexa_prefix_cache_hit_tokens_total{{{labels}}}"] == 6
+    assert samples['nexa_prefix_cache_hit_ratio{model="llama3.2"}'] == 0.6
+    assert samples[f"nexa_time_to_first_token_seconds_count{{{labels}}}"] == 1
+    assert samples[f"nexa_inter_token_latency_seconds_count{{{labels}}}"] == 2
+    assert samples[f"nexa_queue_wait_seconds_count{{{labels}}}"] == 1
+    assert samples[f"nexa_request_duration_seconds_count{{{labels}}}"] == 2
+    assert samples[f'nexa_request_duration_seconds_bucket{{{labels},le="+Inf"}}'] == 2
+    assert samples['nexa_llama_phase_seconds_count{phase="decode"}'] == 1
+    assert samples['nexa_kv_cache_used_cells{model="llama3.2"}'] == 17
+    assert samples["nexa_requests_in_flight"] == 0
+
+
+# Test that the model label stays bounded
+def test_model_labels_are_bounded():
+    metrics = ServerMetrics(max_models=2)
+    for i in range(100):
+        metrics.finish(metrics.start("/v1/completions", f"model-{i}"))
+        metrics.model_loaded(f"model-{i}", 1.0)
+    models = {
+        line.split('model="')[1].split('"')[0]
+        for line in metrics.render().splitlines()
+        if 'model="' in line
+    }
+    assert models == {"model-0", "model-1", "other"}